@@ -1,4 +1,4 @@
-import WebsiteControl from "./WebsiteControl";
+import WebsiteControl, { PlayerStatus } from "./WebsiteControl";
 import WebsiteControlRegistry, { WebsiteControlEntry } from "./WebsiteControlRegistry";
 
 export default class AudibleControl implements WebsiteControl {
@@ -143,6 +143,27 @@ export default class AudibleControl implements WebsiteControl {
         return this.ready;
     }
 
+    private lastPosition: number | null = null;
+    private lastPositionChange = 0;
+    public getState(): PlayerStatus {
+        const position = this.getCurrentPlaytime();
+        const duration = this.getMaxPlaytime();
+        const now = Date.now();
+        if (position !== this.lastPosition) {
+            this.lastPosition = position;
+            this.lastPositionChange = now;
+        }
+        const playing = this.isPlaying();
+        return {
+            playing: playing,
+            position: isNaN(position) ? null : position,
+            duration: isNaN(duration) ? null : duration,
+            buffering: playing && now - this.lastPositionChange > 2000, // the time display updates every second
+            chapter: this.chapterContent || null,
+            error: isNaN(this.getRemainingPlayTime()) ? "Connection lost" : null
+        };
+    }
+
     private chapterContent = "";
     private chapterChanged(mutations: MutationRecord[], observer: MutationObserver): void {
         if (this.bgPort === null)
@@ -1,10 +1,11 @@
 import { ChapterChangedEvent, CustomErrorEvent } from "./OfflinePlayerEvents";
-import WebsiteControl from "./WebsiteControl";
+import WebsiteControl, { PlayerStatus } from "./WebsiteControl";
 import WebsiteControlRegistry, { WebsiteControlEntry } from "./WebsiteControlRegistry";
 
 export default class OfflinePlayer implements WebsiteControl {
     private bgPort: chrome.runtime.Port | null = null;
     private isLoaded = false;
+    private chapter: string | null = null;
 
     constructor(private src: string, private file: string, private player: HTMLAudioElement, private win: Window) {
         // handler
@@ -33,9 +34,11 @@ export default class OfflinePlayer implements WebsiteControl {
             this.bgPort.postMessage("log\nerror\n" + e.message);
         });
         this.player.addEventListener("chapterChanged", (e) => {
-            if (!(e instanceof ChapterChangedEvent) || this.bgPort === null)
+            if (!(e instanceof ChapterChangedEvent))
                 return;
-            this.bgPort.postMessage("log\ninfo\nChapter changed: " + e.chapter);
+            this.chapter = e.chapter;
+            if (this.bgPort !== null)
+                this.bgPort.postMessage("log\ninfo\nChapter changed: " + e.chapter);
         });
 
         // start by loading file
@@ -73,8 +76,10 @@ export default class OfflinePlayer implements WebsiteControl {
                 chapter = this.win.document.querySelector(".amplitude-active-song-container[data-chapter] .song-artist");
                 chapter = chapter && chapter.textContent;
             }
-            if (chapter)
+            if (chapter) {
+                this.chapter = chapter;
                 this.bgPort.postMessage("log\ninfo\nChapter changed: " + chapter);
+            }
         } catch (e) {}
     }
 
@@ -145,6 +150,18 @@ export default class OfflinePlayer implements WebsiteControl {
         }
     }
 
+    public getState(): PlayerStatus {
+        const ready = this.isReady();
+        return {
+            playing: this.isPlaying(),
+            position: ready ? Math.round(this.player.currentTime * 10) / 10 : null,
+            duration: ready && isFinite(this.player.duration) ? Math.round(this.player.duration) : null,
+            buffering: !this.player.paused && this.player.readyState < HTMLMediaElement.HAVE_FUTURE_DATA,
+            chapter: this.chapter,
+            error: this.player.error !== null ? this.player.error.message + " (Code " + this.player.error.code + ")" : null
+        };
+    }
+
     public isReady(): boolean {
         return this.player.src !== "" && this.player.readyState >= HTMLMediaElement.HAVE_CURRENT_DATA; // enough to play current frame
     }
@@ -1,4 +1,14 @@
 
+/** Current state of the player, pushed to UserControl (see UserControl/PlayerState.py) */
+export interface PlayerStatus {
+    playing: boolean;
+    position: number | null; // seconds
+    duration: number | null; // seconds
+    buffering: boolean; // should be playing, but doesn't advance
+    chapter: string | null;
+    error: string | null;
+}
+
 export default interface WebsiteControl {
     play(): boolean;
     pause(): boolean;
@@ -12,4 +22,5 @@ export default interface WebsiteControl {
 
     setPort(port: chrome.runtime.Port | null): void;
     isReady(): boolean;
+    getState(): PlayerStatus;
 }
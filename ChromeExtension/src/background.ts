@@ -9,6 +9,7 @@ let currentPort: chrome.runtime.Port | null = null;
 let currentTab: chrome.tabs.Tab | null = null;
 let terminate = false; // socket closing from this side
 let lastLoad: string | null = null;
+let lastSubscribe: string | null = null; // state stream of the page
 let loadErrorTimer: number | null = null; // wait for tab to load, but trigger an error of that wasn't possible
 
 const host = "127.0.0.1";
@@ -16,6 +17,63 @@ const port = 1025;
 const retryTimeMs = 2000;
 const retriesTillTabClose = 5;
 const waitForLoadMs = 15000;
+const protocolVersion = 1;
+
+// message types and their fields (in legacy order), see UserControl/CommandChannel.py
+const messageFields: { [type: string]: string[] } = {
+    // commands from UserControl
+    load: ["url"],
+    reset: [],
+    shutdown: [],
+    play: [],
+    pause: [],
+    playSwitch: [],
+    rewind: ["secs"],
+    forward: ["secs"],
+    status: [],
+    subscribe: ["interval"],
+    // messages to UserControl
+    hello: [],
+    ack: ["re"],
+    log: ["level", "msg"],
+    readout: ["text"],
+    playing: [],
+    paused: [],
+    finished: [],
+    loaded: ["url"],
+    network: [],
+    unloaded: [],
+    state: ["playing", "position", "duration", "buffering", "chapter", "error"]
+};
+
+interface Message {
+    v: number;
+    type: string;
+    id?: number;
+    [field: string]: any;
+}
+
+/** Converts a message to the legacy text format (type and fields separated by newlines) used by the pages */
+function toLegacy(message: Message): string {
+    const fields = (messageFields[message.type] || []).filter(field => message[field] !== undefined && message[field] !== null);
+    return [message.type].concat(fields.map(field => String(message[field]))).join('\n');
+}
+
+/** Converts a legacy text message to a message, the last field gets the remaining lines */
+function fromLegacy(text: string): Message {
+    const lines = text.split('\n');
+    const fields = messageFields[lines[0]] || [];
+    const message: Message = { v: protocolVersion, type: lines[0] };
+    fields.forEach((field, i) => {
+        if (i + 1 < lines.length)
+            message[field] = i + 1 === fields.length ? lines.slice(i + 1).join('\n') : lines[i + 1];
+    });
+    return message;
+}
+
+function sendToSocket(text: string): void {
+    cmdSocket.send(JSON.stringify(fromLegacy(text)));
+}
 
 function connectToSocket(): void {
     try {
@@ -48,8 +106,10 @@ function connectToSocket(): void {
         socketOpen = true; // now the socket is really open
         socketReconnectTries = 0;
         console.info("Socket opened");
+        cmdSocket.send(JSON.stringify({ v: protocolVersion, type: "hello" })); // switch UserControl to the JSON protocol
+        lastSubscribe = null; // UserControl subscribes after hello
         if (reconnect)
-            cmdSocket.send("status"); // send current status, so cmdSocket knows it
+            sendToSocket("status"); // send current status, so cmdSocket knows it
         reconnect = false;
     });
     cmdSocket.addEventListener("error", onSocketError);
@@ -120,7 +180,32 @@ function onSocketReceive(ev: MessageEvent): void {
         return;
     }
 
-    const cmd = (ev.data as string).split('\n', 3);
+    const data = ev.data as string;
+    if (!data.startsWith("{") && !data.startsWith("[")) {
+        handleCommand(data); // legacy protocol (before hello was received)
+        return;
+    }
+    let messages: Message[];
+    try {
+        const parsed = JSON.parse(data);
+        messages = Array.isArray(parsed) ? parsed : [parsed];
+    } catch (error) {
+        console.error("Invalid message received on socket:", data);
+        return;
+    }
+    for (const message of messages) {
+        if (!message || typeof message.type !== "string") {
+            console.error("Invalid message received on socket:", message);
+            continue;
+        }
+        handleCommand(toLegacy(message));
+        if (message.id !== undefined && socketOpen)
+            cmdSocket.send(JSON.stringify({ v: protocolVersion, type: "ack", re: message.id }));
+    }
+}
+
+function handleCommand(data: string): void {
+    const cmd = data.split('\n', 3);
     switch (cmd[0]) {
         case "shutdown":
             socketCloseExpected = true;
@@ -137,11 +222,11 @@ function onSocketReceive(ev: MessageEvent): void {
             break;
         case "load":
             if (cmd.length != 2) {
-                console.error("Invalid command for load:", ev.data);
+                console.error("Invalid command for load:", data);
                 return;
             }
             if (!currentTab || !currentPort) {
-                lastLoad = ev.data as string;
+                lastLoad = data;
                 const url = isOfflineUrl(cmd[1]) ? getUrlFromOfflineUrl(cmd[1]) : cmd[1];
                 if (isOfflineUrl(cmd[1]))
                     console.info("Loading special offline url: " + url);
@@ -156,9 +241,9 @@ function onSocketReceive(ev: MessageEvent): void {
                 console.warn("could not send command, since there is no tab connected");
                 return;
             }
-            if ((ev.data as string) !== lastLoad) { // no need to do this after a reconnect
-                console.debug("Forwarding message to page:", ev.data as string);
-                currentPort.postMessage(ev.data as string);
+            if (data !== lastLoad) { // no need to do this after a reconnect
+                console.debug("Forwarding message to page:", data);
+                currentPort.postMessage(data);
             }
             break;
         case "playSwitch":
@@ -170,19 +255,26 @@ function onSocketReceive(ev: MessageEvent): void {
                 console.warn("could not send command, since there is no tab connected");
                 return;
             }
-            console.debug("Forwarding message to page:", ev.data as string);
-            currentPort.postMessage(ev.data as string);
+            console.debug("Forwarding message to page:", data);
+            currentPort.postMessage(data);
+            break;
+        case "subscribe":
+            lastSubscribe = data; // again for every new page
+            if (currentPort) {
+                console.debug("Forwarding message to page:", data);
+                currentPort.postMessage(data);
+            }
             break;
         case "status":
             if (currentPort) {
-                console.debug("Forwarding message to page:", ev.data as string);
-                currentPort.postMessage(ev.data as string);
+                console.debug("Forwarding message to page:", data);
+                currentPort.postMessage(data);
             } else {
-                cmdSocket.send("unloaded");
+                sendToSocket("unloaded");
             }
             break;
         default:
-            console.error("unknown command received:", ev.data);
+            console.error("unknown command received:", data);
     }
 }
 
@@ -192,8 +284,8 @@ function onLoadTimeout(): void {
 
     console.error("Page loading timed out after " + Math.round(waitForLoadMs / 1000) + " seconds.");
     if (socketOpen) {
-        cmdSocket.send("log\nerror\nPage loading timed out after " + Math.round(waitForLoadMs / 1000) + " seconds.");
-        cmdSocket.send("network");
+        sendToSocket("log\nerror\nPage loading timed out after " + Math.round(waitForLoadMs / 1000) + " seconds.");
+        sendToSocket("network");
     }
     if (currentTab) {
         lastLoad = null;
@@ -211,6 +303,11 @@ function onPortReceive(message: any, port: chrome.runtime.Port): void {
     if (!socketOpen)
         return;
 
+    if (message !== null && typeof message === "object" && message.type === "state") {
+        cmdSocket.send(JSON.stringify({ v: protocolVersion, ...message })); // already structured
+        return;
+    }
+
     if (!(message instanceof String) && typeof message !== "string") {
         console.error("Invalid message received on port:", message);
         return;
@@ -224,11 +321,11 @@ function onPortReceive(message: any, port: chrome.runtime.Port): void {
         case "finished":
         case "loaded":
             console.debug("Forwarding message to socket:", message);
-            cmdSocket.send(message as string);
+            sendToSocket(message as string);
             break;
         case "network":
             console.error("Connection lost");
-            cmdSocket.send(message as string);
+            sendToSocket(message as string);
             if (currentTab) {
                 lastLoad = null;
                 chrome.tabs.create({});
@@ -248,7 +345,7 @@ function onPortDisconnect(port: chrome.runtime.Port): void {
     currentPort = null;
     currentTab = null;
     if (socketOpen && !socketCloseExpected)
-        cmdSocket.send("unloaded");
+        sendToSocket("unloaded");
     // TODO check for new tab after timeout?
 }
 
@@ -280,6 +377,8 @@ function onPortConnect(port: chrome.runtime.Port): void {
         console.warn("Could not find the tab that just connected")
     if (lastLoad != null) // be sure correct page is loaded
         currentPort.postMessage(lastLoad);
+    if (lastSubscribe != null)
+        currentPort.postMessage(lastSubscribe);
 }
 chrome.runtime.onConnect.addListener(onPortConnect);
 
@@ -1,5 +1,6 @@
 import WebsiteControlRegistry from "./WebsiteControlRegistry";
 import { getUrlFromOfflineUrl, isOfflineUrl } from "./OfflineUrlHelper";
+import { PlayerStatus } from "./WebsiteControl";
 
 let bgPort: chrome.runtime.Port | null = null;
 const bgConnectRetryTimeout = 500;
@@ -11,6 +12,10 @@ if (control === null)
 function backgroundDisconnected(port: chrome.runtime.Port): void {
     bgPort = null;
     control.setPort(bgPort);
+    if (stateTimer !== null) { // the background script subscribes again
+        clearInterval(stateTimer);
+        stateTimer = null;
+    }
     console.error("Background script disconnected");
     setTimeout(connectToBackground, bgConnectRetryTimeout);
 }
@@ -21,6 +26,8 @@ function resendStatusAfterTimeout(timeout = 750) {
         clearTimeout(statusTimeout); // restart in case multiple actions happen
     statusTimeout = setTimeout(() => {
         statusTimeout = null;
+        if (stateTimer !== null)
+            pushState(); // changes after a command should arrive fast
         if (control.isPlaying())
             bgPort.postMessage("playing");
         else
@@ -28,6 +35,54 @@ function resendStatusAfterTimeout(timeout = 750) {
     }, timeout);
 }
 
+// state stream (after subscribe): changes are pushed at once, the position only if it differs from the expected one
+const stateSampleMs = 1000;
+const positionTolerance = 2; // seconds
+let stateTimer: number | null = null;
+let heartbeatMs = 0;
+let lastState: PlayerStatus | null = null;
+let lastStateTime = 0;
+
+function subscribe(interval: number): void {
+    if (stateTimer !== null)
+        clearInterval(stateTimer);
+    heartbeatMs = interval * 1000;
+    lastState = null;
+    stateTimer = setInterval(pushState, stateSampleMs);
+    pushState();
+}
+
+function pushState(): void {
+    if (bgPort === null || control === null)
+        return;
+    const now = Date.now();
+    if (!control.isReady()) {
+        // no state yet, but the heartbeat tells UserControl that the stream is alive
+        if (now - lastStateTime >= heartbeatMs) {
+            lastStateTime = now;
+            bgPort.postMessage({ type: "state" });
+        }
+        return;
+    }
+    const state = control.getState();
+    const delta: { [field: string]: any } = {};
+    let expectedPosition: number | null = null;
+    if (lastState !== null) {
+        for (const field of Object.keys(state))
+            if (field !== "position" && (state as any)[field] !== (lastState as any)[field])
+                delta[field] = (state as any)[field];
+        if (lastState.position !== null)
+            expectedPosition = lastState.position + (lastState.playing && !lastState.buffering ? (now - lastStateTime) / 1000 : 0);
+    } else
+        Object.assign(delta, state);
+    const positionChanged = state.position !== null && (expectedPosition === null || Math.abs(state.position - expectedPosition) > positionTolerance);
+    if (Object.keys(delta).length === 0 && !positionChanged && now - lastStateTime < heartbeatMs)
+        return; // nothing new
+    delta.position = state.position; // anchor for the extrapolation
+    lastState = state;
+    lastStateTime = now;
+    bgPort.postMessage({ type: "state", ...delta });
+}
 
 function backgroundMessage(msg: any, port: chrome.runtime.Port): void {
     if (!(msg instanceof String) && typeof msg !== "string") {
@@ -108,6 +163,14 @@ function backgroundMessage(msg: any, port: chrome.runtime.Port): void {
             control.forward(fsecs);
             resendStatusAfterTimeout();
             break;
+        case "subscribe":
+            if (cmd.length != 2 || !(parseFloat(cmd[1]) > 0)) {
+                console.error("Invalid command for subscribe", msg);
+                return;
+            }
+            console.info("Pushing player state at least every " + cmd[1] + " seconds");
+            subscribe(parseFloat(cmd[1]));
+            break;
         default:
             console.error("Unknown command received:", msg);
             break;
@@ -1,7 +1,158 @@
-__version_info__ = (1, 0, 0)
+import struct
+
+__version_info__ = (1, 1, 0)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Sebastian Hofmann (Kaemmelot)"
-__all__ = ['Card']
+__all__ = ['Card', 'binaryContentLength', 'decodeBinaryContent',
+           'encodeNdefContent', 'encodeCompactContent']
+
+
+# Besides the plain ascii text (terminated by 0x04), card contents can be binary encoded.
+# The format is recognized by the first byte of the first data block:
+# NDEF: 0x03 (NDEF message TLV), length (1 byte or 0xFF and 2 bytes), NDEF records.
+#     Only URI records are used, their prefix is abbreviated with the code of uriPrefixes.
+#     This is a private NDEF-like layout, not the NFC Forum MIFARE Classic mapping: the TLV starts at block 1
+#     (standard cards have the MAD in sector 0 and start at block 4), it has to be the first TLV (NULL, Lock and
+#     Memory Control TLVs are not skipped, 0x02 is the compact format) and all sectors use the key of the reader.
+#     Cards written by other NFC tools are read as (invalid) text.
+# Compact: 0x02, length of the entries (2 bytes), entries.
+#     Each entry is a prefix code (see compactPrefixes), length (1 byte) and the rest of the url.
+# The urls of both formats are joined with the url separator, so they result in the same content as the ascii text.
+ndefTlv = 0x03
+compactMagic = 0x02
+urlSeparator = ";"
+# URI identifier codes of the NFC Forum URI record type definition
+uriPrefixes = ("", "http://www.", "https://www.", "http://", "https://", "tel:", "mailto:",
+               "ftp://anonymous:anonymous@", "ftp://ftp.", "ftps://", "sftp://", "smb://", "nfs://",
+               "ftp://", "dav://", "news:", "telnet://", "imap:", "rtsp://", "urn:", "pop:", "sip:",
+               "sips:", "tftp:", "btspp://", "btl2cap://", "btgoep://", "tcpobex://", "irdaobex://",
+               "file://", "urn:epc:id:", "urn:epc:tag:", "urn:epc:pat:", "urn:epc:raw:", "urn:epc:",
+               "urn:nfc:")
+# the compact format knows some more prefixes, starting at 0x80
+compactPrefixes = dict(enumerate(uriPrefixes))
+compactPrefixes.update(enumerate(("offline://", "https://www.audible.de/pd/",
+                                  "https://www.audible.com/pd/", "https://www.audible.co.uk/pd/"), 0x80))
+
+
+def binaryContentLength(data):
+    """Returns the total number of bytes of binary encoded content based on its first block or None for ascii text"""
+    if len(data) >= 4 and data[0] == ndefTlv:
+        if data[1] == 0xFF:
+            return 4 + struct.unpack_from(">H", data, 2)[0]
+        return 2 + data[1]
+    if len(data) >= 3 and data[0] == compactMagic:
+        return 3 + struct.unpack_from(">H", data, 1)[0]
+    return None
+
+
+def decodeBinaryContent(data):
+    """Decodes the complete binary encoded content. Raises ValueError if it is invalid"""
+    try:
+        if data[0] == ndefTlv:
+            urls = _decodeNdef(data)
+        elif data[0] == compactMagic:
+            urls = _decodeCompact(data)
+        else:
+            raise ValueError("Unknown content format %#x" % data[0])
+    except (IndexError, KeyError, struct.error) as error:
+        raise ValueError("Invalid binary content: %s" % str(error))
+    return urlSeparator.join(urls)
+
+
+def _decodeNdef(data):
+    if data[1] == 0xFF:
+        (length,) = struct.unpack_from(">H", data, 2)
+        pos = 4
+    else:
+        (length, pos) = (data[1], 2)
+    end = pos + length
+    if end > len(data):
+        raise ValueError("NDEF message is incomplete")
+    urls = []
+    while pos < end:
+        header = data[pos]
+        typeLength = data[pos + 1]
+        pos += 2
+        if header & 0x10:  # short record
+            payloadLength = data[pos]
+            pos += 1
+        else:
+            (payloadLength,) = struct.unpack_from(">I", data, pos)
+            pos += 4
+        idLength = 0
+        if header & 0x08:
+            idLength = data[pos]
+            pos += 1
+        recordType = data[pos:pos + typeLength]
+        pos += typeLength + idLength
+        payload = data[pos:pos + payloadLength]
+        pos += payloadLength
+        if pos > end:
+            raise ValueError("NDEF record exceeds message")
+        # only well known URI records are relevant, others are skipped
+        if header & 0x07 == 0x01 and recordType == b"U" and len(payload) > 0:
+            urls.append(uriPrefixes[payload[0]] +
+                        payload[1:].decode("utf-8", "replace"))
+        if header & 0x40:  # message end
+            break
+    return urls
+
+
+def _decodeCompact(data):
+    (length,) = struct.unpack_from(">H", data, 1)
+    pos = 3
+    end = pos + length
+    if end > len(data):
+        raise ValueError("Compact content is incomplete")
+    urls = []
+    while pos < end:
+        prefix = compactPrefixes[data[pos]]
+        urlLength = data[pos + 1]
+        pos += 2
+        urls.append(prefix + data[pos:pos + urlLength].decode("utf-8", "replace"))
+        pos += urlLength
+    if pos > end:
+        raise ValueError("Compact entry exceeds content")
+    return urls
+
+
+def _splitPrefix(url, prefixes):
+    code = max(prefixes, key=lambda code: len(prefixes[code])
+               if url.startswith(prefixes[code]) else -1)
+    return (code, url[len(prefixes[code]):].encode("utf-8"))
+
+
+def encodeNdefContent(content):
+    """Encodes the content as NDEF message with one URI record per url"""
+    urls = content.split(urlSeparator)
+    message = bytearray()
+    for i, url in enumerate(urls):
+        (code, rest) = _splitPrefix(url, dict(enumerate(uriPrefixes)))
+        payload = bytes([code]) + rest
+        header = 0x01  # well known type
+        if i == 0:
+            header |= 0x80
+        if i == len(urls) - 1:
+            header |= 0x40
+        if len(payload) < 256:
+            message += bytes([header | 0x10, 1, len(payload)])
+        else:
+            message += bytes([header, 1]) + struct.pack(">I", len(payload))
+        message += b"U" + payload
+    if len(message) < 0xFF:
+        return bytes([ndefTlv, len(message)]) + message + b"\xFE"
+    return bytes([ndefTlv, 0xFF]) + struct.pack(">H", len(message)) + message + b"\xFE"
+
+
+def encodeCompactContent(content):
+    """Encodes the content in the compact format"""
+    entries = bytearray()
+    for url in content.split(urlSeparator):
+        (code, rest) = _splitPrefix(url, compactPrefixes)
+        if len(rest) > 0xFF:
+            raise ValueError("Url is too long for the compact format")
+        entries += bytes([code, len(rest)]) + rest
+    return bytes([compactMagic]) + struct.pack(">H", len(entries)) + entries
 
 
 class Card(object):
@@ -18,3 +169,24 @@ class Card(object):
     @property
     def content(self):
         return self._content
+
+
+if __name__ == "__main__":
+    from timeit import timeit
+
+    # compares the number of blocks and the decoding time of the formats
+    sample = ("https://www.audible.de/pd/Some-Book-Hoerbuch/B0123456789;"
+              "https://www.audible.com/pd/Some-Book-Audiobook/B0123456789;offline://Some%20Book/book.mp3")
+    text = (sample + chr(0x04)).encode("latin-1")
+    number = 100000
+    for (name, data, decode) in (
+            ("ascii", text, lambda: text[:text.find(0x04)].decode("latin-1")),
+            ("ndef", encodeNdefContent(sample), None),
+            ("compact", encodeCompactContent(sample), None)):
+        if decode == None:
+            data = data[:binaryContentLength(data)]
+            decode = (lambda data: lambda: decodeBinaryContent(data))(data)
+        assert decode() == sample
+        seconds = timeit(decode, number=number)
+        print("%-8s %4d bytes %3d blocks %6.2f us per decode" %
+              (name, len(data), -(-len(data) // 16), seconds / number * 1000000))
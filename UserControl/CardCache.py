@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['CardCache']
+
+
+class CardCache(object):
+    """Cache of card contents by uid, kept in memory and optionally in a file.
+
+    Every entry has a fingerprint: the numbers and data of the blocks that have to be read again to validate it.
+    These are the first and the last two blocks, so a changed length (in the first block of binary contents,
+    the position of the end char of ascii text) or beginning or end is noticed.
+    """
+
+    def __init__(self, filename=None, maxCards=256):
+        self._filename = filename
+        self._maxCards = maxCards
+        self._cards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self._filename:
+            self.__load()
+
+    def get(self, uid):
+        """Returns tuple of (content, fingerprint) for the uid or None. The fingerprint is a tuple of (block, data) tuples"""
+        return self._cards.get(self.__key(uid))
+
+    def hit(self, uid):
+        """Marks the entry of the uid as validated"""
+        key = self.__key(uid)
+        if key in self._cards:
+            self._cards.move_to_end(key)
+            self.hits += 1
+
+    def invalidate(self, uid):
+        """Removes the entry of the uid, its content does not match the card anymore"""
+        if self._cards.pop(self.__key(uid), None) != None and self._filename:
+            self.__save()
+
+    def put(self, uid, content, fingerprint):
+        """Stores the content of a completely read card and its fingerprint"""
+        self.misses += 1
+        key = self.__key(uid)
+        entry = (content, tuple((block, bytes(data)) for (block, data) in fingerprint))
+        if self._cards.get(key) == entry:
+            self._cards.move_to_end(key)
+            return
+        self._cards[key] = entry
+        self._cards.move_to_end(key)
+        while len(self._cards) > self._maxCards:
+            self._cards.popitem(last=False)
+        if self._filename:
+            self.__save()
+
+    @property
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __key(self, uid):
+        return ''.join('{:02X}'.format(byte) for byte in uid)
+
+    def __load(self):
+        try:
+            with open(self._filename, "r") as f:
+                cards = json.load(f)
+            for key, entry in cards.items():
+                self._cards[key] = (entry["content"], tuple(
+                    (block, bytes.fromhex(data)) for (block, data) in entry["fingerprint"]))
+            logging.debug("Loaded %d cached cards", len(self._cards))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as error:
+            logging.warning("Could not load card cache %s: %s",
+                            self._filename, str(error))
+            self._cards.clear()
+
+    def __save(self):
+        cards = OrderedDict()
+        for key, (content, fingerprint) in self._cards.items():
+            cards[key] = {"content": content, "fingerprint": [
+                (block, data.hex()) for (block, data) in fingerprint]}
+        tmpName = self._filename + ".tmp"
+        try:
+            with open(tmpName, "w") as f:
+                json.dump(cards, f)
+            os.replace(tmpName, self._filename)  # never leave a broken file behind
+        except OSError as error:
+            logging.warning("Could not save card cache %s: %s",
+                            self._filename, str(error))
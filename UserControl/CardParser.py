@@ -0,0 +1,78 @@
+import re
+import urllib.parse
+from collections import OrderedDict, namedtuple
+from posixpath import join, normpath
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['CardContent', 'CardParser']
+
+
+CardContent = namedtuple(
+    "CardContent", ["onlineUrls", "offlineUrl", "offlinePath", "invalidUrls"])
+CardContent.__doc__ = """The parsed (read-only) content of an RFID card.
+onlineUrls and invalidUrls are tuples, offlineUrl and offlinePath are None if the card has no offline url"""
+
+
+class CardParser(object):
+    """Parses the content of RFID cards into their urls. Results are memoized by card uid and content"""
+
+    urlSeparator = ";"
+    offlineScheme = "offline://"
+    onlineUrlRegex = re.compile(
+        r"^https?:\/\/(?:[a-z0-9_\-]+)+(?:\.[a-z0-9_\-]+)+(?:\/(?:[a-z0-9_\-\.]|%[\da-f]{2})+)+\/?(?:\?.*|#.*)?$", re.IGNORECASE)
+    offlineUrlRegex = re.compile(
+        r"^offline:\/\/(?:(?:[a-z0-9_\-\.]|%[\da-f]{2})+\/?)+$", re.IGNORECASE)
+
+    def __init__(self, offlineDir, maxCards=32):
+        self._offlineDir = offlineDir
+        self._maxCards = maxCards
+        self._parsed = OrderedDict()
+
+    def parse(self, card):
+        """Returns the CardContent of the given card"""
+        key = (tuple(card.uid), card.content)
+        content = self._parsed.get(key)
+        if content != None:
+            self._parsed.move_to_end(key)
+            return content
+        content = self.parseContent(card.content)
+        self._parsed[key] = content
+        while len(self._parsed) > self._maxCards:
+            self._parsed.popitem(last=False)
+        return content
+
+    def parseContent(self, text):
+        """Returns the CardContent of the given card content without memoizing it"""
+        onlineUrls = []
+        invalidUrls = []
+        offlineUrl = None
+        for url in text.split(self.urlSeparator):
+            if self.onlineUrlRegex.match(url) != None:
+                onlineUrls.append(url)
+            elif self.offlineUrlRegex.match(url) != None:
+                offlineUrl = url
+            else:
+                invalidUrls.append(url)
+        offlinePath = None
+        if offlineUrl != None:
+            offlinePath = normpath(join(self._offlineDir, urllib.parse.unquote(
+                offlineUrl[len(self.offlineScheme):])))
+        return CardContent(tuple(onlineUrls), offlineUrl, offlinePath, tuple(invalidUrls))
+
+
+if __name__ == "__main__":
+    from timeit import timeit
+
+    from Card import Card
+
+    # compares a memoized parse with a fresh one
+    card = Card([0x01, 0x02, 0x03, 0x04], "https://www.audible.de/pd/Some-Book-Hoerbuch/B0123456789;"
+                "https://www.audible.com/pd/Some-Book-Audiobook/B0123456789;offline://Some%20Book/book.mp3")
+    parser = CardParser("/automnt/offlineBooks")
+    number = 100000
+    for (name, parse) in (("fresh", lambda: parser.parseContent(card.content)),
+                          ("memoized", lambda: parser.parse(card))):
+        seconds = timeit(parse, number=number)
+        print("%-8s %6.2f us per parse" % (name, seconds / number * 1000000))
@@ -0,0 +1,179 @@
+"""
+Protocol between UserControl and the browser extension.
+
+Version 1 uses compact JSON objects: {"v": 1, "type": <type>, <fields of the type>}.
+Commands to the extension have an "id", the extension answers {"v": 1, "type": "ack", "re": <id>} after handling them.
+A frame can hold a single message or an array of messages.
+The extension starts with a "hello" message. Until then (or for older extensions) the legacy text protocol is used:
+the type and the fields of the message separated by newlines.
+After "subscribe" the extension pushes "state" messages with the changed player fields (see PlayerState),
+at least every interval seconds (an empty one is a heartbeat).
+"""
+
+import json
+import logging
+from itertools import count
+from threading import Lock
+from time import monotonic
+
+from SingleClientWebsocket import SingleClientWebsocket
+
+__version_info__ = (1, 1, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['protocolVersion', 'messageFields', 'encodeMessage', 'decodeFrame', 'CommandChannel']
+
+
+protocolVersion = 1
+# message types and their fields (in legacy order)
+messageFields = {
+    # commands to the extension
+    "load": ("url",),
+    "reset": (),
+    "shutdown": (),
+    "play": (),
+    "pause": (),
+    "playSwitch": (),
+    "rewind": ("secs",),
+    "forward": ("secs",),
+    "status": (),
+    "subscribe": ("interval",),
+    # messages from the extension
+    "hello": (),
+    "ack": ("re",),
+    "log": ("level", "msg"),
+    "readout": ("text",),
+    "playing": (),
+    "paused": (),
+    "finished": (),
+    "loaded": ("url",),
+    "network": (),
+    "unloaded": (),
+    "state": ("playing", "position", "duration", "buffering", "chapter", "error")
+}
+
+
+def encodeMessage(message, version=protocolVersion):
+    """Returns the frame of the message (dict with type and fields) in the given protocol version"""
+    if version >= 1:
+        message = dict({"v": version}, **message)
+        return json.dumps(message, separators=(",", ":"))
+    return "\n".join([message["type"]] + [str(message[field]) for field in messageFields[message["type"]]
+                                          if message.get(field) != None])
+
+
+def decodeFrame(frame):
+    """Returns the list of messages in the frame (JSON or legacy text). Raises ValueError if it is invalid"""
+    if frame.startswith("{") or frame.startswith("["):
+        messages = json.loads(frame)
+        if not isinstance(messages, list):
+            messages = [messages]
+        for message in messages:
+            if not isinstance(message, dict) or not isinstance(message.get("v"), int) or message["v"] < 1:
+                raise ValueError("Invalid message: %s" % json.dumps(message))
+    else:
+        fields = messageFields.get(frame.split("\n", 1)[0])
+        if fields == None:
+            raise ValueError("Unknown command received: %s" % frame)
+        lines = frame.split("\n", len(fields))  # the last field may contain newlines
+        messages = [dict(zip(("type",) + fields, lines), v=0)]
+    for message in messages:
+        if message.get("type") not in messageFields:
+            raise ValueError("Unknown command received: %s" % frame)
+    return messages
+
+
+class CommandChannel(object):
+    """
+    The protocol on top of SingleClientWebsocket. Messages are dicts with type and fields.
+    Commands get request ids, acks are matched to them to measure the round trip time per type
+    """
+
+    def __init__(self, ip, port, msgCallback, connCallback=None):
+        self._msgCallback = msgCallback
+        self._connCallback = connCallback
+        self._websocket = SingleClientWebsocket(
+            ip, port, self._receive, self._connected)
+        self._ids = count(1)
+        self._pending = {}  # id -> (type, send time)
+        self._pendingLock = Lock()  # commands are sent from several threads
+        self.version = 0
+        self.roundTrips = {}  # type -> [acks, total seconds, maximum seconds]
+
+    def start(self):
+        self._websocket.start()
+
+    def stop(self):
+        self._websocket.stop()
+        for line in self.roundTripLines():
+            logging.debug(line)
+
+    def send(self, type, wait=False, coalesceKey=None, **fields):
+        """Sends the command with the given fields. Returns False if it could not be queued (see SingleClientWebsocket.send)"""
+        message = dict(fields, type=type)
+        version = self.version
+        if version >= 1:
+            with self._pendingLock:
+                message["id"] = next(self._ids)
+                self._pending[message["id"]] = (type, monotonic())
+        # only JSON messages can be batched, a legacy extension could not parse the array
+        success = self._websocket.send(encodeMessage(
+            message, version), wait, coalesceKey, batchable=version >= 1)
+        if not success and version >= 1:
+            with self._pendingLock:
+                self._pending.pop(message["id"], None)
+        return success
+
+    def _connected(self, connected):
+        # every client starts with the legacy protocol until it says hello
+        self.version = 0
+        self._websocket.batchEncoder = None
+        with self._pendingLock:
+            self._pending.clear()
+        if self._connCallback != None:
+            self._connCallback(connected)
+
+    def _receive(self, frame):
+        try:
+            messages = decodeFrame(frame)
+        except ValueError as error:
+            logging.error(str(error))
+            return
+        for message in messages:
+            if message["type"] == "hello":
+                self.version = min(message["v"], protocolVersion)
+                self._websocket.batchEncoder = lambda frames: "[" + ",".join(frames) + "]"
+                logging.info("Browser uses protocol version %d", self.version)
+                self._msgCallback(message)
+            elif message["type"] == "ack":
+                self.__acked(message.get("re"))
+            else:
+                self._msgCallback(message)
+
+    def __acked(self, id):
+        with self._pendingLock:
+            pending = self._pending.pop(id, None)
+            if pending != None:
+                # commands are handled in order, so older ones were lost or replaced by coalescing
+                for older in [older for older in self._pending if older < id]:
+                    del self._pending[older]
+        if pending == None:
+            logging.warning("Ack for unknown request %s", str(id))
+            return
+        (type, sent) = pending
+        roundTrip = monotonic() - sent
+        statistics = self.roundTrips.setdefault(type, [0, 0.0, 0.0])
+        statistics[0] += 1
+        statistics[1] += roundTrip
+        statistics[2] = max(statistics[2], roundTrip)
+        logging.debug("Command %s (%d) acked after %.1f ms",
+                      type, id, roundTrip * 1000)
+
+    def roundTripLines(self):
+        """Returns the round trip statistics per command as lines of text"""
+        return ["%-12s %5d acks  round trip mean %7.1f ms  max %7.1f ms" % (type, acks, total / acks * 1000, maximum * 1000)
+                for type, (acks, total, maximum) in sorted(self.roundTrips.items())]
+
+    @property
+    def connected(self):
+        return self._websocket.connected
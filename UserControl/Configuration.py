@@ -19,7 +19,9 @@ defaultValues = {
         "readyRepeat": "0.0",
         "loggingDebug": "false",
         "useOffline": "true",
-        "offlineDir": "/automnt/offlineBooks"
+        "offlineDir": "/automnt/offlineBooks",
+        "offlineEngine": "threading",
+        "offlinePrefetchMB": "8"
     },
     "InputPins": {
         "shutdown": "40",
@@ -49,13 +51,25 @@ defaultValues = {
     "Chromium": {
         "checktime": "20.0",
         "display": "1",
-        "recheckBrowser": "150.0"
+        "recheckBrowser": "150.0",
+        "stateHeartbeat": "10.0"
     },
     "Extra": {
         "socketHost": "127.0.0.1",
         "socketPort": "1025",
         "readRepeatSecs": "1.0",
-        "readRetries": "5"
+        "readRetries": "5",
+        "rfidRemovalMode": "irq",
+        "rfidRemovalInterval": "0.25",
+        "rfidCardCache": "cardCache.json",
+        "soundBackend": "auto",
+        "soundDevice": "default",
+        "ttsCache": "ttsCache",
+        "ttsCacheSize": "16",
+        "volumeBackend": "auto",
+        "volumeMixer": "PCM",
+        "volumeInterval": "0.05",
+        "volumeAcceleration": "4"
     }
 }
 
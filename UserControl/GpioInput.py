@@ -1,8 +1,9 @@
 import asyncio
 import logging
-from threading import BoundedSemaphore, Thread
+from threading import BoundedSemaphore
 
-import RPi.GPIO as GPIO
+from Hardware import GPIO
+from SharedEventLoop import acquireEventLoop, releaseEventLoop
 
 __version_info__ = (1, 0, 0)
 __version__ = '.'.join(map(str, __version_info__))
@@ -11,7 +12,6 @@ __all__ = ['GpioInputButton', 'GpioInputRotaryEncoder', 'gpioInputStop']
 
 
 class GpioInput:
-    eventThread = None
     eventLoop = None
     gpioMode = None
     usedGpioPins = []
@@ -24,10 +24,7 @@ def init():
     global _initialized
     if _initialized:
         return
-    GpioInput.eventLoop = asyncio.new_event_loop()
-    GpioInput.eventThread = Thread(
-        target=GpioInput.eventLoop.run_forever, name="GpioInput.eventLoop")
-    GpioInput.eventThread.start()
+    GpioInput.eventLoop = acquireEventLoop()
     _initialized = True
 
 
@@ -36,16 +33,9 @@ def gpioInputStop(gpioCleanup=True):
     if not _initialized:
         return
     logging.debug("Stopping GPIO Input")
-    GpioInput.eventLoop.call_soon_threadsafe(GpioInput.eventLoop.stop)
-    GpioInput.eventThread.join()  # wait until loop stopped
-    # needed for next run_until_complete call
-    asyncio.set_event_loop(GpioInput.eventLoop)
-    try:
-        GpioInput.eventLoop.run_until_complete(asyncio.gather(
-            *asyncio.Task.all_tasks(GpioInput.eventLoop)))  # finish all pending tasks
-    except asyncio.CancelledError:
-        pass
-    GpioInput.eventLoop.close()  # now we can safely close the loop
+    releaseEventLoop()  # the last user finishes all pending tasks
+    GpioInput.eventLoop = None
+    _initialized = False
     if gpioCleanup and len(GpioInput.usedGpioPins) > 0:
         GPIO.setmode(GpioInput.gpioMode)  # why is this needed??
         GPIO.cleanup(GpioInput.usedGpioPins)
@@ -94,7 +84,7 @@ class GpioInputButton:
                 while holdTimeOff > 0 and isPressed:  # wait in intervals and recheck GPIO state
                     waitTime = self.__stateCheckTime if self.__stateCheckTime <= holdTimeOff else holdTimeOff
                     holdTimeOff -= self.__stateCheckTime
-                    await asyncio.sleep(waitTime, loop=GpioInput.eventLoop)
+                    await asyncio.sleep(waitTime)
                     isPressed = self.isPressed
                 if isPressed:  # call callback
                     self._holdCallback(self._pin)
@@ -105,14 +95,14 @@ class GpioInputButton:
                         while holdTimeRep > 0 and isPressed:  # wait in intervals and recheck GPIO state
                             waitTime = self.__stateCheckTime if self.__stateCheckTime <= holdTimeRep else holdTimeRep
                             holdTimeRep -= self.__stateCheckTime
-                            await asyncio.sleep(waitTime, loop=GpioInput.eventLoop)
+                            await asyncio.sleep(waitTime)
                             isPressed = self.isPressed
                         if isPressed:
                             self._holdCallback(self._pin)
             else:
                 while isPressed:  # wait in intervals and recheck GPIO state
                     # this causes other handlers to abort as long as the button is pressed
-                    await asyncio.sleep(self.__stateCheckTime, loop=GpioInput.eventLoop)
+                    await asyncio.sleep(self.__stateCheckTime)
                     isPressed = self.isPressed
         except:
             pass
@@ -1,8 +1,8 @@
 import asyncio
 import logging
-from threading import Thread
 
-import RPi.GPIO as GPIO
+from Hardware import GPIO
+from SharedEventLoop import acquireEventLoop, releaseEventLoop
 
 __version_info__ = (1, 0, 0)
 __version__ = '.'.join(map(str, __version_info__))
@@ -11,7 +11,6 @@ __all__ = ['GpioOutputLed', 'gpioOutputStop']
 
 
 class GpioOutput:
-    taskThread = None
     taskLoop = None
     gpioMode = None
     usedGpioPins = []
@@ -24,10 +23,7 @@ def init():
     global _initialized
     if _initialized:
         return
-    GpioOutput.taskLoop = asyncio.new_event_loop()
-    GpioOutput.taskThread = Thread(
-        target=GpioOutput.taskLoop.run_forever, name="GpioOutput.taskLoop")
-    GpioOutput.taskThread.start()
+    GpioOutput.taskLoop = acquireEventLoop()
     _initialized = True
 
 
@@ -36,9 +32,9 @@ def gpioOutputStop(gpioCleanup=True):
     if not _initialized:
         return
     logging.debug("Stopping GPIO Output")
-    GpioOutput.taskLoop.call_soon_threadsafe(GpioOutput.taskLoop.stop)
-    GpioOutput.taskThread.join()  # wait until loop stopped
-    GpioOutput.taskLoop.close()  # now we can safely close the loop
+    releaseEventLoop()
+    GpioOutput.taskLoop = None
+    _initialized = False
     if gpioCleanup and len(GpioOutput.usedGpioPins) > 0:
         GPIO.setmode(GpioOutput.gpioMode)  # why is this needed??
         GPIO.cleanup(GpioOutput.usedGpioPins)
@@ -59,9 +55,6 @@ class GpioOutputLed:
         GpioOutput.usedGpioPins.append(pin)
         GPIO.setup(pin, GPIO.OUT, initial=self._value)
 
-    async def __runTask(self, task):
-        await task
-
     async def __runPattern(self, pattern):
         try:
             if not isinstance(pattern, list):
@@ -75,7 +68,7 @@ class GpioOutputLed:
             pPos = 0
             while True:
                 # sleep for time given by pattern
-                await asyncio.sleep(pattern[pPos], loop=GpioOutput.taskLoop)
+                await asyncio.sleep(pattern[pPos])
                 curVal = self._off if curVal == self._on else self._on  # switch on/off
                 self._value = curVal
                 GPIO.output(self._pin, curVal)
@@ -93,7 +86,7 @@ class GpioOutputLed:
         if self._currentTask == None:
             return
         self.__taskEndValue = newValue
-        GpioOutput.taskLoop.call_soon_threadsafe(self._currentTask.cancel)
+        self._currentTask.cancel()  # cancels the task in the loop thread
         self._currentTask = None
 
     def on(self):
@@ -112,10 +105,8 @@ class GpioOutputLed:
 
     def setPattern(self, pattern):
         self._cancelCurrentTask()
-        self._currentTask = GpioOutput.taskLoop.create_task(
-            self.__runPattern(pattern))  # create task
-        asyncio.run_coroutine_threadsafe(self.__runTask(
-            self._currentTask), GpioOutput.taskLoop)  # and run it here
+        self._currentTask = asyncio.run_coroutine_threadsafe(
+            self.__runPattern(pattern), GpioOutput.taskLoop)
 
     def stopPattern(self):
         self._cancelCurrentTask()
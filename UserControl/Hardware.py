@@ -0,0 +1,19 @@
+import os
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['GPIO', 'RFID', 'hardwareBackend']
+
+
+# the backend has to be known at import time, because GPIO constants are used as default arguments
+# set AUDIBLEPLAYER_HARDWARE=simulated to run without a Raspberry Pi (see SimulatedHardware)
+hardwareBackend = os.environ.get("AUDIBLEPLAYER_HARDWARE", "rpi")
+
+if hardwareBackend == "simulated":
+    from SimulatedHardware import GPIO, RFID
+elif hardwareBackend == "rpi":
+    import RPi.GPIO as GPIO
+    from pirc522 import RFID
+else:
+    raise ImportError("Unknown hardware backend: %s" % hardwareBackend)
@@ -0,0 +1,70 @@
+from threading import Lock
+from time import monotonic
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['PlayerState']
+
+
+class PlayerState(object):
+    """
+    Live model of the player in the browser, updated by the state messages the extension pushes.
+    A message only contains the fields that changed, an empty one is a heartbeat. The model is stale if no message arrived for a while.
+    The position is only sent if it differs from the extrapolated one (seek, stall) or with other changes
+    """
+    fields = ("playing", "position", "duration", "buffering", "chapter", "error")
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets the state, e.g. when the browser disconnected"""
+        with self._lock:
+            for field in self.fields:
+                setattr(self, field, None)
+            self.lastUpdate = monotonic()  # a reset counts as fresh state
+            self.positionTime = None
+            self.bufferingSince = None
+            self.updates = 0
+
+    def update(self, message):
+        """Applies the changed fields of the message. Returns dict of field -> (old value, new value) for all fields that really changed"""
+        now = monotonic()
+        changes = {}
+        with self._lock:
+            for field in self.fields:
+                if field in message and getattr(self, field) != message[field]:
+                    changes[field] = (getattr(self, field), message[field])
+                    setattr(self, field, message[field])
+            if "position" in message:
+                self.positionTime = now
+            if "buffering" in changes:
+                self.bufferingSince = now if self.buffering else None
+            self.lastUpdate = now
+            self.updates += 1
+        return changes
+
+    @property
+    def age(self):
+        """Seconds since the last update or reset"""
+        return monotonic() - self.lastUpdate
+
+    def isStale(self, maxAge):
+        """Returns True if there was no update within maxAge seconds"""
+        return self.age > maxAge
+
+    def estimatedPosition(self):
+        """Returns the current position in seconds, extrapolated while playing, or None if unknown"""
+        with self._lock:
+            if self.position == None or self.positionTime == None:
+                return None
+            if self.playing and not self.buffering:
+                return self.position + monotonic() - self.positionTime
+            return self.position
+
+    def isStalled(self, maxBuffering):
+        """Returns True if the player should be playing but is buffering for more than maxBuffering seconds"""
+        bufferingSince = self.bufferingSince
+        return bool(self.playing) and bufferingSince != None and monotonic() - bufferingSince > maxBuffering
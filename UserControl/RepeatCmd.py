@@ -1,51 +1,75 @@
 import logging
 import subprocess
-from threading import BoundedSemaphore, Timer
+from threading import Lock, Thread
 
-__version_info__ = (1, 0, 0)
+from Scheduler import defaultScheduler
+
+__version_info__ = (1, 2, 0)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Sebastian Hofmann (Kaemmelot)"
 __all__ = ["repeatCmd", "stopAllCmds"]
 
 
-shutdown = False
-timersSema = BoundedSemaphore(1)
-timers = []
+jobs = []
+running = {}  # name -> Popen of the commands that did not finish yet
+runningLock = Lock()
+
+
+def _runCmd(cmd, name, repeatOnError, timeout):
+    """Starts the command, it is waited for in its own thread so the scheduler thread is never blocked"""
+    with runningLock:
+        if name in running:
+            logging.warning("Command %s is still running, skipping this run", name)
+            return
+        try:
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, close_fds=True)
+        except OSError as error:
+            logging.error("Error executing repeated command %s: %s",
+                          name, str(error))
+            if not repeatOnError:
+                defaultScheduler().cancel("command " + name)
+            return
+        running[name] = process
+    Thread(target=_waitCmd, args=(process, name, repeatOnError, timeout),
+           name="command " + name, daemon=True).start()
 
 
-def repeatCmd(cmd, interval, name, repeatOnError=False, t=-1):
-    if shutdown:
-        return
+def _waitCmd(process, name, repeatOnError, timeout):
     err = False
     try:
-        logging.info("Command %s returned: %s", name, subprocess.check_output(
-            cmd, timeout=2000).decode("utf-8").rstrip("\r\n"))  # universal_newlines=True,
-    except subprocess.CalledProcessError as error:
-        logging.error("Error executing repeated command %s: %s",
-                      name, str(error))
-        err = True
+        (output, _) = process.communicate(timeout=timeout)
+        if process.returncode != 0:
+            logging.error("Error executing repeated command %s: %s", name, str(
+                subprocess.CalledProcessError(process.returncode, process.args)))
+            err = True
+        else:
+            logging.info("Command %s returned: %s", name,
+                         output.decode("utf-8").rstrip("\r\n"))
     except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
         logging.error("Command %s took to long to execute", name)
         err = True
+    finally:
+        with runningLock:
+            running.pop(name, None)
+    if err and not repeatOnError:
+        defaultScheduler().cancel("command " + name)
+
 
-    timersSema.acquire()
-    stop = shutdown or (err and not repeatOnError)
-    if t < 0 and not stop:
-        t = len(timers)
-        timers.append(None)  # add dummy
-    if not stop:
-        timers[t] = Timer(interval, repeatCmd, [
-                          cmd, interval, name, repeatOnError, t])
-        timers[t].start()
-    else:
-        timers[t] = None  # remove entry without starting a new timer
-    timersSema.release()
+def repeatCmd(cmd, interval, name, repeatOnError=False, timeout=2000):
+    """
+    Runs the command now and then every interval seconds. The scheduler thread only starts it.
+    A run is killed after timeout seconds, runs that are due while it is still running are skipped
+    """
+    jobs.append(defaultScheduler().every(interval, _runCmd, args=(
+        cmd, name, repeatOnError, timeout), name="command " + name, delay=0))
 
 
 def stopAllCmds():
-    shutdown = True
-    timersSema.acquire()
-    for t in timers:
-        if t != None:  # stop all timers
-            t.cancel()
-    timersSema.release()
+    for job in jobs:
+        job.cancel()
+    del jobs[:]
+    with runningLock:
+        for process in running.values():
+            process.kill()
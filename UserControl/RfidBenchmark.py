@@ -0,0 +1,169 @@
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+from threading import Event
+from time import monotonic, sleep
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['main']
+
+
+class _Detector(object):
+    """Callback of the RfidReader that remembers when cards were detected and removed"""
+
+    def __init__(self):
+        self.detected = Event()
+        self.removed = Event()
+        self.removedAt = None
+
+    def __call__(self, card):
+        if card != None:
+            self.removed.clear()
+            self.detected.set()
+        else:
+            self.removedAt = monotonic()
+            self.detected.clear()
+            self.removed.set()
+
+
+def removal(hardware, RfidReader, mode, taps, hold):
+    """Taps a card taps times for hold seconds. Returns tuple of (removal latencies, SPI transactions per minute while present)"""
+    detector = _Detector()
+    reader = RfidReader(detector, removalMode=mode)
+    card = hardware.SimulatedCard([0x01, 0x02, 0x03, 0x04], "https://www.audible.de/pd/Some-Book-Hoerbuch/B0123456789")
+    latencies = []
+    transactions = 0
+    try:
+        for _ in range(taps):
+            hardware.rfidField.tap(card)
+            if not detector.detected.wait(2):
+                raise RuntimeError("Card was not detected")
+            spi = reader.spiTransactions
+            sleep(hold)
+            transactions += reader.spiTransactions - spi
+            removed = monotonic()
+            hardware.rfidField.remove()
+            if not detector.removed.wait(5):
+                raise RuntimeError("Removal was not detected")
+            latencies.append(detector.removedAt - removed)
+    finally:
+        reader.stop()
+    return (latencies, transactions / (taps * hold / 60))
+
+
+def lostInterrupts(hardware, RfidReader, hold):
+    """Checks that a card is kept while the interrupts of the reader get lost and its removal is detected afterwards. Returns a line of text"""
+    detector = _Detector()
+    reader = RfidReader(detector, removalMode=RfidReader.removalIrq)
+    card = hardware.SimulatedCard([0x05, 0x06, 0x07, 0x08], "offline://Some%20Book/book.mp3")
+    try:
+        hardware.rfidField.tap(card)
+        if not detector.detected.wait(2):
+            raise RuntimeError("Card was not detected")
+        checks = reader.removalChecks
+        reader._rfid.droppedInterrupts = 1000000
+        sleep(hold)
+        kept = not detector.removed.is_set()
+        checks = reader.removalChecks - checks
+        reader._rfid.droppedInterrupts = 0
+        hardware.rfidField.remove()
+        removed = detector.removed.wait(5)
+    finally:
+        reader.stop()
+    if not kept or not removed or checks == 0:
+        raise RuntimeError("Lost interrupts: card kept %s after %d checks, removal detected %s" % (kept, checks, removed))
+    return "lost interrupts: card kept during %d checks without interrupt, removal detected afterwards" % checks
+
+
+def read(hardware, RfidReader, CardCache, encoders, urls, taps, frameTime):
+    """Reads cards with 1 to urls urls in each format taps times, without and with card cache.
+    Every frame to the card takes frameTime seconds. Returns lines of text"""
+    books = ["https://www.audible.de/pd/Book-%d-Hoerbuch/B0%09d" % (i, i) for i in range(urls - 1)]
+    lines = []
+    for count in range(1, urls + 1):
+        content = ";".join(books[:count - 1] + ["offline://Book%%20%d/book.mp3" % count])
+        for (name, encode) in encoders:
+            card = hardware.SimulatedCard([0x01, 0x02, 0x03, count], encode(content))
+            blocks = next(i for i in range(len(card.blocks) - 1, 0, -1) if any(card.blocks[i])) + 1
+            results = []
+            for cache in (None, CardCache()):
+                detector = _Detector()
+                reader = RfidReader(detector, cardCache=cache)
+                reader._rfid.frameTime = frameTime
+                (times, frames) = ([], 0)
+                try:
+                    for _ in range(taps):
+                        sent = reader._rfid.frames
+                        hardware.rfidField.tap(card)
+                        if not detector.detected.wait(5):
+                            raise RuntimeError("Card was not detected")
+                        frames += reader._rfid.frames - sent
+                        times.append(reader.timeToCallback)
+                        if reader.currentCard.content != content:
+                            raise RuntimeError("%s card was read as %r" % (name, reader.currentCard.content))
+                        hardware.rfidField.remove()
+                        if not detector.removed.wait(5):
+                            raise RuntimeError("Removal was not detected")
+                finally:
+                    reader.stop()
+                if cache != None:
+                    times = times[1:]  # the first tap fills the cache
+                times.sort()
+                results.append("%6.1f ms %3d frames" % (times[len(times) // 2] * 1000, frames // taps))
+            lines.append("%d urls %-7s %4d bytes (up to block %2d)  read %s  cached %s" % (
+                count, name, len(encode(content)), blocks - 1, results[0], results[1]))
+    return lines
+
+
+def main():
+    """Runs the RfidReader against the simulated MFRC522 of SimulatedHardware and reports its timings. Exits with 1 if a check fails"""
+    parser = ArgumentParser(description="Benchmarks the RfidReader with a simulated reader")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    parser_removal = subparsers.add_parser(
+        "removal", help="Removal latency and SPI load of both removal modes, the irq mode with lost interrupts")
+    parser_removal.add_argument("--taps", type=int, default=5,
+                                help="Card taps per mode [default: 5]")
+    parser_removal.add_argument("--hold", type=float, default=2.0,
+                                help="Seconds a card stays on the reader [default: 2]")
+    parser_read = subparsers.add_parser(
+        "read", help="Time to the callback and frames to the card per card size and format, with and without card cache")
+    parser_read.add_argument("--urls", type=int, default=4,
+                             help="Largest card content in urls [default: 4]")
+    parser_read.add_argument("--taps", type=int, default=5,
+                             help="Card taps per card and cache mode [default: 5]")
+    parser_read.add_argument("--frame-time", type=float, default=2.0,
+                             help="Milliseconds a frame to the card takes [default: 2]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.benchmark == None:
+        parser.error("no benchmark given")
+
+    # the reader has to use the simulation
+    os.environ["AUDIBLEPLAYER_HARDWARE"] = "simulated"
+    import SimulatedHardware as hardware
+    from Card import encodeCompactContent, encodeNdefContent
+    from CardCache import CardCache
+    from RfidReader import RfidReader
+    try:
+        if args.benchmark == "removal":
+            for mode in (RfidReader.removalIrq, RfidReader.removalBackoff):
+                (latencies, transactions) = removal(hardware, RfidReader, mode, args.taps, args.hold)
+                latencies.sort()
+                print("%-8s removal p50 %6.1f ms  max %6.1f ms  %6.0f SPI transactions per minute" % (
+                    mode, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000, transactions))
+            print(lostInterrupts(hardware, RfidReader, args.hold))
+        elif args.benchmark == "read":
+            encoders = (("text", lambda content: content), ("ndef", encodeNdefContent),
+                        ("compact", encodeCompactContent))
+            for line in read(hardware, RfidReader, CardCache, encoders, args.urls, args.taps, args.frame_time / 1000):
+                print(line)
+    except RuntimeError as error:
+        print("FAILED: %s" % str(error))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,9 @@
 import logging
 from threading import Event, RLock, Thread
-from time import sleep
+from time import monotonic, sleep
 
-import RPi.GPIO as GPIO
-from Card import Card
-from pirc522 import RFID
+from Card import Card, binaryContentLength, decodeBinaryContent
+from Hardware import GPIO, RFID
 
 __version_info__ = (1, 0, 0)
 __version__ = '.'.join(map(str, __version_info__))
@@ -19,6 +18,16 @@ def arrayToHexString(arr):
     return res
 
 
+def crcA(data):
+    """Calculates the ISO 14443-3 CRC_A of the given bytes. Returns it as list of two bytes (LSB first)"""
+    crc = 0x6363
+    for byte in data:
+        byte ^= crc & 0xFF
+        byte = (byte ^ (byte << 4)) & 0xFF
+        crc = (crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)
+    return [crc & 0xFF, crc >> 8]
+
+
 class RfidReader(object):
     """The RFID reader class. Uses pi-rc522 to read cards in a separate thread and returns them as Card object to a given callback"""
 
@@ -46,9 +55,21 @@ class RfidReader(object):
     """
 
     rfidReadEndChar = chr(0x04)
+    # HLTA command with its precalculated CRC_A
+    haltCommand = [0x50, 0x00] + crcA([0x50, 0x00])
+    # data blocks in reading order (skipping reserved and trailer blocks)
+    dataBlocks = [block for block in range(1, 64) if block % 4 != 3]
+    # READ commands for all blocks with their precalculated CRC_A, so the reader does not need to calculate them
+    readCommands = [[0x30, block] + crcA([0x30, block]) for block in range(64)]
+    # removal detection modes
+    removalIrq = "irq"
+    removalBackoff = "backoff"
 
     def __init__(self, callback=None, pinRst=15, pinCe=24, pinIrq=13, pinMode=GPIO.BOARD,
-                 key=[0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF], keyName='A', bus=0, device=0, speed=1000000):
+                 key=[0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF], keyName='A', bus=0, device=0, speed=1000000,
+                 removalMode=removalIrq, removalInterval=0.25, removalMaxInterval=1.5, cardCache=None):
+        if removalMode != self.removalIrq and removalMode != self.removalBackoff:
+            raise ValueError("Unknown removal detection mode: %s" % removalMode)
         self._callback = callback
         self._currentCard = None
         logging.debug("Listening for RFID card with pins: rst=%d, ce=%d, irq=%d" % (pinRst, pinCe, pinIrq))
@@ -57,6 +78,15 @@ class RfidReader(object):
         self._rfidUtil = self._rfid.util()
         self.__key = key
         self.__keyName = keyName
+        self._removalMode = removalMode
+        self._removalInterval = removalInterval
+        self._removalMaxInterval = removalMaxInterval
+        self._cardCache = cardCache
+        # statistics
+        self.spiTransactions = 0
+        self.removalChecks = 0
+        self.timeToCallback = None
+        self.__countSpiTransactions()
         #self._rfidUtil.debug = True
         self._currentCardLock = RLock()
         self.__stopThread = Event()
@@ -68,6 +98,7 @@ class RfidReader(object):
         try:
             while not self.__stopThread.isSet():
                 self.__waitForTag()
+                detected = monotonic()
 
                 if self.__stopThread.isSet():
                     break
@@ -90,7 +121,17 @@ class RfidReader(object):
                 self._rfidUtil.auth(
                     self._rfid.auth_a if self.__keyName == 'A' else self._rfid.auth_b, self.__key)
 
-                (error, content) = self.__readCard()
+                cached = self._cardCache.get(uid) if self._cardCache != None else None
+                (error, content) = self.__readCachedCard(cached) if cached != None else (False, None)
+                fromCache = content != None
+                if fromCache:
+                    self._cardCache.hit(uid)
+                else:
+                    if cached != None and not error:
+                        self._cardCache.invalidate(uid)
+                    (error, content, fingerprint) = self.__readCard()
+                    if not error and self._cardCache != None:
+                        self._cardCache.put(uid, content, fingerprint)
 
                 # stop the crypto module on card
                 self._rfid.stop_crypto()
@@ -105,6 +146,11 @@ class RfidReader(object):
                     self._currentCardLock.acquire()
                     self._currentCard = Card(uid, content)
                     self._currentCardLock.release()
+                    self.timeToCallback = monotonic() - detected
+                    if self._cardCache != None:
+                        logging.debug("Card ready %.1f ms after detection (%s, cache hit rate %.0f%%)",
+                                      self.timeToCallback * 1000, "cached" if fromCache else "read",
+                                      self._cardCache.hitRate * 100)
                     self._callback(self._currentCard)
 
                     # wait until card is removed
@@ -122,15 +168,21 @@ class RfidReader(object):
 
     def __readCard(self):
         """
-        Reads the contents of the currently selected and authorized card.
-        Returns tuple of (error, content)
+        Reads the contents of the currently selected and authorized card. Contents can be ascii text or binary encoded (see Card).
+        Returns tuple of (error, content, fingerprint) with fingerprint as tuple of (block, data) tuples: the first and the last two blocks read.
+        The length of binary contents is in the first block, the end char of ascii text in the last one
         """
-        # read text content block for block (skipping reserved and trailer blocks)
-        content = ""
-        block = 1
+        start = monotonic()
+        endByte = ord(self.rfidReadEndChar)
+        content = bytearray()
+        blocksRead = 0
         finished = False
-        while not finished and not self.__stopThread.isSet():
-            # authorize for sector
+        blocks = []
+        binaryLength = None
+        for block in self.dataBlocks:
+            if self.__stopThread.isSet():
+                break
+            # authorize once per sector
             if block == 1 or block % 4 == 0:
                 error = self._rfidUtil.do_auth(block)
                 if error:
@@ -138,28 +190,90 @@ class RfidReader(object):
                                   self._rfidUtil.sector_string(block), str(block))
                     break
             # read data
-            (error, data) = self._rfid.read(block)
+            (error, data) = self.__readBlock(block)
             if error:
                 logging.error("Could not read block %s (B%s)",
                               self._rfidUtil.sector_string(block), str(block))
                 break
-            for byte in data:
-                # goon until end char is found
-                if chr(byte) == self.rfidReadEndChar:
+            blocksRead += 1
+            data = bytes(data)
+            blocks.append((block, data))
+            # binary contents know their length from the first block
+            if blocksRead == 1:
+                binaryLength = binaryContentLength(data)
+                if binaryLength != None and binaryLength > len(self.dataBlocks) * 16:
+                    logging.error("Binary content of %d bytes does not fit on the card", binaryLength)
+                    break
+            if binaryLength != None:
+                content += data
+                if len(content) >= binaryLength:
                     finished = True
                     break
-                content += chr(byte)
-            block += 1
-            # skip trailers
-            if block % 4 == 3:
-                block += 1
-            # maximum -> block 63
-            if block > 63:
+                continue
+            # goon until end char is found
+            end = data.find(endByte)
+            if end >= 0:
+                content += data[:end]
                 finished = True
+                break
+            content += data
+        else:
+            # maximum -> block 63
+            finished = binaryLength == None and not self.__stopThread.isSet()
         if not self.__stopThread.isSet():
             self._rfid.stop_crypto()
+        logging.debug("Read %d bytes from %d blocks in %.1f ms", len(content),
+                      blocksRead, (monotonic() - start) * 1000)
+        fingerprint = tuple(blocks) if len(blocks) <= 3 else tuple(blocks[:1] + blocks[-2:])
 
-        return (not finished, content if finished else None)
+        if not finished:
+            return (True, None, fingerprint)
+        if binaryLength == None:
+            return (False, content.decode("latin-1"), fingerprint)
+        try:
+            return (False, decodeBinaryContent(content[:binaryLength]), fingerprint)
+        except ValueError as error:
+            logging.error("Could not decode card content: %s", str(error))
+            return (True, None, fingerprint)
+
+    def __readCachedCard(self, cached):
+        """
+        Validates a cached card content of the currently selected and authorized card by reading only its fingerprint blocks.
+        Returns tuple of (error, content) with content None if it does not match. A failed read is an error, not a mismatch
+        """
+        (content, fingerprint) = cached
+        if fingerprint[0][0] != self.dataBlocks[0]:
+            return (False, None)  # entry of an older version with only the last two blocks
+        sector = None
+        for (block, expected) in fingerprint:
+            # authorize once per sector
+            if block // 4 != sector:
+                sector = block // 4
+                error = self._rfidUtil.do_auth(block)
+                if error:
+                    logging.debug("Authorization for cached block %s (B%s) failed",
+                                  self._rfidUtil.sector_string(block), str(block))
+                    return (True, None)
+            (error, data) = self.__readBlock(block)
+            if error:
+                logging.debug("Could not read cached block %s (B%s)",
+                              self._rfidUtil.sector_string(block), str(block))
+                return (True, None)
+            if bytes(data) != expected:
+                logging.debug("Cached content does not match the card anymore")
+                return (False, None)
+        return (False, content)
+
+    def __readBlock(self, block):
+        """
+        Reads a single block of the authorized sector.
+        Returns tuple of (error, data)
+        """
+        (error, data, length) = self._rfid.card_write(
+            self._rfid.mode_transrec, self.readCommands[block])
+        if len(data) != 16:
+            error = True
+        return (error, data)
 
     def __waitForTag(self):
         """Periodically checks if a tag is in range and returns once a tag was found. Custom version of the rfid library function"""
@@ -181,20 +295,81 @@ class RfidReader(object):
 
     def __waitForTagRemoval(self):
         """Periodically checks if tag is still present and returns once it's gone"""
+        checks = self.removalChecks
+        spiTransactions = self.spiTransactions
+        start = monotonic()
+        interval = self._removalInterval
         found = True
         while found and not self.__stopThread.isSet():
             # wait before next check
-            if self.__stopThread.wait(0.75):
+            if self.__stopThread.wait(interval):
                 return
-            # BUG: The following creates a relative high cpu usage. Is there a better way?
-            # TEMP_FIX: higher wait time
-            # request all tags (including halted!)
-            (error, tag) = self._rfid.request(0x52)
-            # try to select current card again and send it back to halt
-            if error or self.currentCard == None or not self._rfid.select_tag(self._currentCard.uid):
+            self.removalChecks += 1
+            if self.currentCard == None:
                 found = False
+            elif self._removalMode == self.removalIrq:
+                found = self.__isTagPresentIrq()
             else:
-                self._rfid.halt()
+                found = self.__isTagPresent()
+                # check less often the longer the card stays
+                interval = min(interval * 1.5, self._removalMaxInterval)
+        minutes = (monotonic() - start) / 60
+        if minutes > 0:
+            logging.debug("Tag removal detected after %d checks (%.0f SPI transactions per minute)",
+                          self.removalChecks - checks, (self.spiTransactions - spiTransactions) / minutes)
+
+    def __isTagPresent(self):
+        """Checks if the current tag is still present with the rfid library functions"""
+        # request all tags (including halted!)
+        (error, tag) = self._rfid.request(0x52)
+        # try to select current card again and send it back to halt
+        if error or self.currentCard == None or not self._rfid.select_tag(self._currentCard.uid):
+            return False
+        self._rfid.halt()
+        return True
+
+    def __isTagPresentIrq(self):
+        """Checks if the halted tag is still present. Waits for the answer interrupt instead of polling the reader"""
+        # clear all interrupt requests
+        self._rfid.dev_write(0x04, 0x7F)
+        self._rfid.irq.clear()
+        # this enables an interrupt for a received answer or a timeout of the reader timer:
+        self._rfid.dev_write(0x02, 0xA1)
+        self._rfid.dev_write(0x01, 0x00)
+        self._rfid.dev_write(0x0A, 0x80)
+        # this wakes up all cards, including halted ones:
+        self._rfid.dev_write(0x09, 0x52)
+        self._rfid.dev_write(0x01, 0x0C)
+        self._rfid.dev_write(0x0D, 0x87)
+        if not self._rfid.irq.wait(0.1):
+            logging.debug("No interrupt from RFID reader, assuming the tag is still present")
+            return True
+        answered = self._rfid.dev_read(0x04) & 0x20
+        self._rfid.dev_write(0x01, 0x00)
+        if not answered:
+            return False
+        # send the tag back to halt; it does not answer, so there is nothing to wait for
+        self._rfid.dev_write(0x0A, 0x80)
+        for byte in self.haltCommand:
+            self._rfid.dev_write(0x09, byte)
+        self._rfid.dev_write(0x0D, 0x00)
+        self._rfid.dev_write(0x01, 0x04)
+        return True
+
+    def __countSpiTransactions(self):
+        """Counts the register accesses of the reader (including those of the rfid library)"""
+        devWrite = self._rfid.dev_write
+        devRead = self._rfid.dev_read
+
+        def countedDevWrite(address, value):
+            self.spiTransactions += 1
+            return devWrite(address, value)
+
+        def countedDevRead(address):
+            self.spiTransactions += 1
+            return devRead(address)
+        self._rfid.dev_write = countedDevWrite
+        self._rfid.dev_read = countedDevRead
 
     @property
     def currentCard(self):
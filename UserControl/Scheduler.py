@@ -0,0 +1,189 @@
+import heapq
+import logging
+from itertools import count
+from threading import Condition, Lock, Thread, currentThread
+from time import monotonic
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['ScheduledJob', 'Scheduler',
+           'defaultScheduler', 'stopDefaultScheduler']
+
+
+class ScheduledJob(object):
+    """A one-shot or periodic (with interval) job of the Scheduler"""
+
+    def __init__(self, scheduler, name, due, interval, callback, args, kwargs):
+        self._scheduler = scheduler
+        self.name = name
+        self.due = due
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+
+class Scheduler(object):
+    """
+    Runs one-shot and periodic jobs in a single worker thread instead of a thread per threading.Timer.
+    Jobs wait in a heap, cancelling only marks them (they are dropped once due). Scheduling a job with the name of an active one replaces it.
+    Periodic jobs keep their rate: runs that were due while the job was still running (or waiting for another job) are skipped and counted as overruns.
+    The drift (delay between due time and start) and the overruns are tracked per job name
+    """
+
+    def __init__(self, name="Scheduler"):
+        self._condition = Condition(Lock())
+        self._queue = []
+        self._order = count()
+        self._jobs = {}
+        self._stopped = False
+        self.statistics = {}  # name -> [runs, overruns, total drift, maximum drift]
+        self.__thread = Thread(target=self._run, name=name)
+        self.__thread.start()
+
+    def callLater(self, delay, callback, args=(), kwargs=None, name=None):
+        """Calls the callback once after the given seconds. Returns the ScheduledJob"""
+        return self.__schedule(delay, None, callback, args, kwargs, name)
+
+    def every(self, interval, callback, args=(), kwargs=None, name=None, delay=None):
+        """Calls the callback every interval seconds, the first time after delay (default: interval) seconds. Returns the ScheduledJob"""
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        return self.__schedule(interval if delay == None else delay, interval, callback, args, kwargs, name)
+
+    def __schedule(self, delay, interval, callback, args, kwargs, name):
+        if name == None:
+            name = getattr(callback, "__name__", "job")
+        job = ScheduledJob(self, name, monotonic() + max(0, delay), interval,
+                           callback, args, kwargs if kwargs != None else {})
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Scheduler is stopped")
+            previous = self._jobs.get(name)
+            if previous != None:
+                previous.cancelled = True
+            self._jobs[name] = job
+            self.__push(job)
+        return job
+
+    def __push(self, job):
+        """Adds the job to the queue and wakes up the worker if it is due first. Needs the lock"""
+        heapq.heappush(self._queue, (job.due, next(self._order), job))
+        if self._queue[0][2] is job:
+            self._condition.notify()
+
+    def cancel(self, job):
+        """Cancels the job (given by ScheduledJob or name). Returns True if it was active"""
+        with self._condition:
+            if not isinstance(job, ScheduledJob):
+                job = self._jobs.get(job)
+                if job == None:
+                    return False
+            active = not job.cancelled
+            job.cancelled = True
+            if self._jobs.get(job.name) is job:
+                del self._jobs[job.name]
+            return active
+
+    def isScheduled(self, name):
+        """Returns True if a job with the given name is active"""
+        with self._condition:
+            return name in self._jobs
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job = None
+                while job == None and not self._stopped:
+                    if len(self._queue) == 0:
+                        self._condition.wait()
+                        continue
+                    (due, _, nextJob) = self._queue[0]
+                    if nextJob.cancelled:
+                        heapq.heappop(self._queue)
+                        continue
+                    now = monotonic()
+                    if due > now:
+                        self._condition.wait(due - now)
+                        continue
+                    heapq.heappop(self._queue)
+                    job = nextJob
+                if self._stopped:
+                    return
+            self.__runJob(job, now)
+
+    def __runJob(self, job, start):
+        drift = start - job.due
+        try:
+            job.callback(*job.args, **job.kwargs)
+        except Exception as error:
+            logging.error("Scheduled job %s failed: %s", job.name, str(error))
+        end = monotonic()
+        with self._condition:
+            statistics = self.statistics.setdefault(job.name, [0, 0, 0.0, 0.0])
+            statistics[0] += 1
+            statistics[2] += drift
+            statistics[3] = max(statistics[3], drift)
+            if job.cancelled:
+                return
+            if job.interval == None:
+                if self._jobs.get(job.name) is job:
+                    del self._jobs[job.name]
+                return
+            # keep the rate, skip the runs that were missed while running
+            missed = int((end - job.due) // job.interval)
+            if missed > 0:
+                statistics[1] += missed
+                logging.debug("Scheduled job %s missed %d runs with an interval of %.1fs",
+                              job.name, missed, job.interval)
+            job.due += job.interval * (missed + 1)
+            self.__push(job)
+
+    def statisticLines(self):
+        """Returns the statistics of all job names as lines of text"""
+        with self._condition:
+            return ["%-24s %5d runs %3d overruns  drift mean %6.1f ms  max %6.1f ms" % (
+                name, runs, overruns, totalDrift / runs * 1000, maxDrift * 1000)
+                for name, (runs, overruns, totalDrift, maxDrift) in sorted(self.statistics.items())]
+
+    def stop(self):
+        """Stops the worker thread. Pending jobs are dropped"""
+        with self._condition:
+            self._stopped = True
+            for job in self._jobs.values():
+                job.cancelled = True
+            self._jobs.clear()
+            self._condition.notify()
+        if currentThread() != self.__thread:
+            self.__thread.join()
+
+
+_defaultScheduler = None
+_lock = Lock()
+
+
+def defaultScheduler():
+    """Returns the Scheduler shared by UserControl and RepeatCmd"""
+    global _defaultScheduler
+    with _lock:
+        if _defaultScheduler == None:
+            _defaultScheduler = Scheduler("Scheduler.defaultScheduler")
+        return _defaultScheduler
+
+
+def stopDefaultScheduler():
+    """Stops the shared Scheduler and logs its statistics"""
+    global _defaultScheduler
+    with _lock:
+        if _defaultScheduler == None:
+            return
+        logging.debug("Stopping scheduler")
+        _defaultScheduler.stop()
+        for line in _defaultScheduler.statisticLines():
+            logging.debug(line)
+        _defaultScheduler = None
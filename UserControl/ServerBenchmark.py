@@ -0,0 +1,250 @@
+import http.client
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from threading import Thread, enumerate as enumerateThreads
+from time import monotonic, sleep
+
+from ThreadingRangeHTTPServer import FileCache, RangeHTTPRequestHandler, ReadAhead, get_threaded_server, run_server
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['main']
+
+
+def _createFile(directory, name, size):
+    """Creates a file of size bytes of random data and returns its path"""
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        for _ in range(0, size, 1024 * 1024):
+            f.write(os.urandom(min(1024 * 1024, size - f.tell())))
+    return path
+
+
+class _Server(object):
+    """Runs an offline server on the directory in its own thread"""
+
+    def __init__(self, directory, engine="threading"):
+        RangeHTTPRequestHandler.log_message = lambda *args: None
+        self._engine = engine
+        self.server = get_threaded_server(
+            port=18080, next_attempts=100, serve_path=directory, engine=engine)
+        self.port = self.server.server_address[1]
+        self._thread = Thread(target=run_server, kwargs={"server": self.server},
+                              name="ServerBenchmark.server")
+        self._thread.start()
+
+    def connect(self):
+        return http.client.HTTPConnection("localhost", self.port)
+
+    def stop(self):
+        if self._engine == "threading":
+            self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def _get(connection, path, headers={}):
+    """Requests the path on the connection and returns the body"""
+    connection.request("GET", path, headers=headers)
+    return connection.getresponse().read()
+
+
+def _cpuSeconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def throughput(directory, size, repeats):
+    """Downloads a file of size bytes repeats times with sendfile and with the copy loop. Returns lines of text"""
+    _createFile(directory, "throughput.bin", size)
+    lines = []
+    for (name, useSendfile) in (("sendfile", True), ("copy", False)):
+        RangeHTTPRequestHandler.use_sendfile = useSendfile and hasattr(os, "sendfile")
+        server = _Server(directory)
+        try:
+            connection = server.connect()
+            _get(connection, "/throughput.bin")  # warm the page cache
+            (start, cpu) = (monotonic(), _cpuSeconds())
+            for _ in range(repeats):
+                if len(_get(connection, "/throughput.bin")) != size:
+                    raise RuntimeError("Incomplete download")
+            (seconds, cpu) = (monotonic() - start, _cpuSeconds() - cpu)
+            connection.close()
+        finally:
+            server.stop()
+        lines.append("%-8s %8.1f MB/s  %6.1f ms CPU per MB (server and client)" % (
+            name, size * repeats / seconds / 1000000, cpu * 1000 / (size * repeats / 1000000)))
+    return lines
+
+
+def load(directory, engine, readers, requests, rangeSize=256 * 1024, size=48 * 1024 * 1024):
+    """Lets readers concurrent connections request ranges of a file. Returns lines of text with the latencies and server threads"""
+    path = _createFile(directory, "load.bin", size)
+    with open(path, "rb") as f:
+        data = f.read()
+    server = _Server(directory, engine)
+    latencies = []
+    threads = []
+    errors = []
+
+    def reader(number):
+        connection = server.connect()
+        try:
+            for i in range(requests):
+                offset = ((number * requests + i) * 997 * 4096) % (size - rangeSize)
+                start = monotonic()
+                body = _get(connection, "/load.bin", {
+                    "Range": "bytes=%d-%d" % (offset, offset + rangeSize - 1)})
+                latencies.append(monotonic() - start)
+                if body != data[offset:offset + rangeSize]:
+                    errors.append(offset)
+                threads.append(len([thread for thread in enumerateThreads() if thread.name not in (
+                    "MainThread", "ServerBenchmark.reader")]))
+        finally:
+            connection.close()
+    try:
+        clients = [Thread(target=reader, args=(i,), name="ServerBenchmark.reader") for i in range(readers)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        server.stop()
+    if len(errors) > 0:
+        raise RuntimeError("%d ranges had wrong contents" % len(errors))
+    latencies.sort()
+    return ["%-9s %4d readers  p50 %7.1f ms  p95 %7.1f ms  max %7.1f ms  server threads %d" % (
+        engine, readers, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+        latencies[-1] * 1000, max(threads))]
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    return "p50 %6.2f ms  p95 %6.2f ms" % (latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000)
+
+
+def fileCache(directory, requests, rangeSize=64 * 1024, size=16 * 1024 * 1024):
+    """Requests ranges of a file with the file cache (with and without mmap) and without it.
+    Returns lines of text with the latencies and the memory allocated per request (server and client, measured by tracemalloc)"""
+    _createFile(directory, "cache.bin", size)
+    lines = []
+    cache = RangeHTTPRequestHandler.file_cache
+    try:
+        for (name, maxEntries, useMmap) in (("no cache", 0, False), ("cache", 8, False), ("cache+mmap", 8, True)):
+            RangeHTTPRequestHandler.file_cache = FileCache(max_entries=maxEntries)
+            RangeHTTPRequestHandler.use_mmap = useMmap
+            server = _Server(directory)
+            try:
+                connection = server.connect()
+                latencies = []
+                # warm up, measure the latency and then (slower) the allocations
+                for run in ("warm up", "latency", "allocations"):
+                    if run == "allocations":
+                        tracemalloc.start()
+                        allocated = tracemalloc.get_traced_memory()[0]
+                    for i in range(10 if run == "warm up" else requests):
+                        offset = (i * 997 * 4096) % (size - rangeSize)
+                        start = monotonic()
+                        _get(connection, "/cache.bin", {"Range": "bytes=%d-%d" % (offset, offset + rangeSize - 1)})
+                        if run == "latency":
+                            latencies.append(monotonic() - start)
+                (current, peak) = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                connection.close()
+            finally:
+                server.stop()
+            files = RangeHTTPRequestHandler.file_cache
+            lines.append("%-10s %s  peak %6d KiB  %5d B kept per request  %d opens" % (
+                name, _percentiles(latencies), (peak - allocated) // 1024, (current - allocated) // requests, files.misses))
+    finally:
+        RangeHTTPRequestHandler.file_cache = cache
+        RangeHTTPRequestHandler.use_mmap = False
+    return lines
+
+
+def readAhead(directory, files, delay, size=32 * 1024 * 1024):
+    """Measures the time to the first byte of files that are not in the page cache, with and without read-ahead.
+    The read-ahead starts delay seconds before the request (like on card detection). Returns lines of text"""
+    if not hasattr(os, "posix_fadvise"):
+        return ["read-ahead: posix_fadvise is needed to drop files from the page cache"]
+    paths = [_createFile(directory, "book%d.bin" % i, size) for i in range(files)]
+    lines = []
+    for window in (0, 8 * 1024 * 1024):
+        RangeHTTPRequestHandler.read_ahead = ReadAhead(window)
+        server = _Server(directory)
+        try:
+            for path in paths:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)  # dirty pages cannot be dropped
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+                RangeHTTPRequestHandler.file_cache.clear()
+                RangeHTTPRequestHandler.read_ahead.prefetch(path)
+                sleep(delay)
+                connection = server.connect()
+                _get(connection, "/" + os.path.basename(path), {"Range": "bytes=0-%d" % (4 * 1024 * 1024 - 1)})
+                connection.close()
+        finally:
+            server.stop()
+        lines.append("read-ahead %-8s first byte %s" % ("%d MiB" % (window // 1024 // 1024) if window > 0 else "off",
+                                                       _percentiles(RangeHTTPRequestHandler.read_ahead.first_byte_times)))
+    RangeHTTPRequestHandler.read_ahead = None
+    return lines
+
+
+def main():
+    """Benchmarks the offline server on loopback with generated files in a temporary directory"""
+    parser = ArgumentParser(description="Benchmarks the offline server")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    parser_throughput = subparsers.add_parser(
+        "throughput", help="Compares sendfile with the copy loop")
+    parser_throughput.add_argument("--size", type=int, default=64,
+                                   help="File size in MiB [default: 64]")
+    parser_throughput.add_argument("--repeats", type=int, default=10,
+                                   help="Downloads per mode [default: 10]")
+    parser_load = subparsers.add_parser(
+        "load", help="Concurrent range requests with both engines")
+    parser_load.add_argument("--readers", type=int, nargs="+", default=[1, 10, 100],
+                             help="Numbers of concurrent readers [default: 1 10 100]")
+    parser_load.add_argument("--requests", type=int, default=10,
+                             help="Range requests of 256 KiB per reader [default: 10]")
+    parser_cache = subparsers.add_parser(
+        "cache", help="Latency and allocations with and without the file cache, time to the first byte with and without read-ahead")
+    parser_cache.add_argument("--requests", type=int, default=1000,
+                              help="Range requests of 64 KiB per mode [default: 1000]")
+    parser_cache.add_argument("--files", type=int, default=5,
+                              help="Uncached files for the read-ahead [default: 5]")
+    parser_cache.add_argument("--delay", type=float, default=0.2,
+                              help="Seconds between read-ahead and request [default: 0.2]")
+    parser.add_argument("--dir", type=str, default=None,
+                        help="Directory for the generated files, should be on the disk of the books [default: a temporary one]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.benchmark == None:
+        parser.error("no benchmark given")
+    directory = tempfile.mkdtemp(prefix="ServerBenchmark-", dir=args.dir)
+    try:
+        if args.benchmark == "throughput":
+            lines = throughput(directory, args.size * 1024 * 1024, args.repeats)
+        elif args.benchmark == "load":
+            lines = [line for readers in args.readers for engine in ("threading", "asyncio")
+                     for line in load(directory, engine, readers, args.requests)]
+        elif args.benchmark == "cache":
+            lines = fileCache(directory, args.requests) + \
+                readAhead(directory, args.files, args.delay)
+        for line in lines:
+            print(line)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import resource
+from threading import Lock, Thread, active_count, currentThread
+
+__version_info__ = (1, 0, 1)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['acquireEventLoop', 'releaseEventLoop',
+           'isEventLoopThread', 'threadStatistics']
+
+
+class SharedEventLoop:
+    """The event loop shared by GPIO input, GPIO output and the websocket, so they don't need a thread each"""
+    loop = None
+    thread = None
+    users = 0
+    shutdownTimeout = 1.0
+
+
+_lock = Lock()
+
+
+def acquireEventLoop():
+    """Returns the shared event loop and starts it for the first user"""
+    with _lock:
+        if SharedEventLoop.users == 0:
+            SharedEventLoop.loop = asyncio.new_event_loop()
+            SharedEventLoop.thread = Thread(
+                target=SharedEventLoop.loop.run_forever, name="SharedEventLoop.loop")
+            SharedEventLoop.thread.start()
+        SharedEventLoop.users += 1
+        return SharedEventLoop.loop
+
+
+def releaseEventLoop():
+    """
+    Releases the shared event loop. The last user stops the loop and gives the pending tasks shutdownTimeout seconds to finish,
+    the remaining ones (like loops waiting for input) are cancelled
+    """
+    with _lock:
+        if SharedEventLoop.users == 0:
+            return
+        SharedEventLoop.users -= 1
+        if SharedEventLoop.users > 0:
+            return
+        logging.debug("Stopping shared event loop")
+        loop = SharedEventLoop.loop
+        loop.call_soon_threadsafe(loop.stop)
+        SharedEventLoop.thread.join()  # wait until loop stopped
+        # needed for next run_until_complete call
+        asyncio.set_event_loop(loop)
+        pending = asyncio.Task.all_tasks(loop) if hasattr(
+            asyncio.Task, "all_tasks") else asyncio.all_tasks(loop)
+        if len(pending) > 0:
+            (_, pending) = loop.run_until_complete(
+                asyncio.wait(pending, timeout=SharedEventLoop.shutdownTimeout))
+        if len(pending) > 0:
+            logging.debug("Cancelling %d tasks of the shared event loop", len(pending))
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(
+                *pending, return_exceptions=True))
+        loop.close()  # now we can safely close the loop
+        SharedEventLoop.loop = None
+        SharedEventLoop.thread = None
+
+
+def isEventLoopThread():
+    """Returns True if called from the thread of the shared event loop"""
+    return SharedEventLoop.thread == currentThread()
+
+
+def threadStatistics():
+    """Returns tuple of (threads, voluntary context switches, involuntary context switches) of this process, including finished threads"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (active_count(), usage.ru_nvcsw, usage.ru_nivcsw)
@@ -0,0 +1,597 @@
+import heapq
+import logging
+import random
+from collections import deque
+from itertools import count
+from threading import Event, Lock, Thread, active_count
+from time import monotonic, sleep
+
+__version_info__ = (1, 0, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['GPIO', 'RFID', 'SimulatedCard', 'rfidField', 'press', 'turn', 'tap', 'remove',
+           'Scenario', 'LatencyProbe']
+
+
+class SimulatedGPIO(object):
+    """Simulated replacement of the RPi.GPIO module. Input levels are set by scripts and edge callbacks run in the setting thread"""
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    PULL_DOWN = PUD_DOWN  # used by UserControl
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._lock = Lock()
+        self._mode = None
+        self._levels = {}
+        self._idleLevels = {}
+        self._events = {}  # pin -> [edge, bouncetime, last call, callbacks]
+        self.outputs = {}  # pin -> list of (time, level) changes
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def getmode(self):
+        return self._mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=-1):
+        with self._lock:
+            if direction == self.IN:
+                level = self.LOW if pull_up_down == self.PUD_DOWN else self.HIGH
+                self._idleLevels[pin] = level
+            else:
+                level = self.LOW if initial == -1 else initial
+                self.outputs.setdefault(pin, []).append((monotonic(), level))
+            self._levels[pin] = level
+
+    def input(self, pin):
+        level = self._levels.get(pin)
+        if level == None:
+            raise RuntimeError("Pin %d is not set up" % pin)
+        return level
+
+    def output(self, pin, value):
+        with self._lock:
+            if pin not in self._levels:
+                raise RuntimeError("Pin %d is not set up" % pin)
+            if self._levels[pin] != value:
+                self._levels[pin] = value
+                self.outputs[pin].append((monotonic(), value))
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            self._events[pin] = [edge, (bouncetime or 0) / 1000, None,
+                                 [callback] if callback != None else []]
+
+    def add_event_callback(self, pin, callback):
+        with self._lock:
+            self._events[pin][3].append(callback)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._events.pop(pin, None)
+
+    def cleanup(self, channels=None):
+        with self._lock:
+            if channels == None:
+                channels = list(self._levels)
+            elif isinstance(channels, int):
+                channels = [channels]
+            for pin in channels:
+                self._levels.pop(pin, None)
+                self._idleLevels.pop(pin, None)
+                self._events.pop(pin, None)
+
+    def idleLevel(self, pin):
+        """Returns the level of the input pin without any interaction (given by its pull up/down)"""
+        return self._idleLevels[pin]
+
+    def setInput(self, pin, level):
+        """Changes the level of the input pin and calls the matching edge callbacks"""
+        with self._lock:
+            if pin not in self._levels:
+                raise RuntimeError("Pin %d is not set up" % pin)
+            changed = self._levels[pin] != level
+            self._levels[pin] = level
+            event = self._events.get(pin)
+            if not changed or event == None:
+                return
+            edge = self.RISING if level == self.HIGH else self.FALLING
+            if event[0] != self.BOTH and event[0] != edge:
+                return
+            now = monotonic()
+            if event[2] != None and now - event[2] < event[1]:
+                return  # bounce
+            event[2] = now
+            callbacks = list(event[3])
+        for callback in callbacks:
+            callback(pin)
+
+
+class SimulatedCard(object):
+    """A simulated MIFARE Classic 1K card. The content is written to the data blocks like the programmer does"""
+
+    def __init__(self, uid, content):
+        self.uid = list(uid)
+        if isinstance(content, str):
+            content = (content + chr(0x04)).encode("latin-1")
+        dataBlocks = [block for block in range(1, 64) if block % 4 != 3]
+        if len(content) > len(dataBlocks) * 16:
+            raise ValueError("Content does not fit on the card")
+        self.blocks = [bytes(16)] * 64
+        for i, block in enumerate(dataBlocks):
+            self.blocks[block] = content[i * 16:i * 16 + 16].ljust(16, b"\0")
+        self.halted = False
+
+
+class RfidField(object):
+    """The field of the simulated RFID reader. Cards are tapped and removed by scripts"""
+
+    def __init__(self):
+        self.card = None
+
+    def tap(self, card):
+        card.halted = False  # the card is powered up again
+        self.card = card
+
+    def remove(self):
+        self.card = None
+
+
+class SimulatedRFIDUtil(object):
+    """Simulated replacement of the pirc522 RFIDUtil (only the functions used by RfidReader)"""
+
+    def __init__(self, rfid):
+        self.rfid = rfid
+        self.debug = False
+        self.uid = None
+        self.method = None
+        self.key = None
+
+    def set_tag(self, uid):
+        self.uid = uid
+        return self.rfid.select_tag(uid)
+
+    def auth(self, auth_method, key):
+        self.method = auth_method
+        self.key = key
+
+    def do_auth(self, block_address, force=False):
+        return self.rfid.card_auth(self.method, block_address, self.key, self.uid)
+
+    def sector_string(self, block_address):
+        return "S" + str(block_address // 4) + "B" + str(block_address % 4)
+
+
+class SimulatedRFID(object):
+    """Simulated replacement of the pirc522 RC522 reader. Emulates the registers and interrupts used by RfidReader"""
+
+    mode_idle = 0x00
+    mode_auth = 0x0E
+    mode_transmit = 0x04
+    mode_transrec = 0x0C
+    act_reqidl = 0x26
+    act_reqall = 0x52
+    act_anticl = 0x93
+    act_select = 0x93
+    act_read = 0x30
+    act_end = 0x50
+    auth_a = 0x60
+    auth_b = 0x61
+
+    def __init__(self, bus=0, device=0, speed=1000000, pin_rst=22, pin_ce=0, pin_irq=18, pin_mode=None):
+        self.irq = Event()
+        self._fifo = []
+        self._command = self.mode_idle
+        self._comIEn = 0x00
+        self._comIrq = 0x00
+        self._authenticated = None  # authenticated sector
+        self.droppedInterrupts = 0  # the next interrupts that get lost (like with a loose irq wire)
+        self.frames = 0  # frames sent to cards
+        self.frameTime = 0.0  # seconds a frame and its answer take (a block read takes some ms on the real reader)
+
+    def init(self):
+        self._fifo = []
+        self._command = self.mode_idle
+        self._comIEn = 0x00
+        self._comIrq = 0x00
+        self._authenticated = None
+
+    def dev_write(self, address, value):
+        if address == 0x01:  # CommandReg
+            self._command = value & 0x0F
+            if self._command == self.mode_transmit:
+                self.__execute()
+        elif address == 0x02:  # ComIEnReg
+            self._comIEn = value
+        elif address == 0x04:  # ComIrqReg, bit 7 sets or clears the marked bits
+            if value & 0x80:
+                self._comIrq |= value & 0x7F
+            else:
+                self._comIrq &= ~value
+        elif address == 0x09:  # FIFODataReg
+            self._fifo.append(value)
+        elif address == 0x0A:  # FIFOLevelReg
+            if value & 0x80:
+                self._fifo = []
+        elif address == 0x0D:  # BitFramingReg, bit 7 starts a transceive
+            if value & 0x80 and self._command == self.mode_transrec:
+                self.__execute()
+
+    def dev_read(self, address):
+        if address == 0x04:
+            return self._comIrq
+        if address == 0x09:
+            return self._fifo.pop(0) if len(self._fifo) > 0 else 0
+        if address == 0x0A:
+            return len(self._fifo)
+        return 0
+
+    def __execute(self):
+        """Sends the frame in the FIFO like the reader and raises the interrupts for its answer"""
+        answer = self.__answer(self._fifo)
+        self._fifo = []
+        if self._command == self.mode_transmit:
+            self._comIrq |= 0x40  # TxIRq
+        elif answer == None:
+            self._comIrq |= 0x01  # TimerIRq
+        else:
+            self._fifo = list(answer)
+            self._comIrq |= 0x20  # RxIRq
+        if self._comIrq & self._comIEn & 0x7F:
+            if self.droppedInterrupts > 0:
+                self.droppedInterrupts -= 1
+            else:
+                self.irq.set()
+
+    def __answer(self, frame):
+        """Returns the answer of the card in the field for the frame or None"""
+        card = rfidField.card
+        if card == None or len(frame) == 0:
+            return None
+        self.frames += 1
+        if self.frameTime > 0:
+            sleep(self.frameTime)
+        command = frame[0]
+        if command == self.act_reqidl and len(frame) == 1:
+            return None if card.halted else [0x04, 0x00]
+        if command == self.act_reqall and len(frame) == 1:
+            card.halted = False
+            return [0x04, 0x00]
+        if command == self.act_end:
+            card.halted = True
+            self._authenticated = None
+            return None
+        if card.halted:
+            return None
+        if command == self.act_anticl and frame[1] == 0x20:
+            bcc = 0
+            for byte in card.uid:
+                bcc ^= byte
+            return card.uid + [bcc]
+        if command == self.act_select and frame[1] == 0x70:
+            return [0x08, 0xB6, 0xDD] if list(frame[2:6]) == card.uid else None
+        if command == self.auth_a or command == self.auth_b:
+            self._authenticated = frame[1] // 4
+            return []
+        if command == self.act_read:
+            if self._authenticated != frame[1] // 4:
+                return None
+            return list(card.blocks[frame[1]])
+        return None
+
+    def card_write(self, command, data):
+        """Returns tuple of (error, back data, back length in bits)"""
+        answer = self.__answer(list(data))
+        if answer == None:
+            return (True, [], 0)
+        return (False, answer, len(answer) * 8)
+
+    def request(self, req_mode=0x26):
+        (error, back_data, back_bits) = self.card_write(
+            self.mode_transrec, [req_mode])
+        if error or back_bits != 0x10:
+            return (True, None)
+        return (False, back_bits)
+
+    def anticoll(self):
+        (error, back_data, back_bits) = self.card_write(
+            self.mode_transrec, [self.act_anticl, 0x20])
+        if error or len(back_data) != 5:
+            return (True, back_data)
+        return (False, back_data)
+
+    def select_tag(self, uid):
+        (error, back_data, back_bits) = self.card_write(
+            self.mode_transrec, [self.act_select, 0x70] + list(uid[:5]))
+        return not (not error and back_bits == 0x18)
+
+    def card_auth(self, auth_mode, block_address, key, uid):
+        (error, back_data, back_bits) = self.card_write(
+            self.mode_auth, [auth_mode, block_address] + list(key) + list(uid[:4]))
+        return error
+
+    def stop_crypto(self):
+        self._authenticated = None
+
+    def halt(self):
+        self.card_write(self.mode_transrec, [self.act_end, 0x00])
+
+    def util(self):
+        return SimulatedRFIDUtil(self)
+
+    def cleanup(self):
+        pass
+
+
+GPIO = SimulatedGPIO()
+RFID = SimulatedRFID
+rfidField = RfidField()
+
+
+def press(pin, duration=0.1):
+    """Returns an action that presses the button on the pin for the given seconds"""
+    def action():
+        GPIO.setInput(pin, 1 - GPIO.idleLevel(pin))
+        return (duration, lambda: GPIO.setInput(pin, GPIO.idleLevel(pin)))
+    return action
+
+
+def turn(pinClk, pinDt, steps=1):
+    """Returns an action that turns the rotary encoder by the given number of steps (negative: counterclockwise)"""
+    # both pins are high at rest, the pin changing last gives the direction
+    sequence = [(pinDt, 0), (pinClk, 0), (pinDt, 1), (pinClk, 1)] if steps > 0 else \
+        [(pinClk, 0), (pinDt, 0), (pinClk, 1), (pinDt, 1)]
+
+    def action():
+        for _ in range(abs(steps)):
+            for (pin, level) in sequence:
+                GPIO.setInput(pin, level)
+    return action
+
+
+def tap(card, duration=None):
+    """Returns an action that places the card in the field of the reader (and removes it after the given seconds)"""
+    def action():
+        rfidField.tap(card)
+        if duration != None:
+            return (duration, rfidField.remove)
+    return action
+
+
+def remove():
+    """Returns an action that removes the card from the field of the reader"""
+    return rfidField.remove
+
+
+class Scenario(object):
+    """
+    A reproducible sequence of simulated inputs, played in its own thread.
+    Steps are tuples of (seconds since start, name, action). Actions can return a tuple of (seconds, action) to schedule a follow-up (like a release)
+    """
+
+    def __init__(self, steps=()):
+        self._steps = sorted(steps, key=lambda step: step[0])
+        self.__stopThread = Event()
+        self.__thread = None
+
+    @classmethod
+    def generate(cls, duration, rates, seed=0):
+        """Creates a scenario with random, but reproducible steps. rates maps names to tuples of (steps per second, action)"""
+        rand = random.Random(seed)
+        steps = []
+        for name in sorted(rates):
+            (rate, action) = rates[name]
+            if rate <= 0:
+                continue
+            time = rand.expovariate(rate)
+            while time < duration:
+                steps.append((time, name, action))
+                time += rand.expovariate(rate)
+        return cls(steps)
+
+    @property
+    def steps(self):
+        return list(self._steps)
+
+    def run(self, probe=None):
+        """Plays the scenario in the current thread. Injected inputs are reported to the given LatencyProbe"""
+        start = monotonic()
+        order = count()
+        queue = [(offset, next(order), name, action)
+                 for (offset, name, action) in self._steps]
+        heapq.heapify(queue)
+        while len(queue) > 0:
+            (offset, _, name, action) = heapq.heappop(queue)
+            if self.__stopThread.wait(max(0, start + offset - monotonic())):
+                break
+            if probe != None and name != None:
+                probe.injected(name)
+            followUp = action()
+            if followUp != None:
+                heapq.heappush(queue, (monotonic() - start + followUp[0],
+                                       next(order), None, followUp[1]))
+
+    def start(self, probe=None):
+        self.__stopThread.clear()
+        self.__thread = Thread(target=self.run, args=(probe,),
+                               name="Scenario.run")
+        self.__thread.start()
+
+    def join(self, timeout=None):
+        if self.__thread != None:
+            self.__thread.join(timeout)
+
+    def stop(self):
+        self.__stopThread.set()
+        self.join()
+
+
+class LatencyProbe(object):
+    """
+    Measures the time between injected inputs and their arrival at the end of the event pipeline.
+    An arrival belongs to the latest injected input of its name, older ones were lost (like debounced button presses)
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = {}
+        self.latencies = {}
+        self.lost = {}
+        self.peakThreads = active_count()
+
+    def injected(self, name):
+        with self._lock:
+            self._pending.setdefault(name, deque()).append(monotonic())
+            self.peakThreads = max(self.peakThreads, active_count())
+
+    def received(self, name):
+        now = monotonic()
+        with self._lock:
+            pending = self._pending.get(name)
+            if pending:
+                self.latencies.setdefault(name, []).append(now - pending.pop())
+                self.lost[name] = self.lost.get(name, 0) + len(pending)
+                pending.clear()
+            self.peakThreads = max(self.peakThreads, active_count())
+
+    def report(self):
+        """Returns the latency statistics per input as lines of text"""
+        lines = []
+        with self._lock:
+            for name in sorted(set(self._pending) | set(self.latencies)):
+                latencies = sorted(self.latencies.get(name, []))
+                lost = self.lost.get(name, 0) + len(self._pending.get(name, ()))
+                if len(latencies) == 0:
+                    lines.append("%-8s no events received, %d lost" % (name, lost))
+                    continue
+                lines.append("%-8s %5d events  p50 %7.1f ms  p95 %7.1f ms  max %7.1f ms  %d lost" % (
+                    name, len(latencies), latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * 0.95)] * 1000, latencies[-1] * 1000, lost))
+            lines.append("peak threads: %d" % self.peakThreads)
+        return lines
+
+
+def _loopbackClient(uri, callback, connected):
+    """Connects to the websocket and passes every received frame to the callback until the server closes the connection"""
+    import asyncio
+    import websockets
+
+    async def receive():
+        async with websockets.connect(uri) as websocket:
+            connected.set()
+            try:
+                while True:
+                    callback(await websocket.recv())
+            except websockets.ConnectionClosed:
+                pass
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(receive())
+    except Exception as error:
+        logging.error("Loopback client failed: %s", str(error))
+    finally:
+        connected.set()  # never leave main waiting
+        loop.close()
+
+
+def main():
+    """Runs the input pipeline (GPIO buttons, rotary encoder and RFID reader) with a generated load and reports the latencies.
+    Like in UserControl the callbacks send a message via SingleClientWebsocket, the latency is measured up to its arrival at a loopback client.
+    A blinking status LED runs along like in UserControl"""
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the input pipeline with simulated hardware")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="Seconds of generated input [default: 30]")
+    parser.add_argument("--presses", type=float, default=1.0,
+                        help="Button presses per second [default: 1]")
+    parser.add_argument("--turns", type=float, default=4.0,
+                        help="Rotary encoder steps per second [default: 4]")
+    parser.add_argument("--taps", type=float, default=0.2,
+                        help="Card taps per second [default: 0.2]")
+    parser.add_argument("--hold", type=float, default=2.0,
+                        help="Seconds a tapped card stays on the reader [default: 2]")
+    parser.add_argument("--drain", type=float, default=1.0,
+                        help="Seconds to wait for the last inputs after the generated ones [default: 1]")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the generated input [default: 0]")
+    parser.add_argument("--port", type=int, default=8766,
+                        help="Port of the loopback websocket [default: 8766]")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # the pipeline modules have to use this simulation, not the one loaded as __main__
+    os.environ["AUDIBLEPLAYER_HARDWARE"] = "simulated"
+    import SimulatedHardware as hardware
+    from GpioInput import GpioInputButton, GpioInputRotaryEncoder, gpioInputStop
+    from GpioOutput import GpioOutputLed, gpioOutputStop
+    from RfidReader import RfidReader
+    from SharedEventLoop import threadStatistics
+    from SingleClientWebsocket import SingleClientWebsocket
+    (pinButton, pinClk, pinDt, pinLed) = (11, 16, 18, 22)
+
+    probe = LatencyProbe()
+    websocket = SingleClientWebsocket("127.0.0.1", args.port, lambda msg: None)
+    websocket.start()
+    connected = Event()
+    client = Thread(target=_loopbackClient, args=("ws://127.0.0.1:%d" % args.port, probe.received, connected),
+                    name="LoopbackClient", daemon=True)
+    client.start()
+    deadline = monotonic() + 5.0
+    connected.wait(5.0)
+    while not websocket.connected and client.is_alive() and monotonic() < deadline:
+        sleep(0.01)  # the server registers the client a little later
+    if not websocket.connected:
+        logging.error("Loopback client could not connect to port %d", args.port)
+        websocket.stop()
+        return
+    button = GpioInputButton(pinButton, lambda pin: websocket.send("press"))
+    rotary = GpioInputRotaryEncoder(
+        pinClk, pinDt, lambda direction: websocket.send("turn"))
+    reader = RfidReader(lambda card: websocket.send(
+        "tap") if card != None else None)
+    led = GpioOutputLed(pinLed)
+    led.setPattern([0.75, 1.5])
+    (_, voluntary, involuntary) = threadStatistics()
+    card = hardware.SimulatedCard([0x01, 0x02, 0x03, 0x04],
+                                  "https://www.audible.de/pd/Some-Book-Hoerbuch/B0123456789")
+    scenario = Scenario.generate(args.duration, {
+        "press": (args.presses, hardware.press(pinButton)),
+        "turn": (args.turns, hardware.turn(pinClk, pinDt)),
+        "tap": (args.taps, hardware.tap(card, args.hold))}, args.seed)
+    try:
+        scenario.run(probe)
+        sleep(args.drain)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        (threads, voluntaryEnd, involuntaryEnd) = threadStatistics()
+        led.stopPattern()
+        reader.stop()
+        gpioInputStop()
+        gpioOutputStop()
+        websocket.stop()
+        client.join()
+    for line in probe.report():
+        print(line)
+    print("threads at the end: %d, context switches: %d voluntary, %d involuntary" %
+          (threads, voluntaryEnd - voluntary, involuntaryEnd - involuntary))
+
+
+if __name__ == "__main__":
+    main()
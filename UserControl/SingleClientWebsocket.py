@@ -1,28 +1,49 @@
 import asyncio
 import logging
-from threading import Thread, currentThread
+from collections import deque
+from concurrent.futures import Future
+from queue import Full
+from threading import Lock
 
 import websockets
+from SharedEventLoop import (acquireEventLoop, isEventLoopThread,
+                             releaseEventLoop)
 
-__version_info__ = (1, 0, 0)
+__version_info__ = (1, 1, 0)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Sebastian Hofmann (Kaemmelot)"
 __all__ = ['SingleClientWebsocket']
 
 
 class SingleClientWebsocket:
-    def __init__(self, ip, port, msgCallback, connCallback=None):
+    """
+    Websocket server for a single client. Outgoing messages are queued and sent by the event loop, so senders never wait for the client.
+    A burst of messages needs only one wakeup of the loop. Queued messages with the same coalesce key are replaced by the newest one.
+    If more than maxQueued messages are waiting (the client is too slow), new ones are rejected.
+    If batchEncoder is set (function from list of messages to one frame), batchable messages that are waiting together are sent in one frame
+    """
+
+    def __init__(self, ip, port, msgCallback, connCallback=None, maxQueued=64):
         self.__terminated = False
         self._clientWs = None
         self._server = None
-        self._loopThread = None
-        self._eventLoop = asyncio.new_event_loop()
-        self._startServer = websockets.serve(
-            self._socketHandler, ip, port, loop=self._eventLoop)
+        self._eventLoop = None
+        self._ip = ip
+        self._port = port
         self._msgCallback = msgCallback
         self._connCallback = connCallback
-        self._loopThread = Thread(
-            target=self._eventLoop.run_forever, name="SingleClientWebsocket._eventLoop")
+        self._maxQueued = maxQueued
+        self._queueLock = Lock()
+        self._queue = deque()  # entries are lists of [message, futures, batchable]
+        self._coalesced = {}  # coalesce key -> queued entry
+        self.__flushing = False
+        self.batchEncoder = None
+        # statistics
+        self.sent = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.wakeups = 0
+        self.frames = 0
 
     async def _socketHandler(self, websocket, path):
         if self._clientWs != None:
@@ -60,50 +81,131 @@ class SingleClientWebsocket:
                 if self._connCallback != None:
                     self._connCallback(False)
 
+    async def __startServer(self):
+        return await websockets.serve(self._socketHandler, self._ip, self._port, loop=self._eventLoop)
+
+    async def __stopServer(self):
+        # wait for queued messages (like shutdown) before closing
+        for _ in range(100):
+            if not self.__flushing:
+                break
+            await asyncio.sleep(0.01)
+        try:
+            if self._clientWs != None:
+                await self._clientWs.close()  # close open socket
+        except asyncio.CancelledError:
+            pass
+        self._server.close()  # close server
+        await self._server.wait_closed()
+
     def start(self):
-        if not self.__terminated and not self._eventLoop.is_running():
-            self._server = self._eventLoop.run_until_complete(
-                self._startServer)
-            self._loopThread.start()
+        if not self.__terminated and self._server == None:
+            self._eventLoop = acquireEventLoop()
+            self._server = asyncio.run_coroutine_threadsafe(
+                self.__startServer(), self._eventLoop).result()
 
     def stop(self):
         if not self.__terminated and self._server != None:
             logging.debug("Stopping SingleClientWebsocket")
             self.__terminated = True
-            try:
-                if self._clientWs != None:
-                    asyncio.run_coroutine_threadsafe(
-                        self._clientWs.close(), self._eventLoop).result()  # close open socket
-            except asyncio.CancelledError:
-                pass
-            self._server.close()  # close server
-            self._server.wait_closed()
+            asyncio.run_coroutine_threadsafe(
+                self.__stopServer(), self._eventLoop).result()
             self._server = None
-            self._eventLoop.call_soon_threadsafe(self._eventLoop.stop)
-            self._loopThread.join()  # wait until loop stopped
-            # needed for next run_until_complete call
-            asyncio.set_event_loop(self._eventLoop)
+            releaseEventLoop()  # the last user finishes all pending tasks
+            logging.debug("Websocket sent %d messages in %d frames with %d wakeups, %d coalesced, %d rejected",
+                          self.sent, self.frames, self.wakeups, self.coalesced, self.rejected)
+
+    def send(self, msg, wait=False, coalesceKey=None, batchable=False):
+        """
+        Queues the message for the client. Returns False if there is no client or the queue is full.
+        With wait the result tells if the message was actually sent (waiting is not possible in the event loop thread)
+        """
+        future = self.sendAsync(msg, coalesceKey, batchable)
+        if future.done() or (wait and not isEventLoopThread()):
             try:
-                self._eventLoop.run_until_complete(asyncio.gather(
-                    *asyncio.Task.all_tasks(self._eventLoop)))  # finish all pending tasks
-            except asyncio.CancelledError:
-                pass
-            self._eventLoop.close()  # now we can safely close the loop
+                return future.result()
+            except ConnectionError:
+                logging.debug("Could not send message via websocket:\n%s", msg)
+            except Exception as error:
+                logging.error(
+                    "Exception prevented message to be send via websocket:\n%s", str(error))
+            return False
+        return True
 
-    def send(self, msg):
-        try:
-            if self._clientWs != None:
-                res = asyncio.run_coroutine_threadsafe(
-                    self._clientWs.send(msg), self._eventLoop)  # send
-                if self._loopThread != currentThread():
-                    res.result()  # and wait until complete (only if other thread)
-                #logging.debug("Sending message via websocket:\n%s", msg)
-                return True
-            logging.debug("Could not send message via websocket:\n%s", msg)
-        except Exception as error:
-            logging.error(
-                "Exception prevented message to be send via websocket:\n%s", str(error))
-        return False
+    def sendAsync(self, msg, coalesceKey=None, batchable=False):
+        """Queues the message for the client. Returns a concurrent.futures.Future with True once it was sent"""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._queueLock:
+            entry = self._coalesced.get(coalesceKey) if coalesceKey != None else None
+            if self._clientWs == None or self._eventLoop == None:
+                future.set_exception(ConnectionError("No websocket client connected"))
+                return future
+            if entry != None:
+                entry[0] = msg  # replace the queued message, but keep its position
+                entry[2] = batchable
+                entry[1].append(future)
+                self.coalesced += 1
+                return future
+            if len(self._queue) >= self._maxQueued:
+                self.rejected += 1
+                future.set_exception(Full("Websocket send queue is full"))
+                return future
+            entry = [msg, [future], batchable]
+            self._queue.append(entry)
+            if coalesceKey != None:
+                self._coalesced[coalesceKey] = entry
+            wakeup = not self.__flushing
+            self.__flushing = True
+        if wakeup:
+            self.wakeups += 1
+            asyncio.run_coroutine_threadsafe(self.__flush(), self._eventLoop)
+        return future
+
+    async def __flush(self):
+        """Sends all queued messages (including those queued while sending)"""
+        while True:
+            with self._queueLock:
+                if len(self._queue) == 0:
+                    self.__flushing = False
+                    return
+                entries = list(self._queue)
+                self._queue.clear()
+                self._coalesced.clear()
+            for (frame, futures, messages) in self.__frames(entries):
+                try:
+                    if self._clientWs == None:
+                        raise ConnectionError("No websocket client connected")
+                    await self._clientWs.send(frame)
+                    self.sent += messages
+                    self.frames += 1
+                    for future in futures:
+                        future.set_result(True)
+                except Exception as error:
+                    for future in futures:
+                        future.set_exception(error)
+                    if not isinstance(error, ConnectionError):
+                        logging.error(
+                            "Exception prevented message to be send via websocket:\n%s", str(error))
+
+    def __frames(self, entries):
+        """Returns list of (frame, futures, number of messages), consecutive batchable messages are joined by the batchEncoder"""
+        batchEncoder = self.batchEncoder
+        frames = []
+        batch = []
+        for entry in entries + [None]:
+            if batchEncoder != None and entry != None and entry[2]:
+                batch.append(entry)
+                continue
+            if len(batch) > 1:
+                frames.append((batchEncoder([msg for (msg, _, _) in batch]),
+                               [future for (_, futures, _) in batch for future in futures], len(batch)))
+            elif len(batch) == 1:
+                frames.append((batch[0][0], batch[0][1], 1))
+            batch = []
+            if entry != None:
+                frames.append((entry[0], entry[1], 1))
+        return frames
 
     @property
     def connected(self):
@@ -0,0 +1,166 @@
+import logging
+import sys
+import wave
+from array import array
+from collections import Counter, namedtuple
+from os import listdir, path
+
+try:
+    import audioop
+except ImportError:
+    audioop = None  # removed in Python 3.13, the conversion falls back to pure Python
+
+__version_info__ = (1, 1, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['Sound', 'SoundBank']
+
+
+# PCM samples with their format
+Sound = namedtuple("Sound", ["channels", "rate", "sampleWidth", "data"])
+
+
+class SoundBank(object):
+    """
+    Prompts decoded and converted to a single PCM format (channels, rate, sample width) once,
+    so playing one needs no disk access and the device never has to be reconfigured.
+    Without a given format the most common one of the first loaded directory is used
+    """
+
+    def __init__(self, format=None):
+        self.format = format
+        self._sounds = {}  # filename -> Sound
+        self.bytes = 0
+
+    def load(self, directory):
+        """Decodes and converts all WAV files of the directory"""
+        sounds = {}
+        for name in sorted(listdir(directory)):
+            if name.endswith(".wav"):
+                filename = path.join(directory, name)
+                try:
+                    sounds[filename] = self.decode(filename)
+                except Exception as error:
+                    logging.error("Could not load sound %s\nReason: %s",
+                                  filename, str(error))
+        if self.format == None and len(sounds) > 0:
+            self.format = Counter(sound[:3] for sound in sounds.values()).most_common(1)[0][0]
+        for filename, sound in sounds.items():
+            self.__store(filename, self.convert(sound))
+        logging.debug("Loaded %d sounds of %s, sound bank has %d sounds with %d kB in format %s",
+                      len(sounds), directory, len(self._sounds), self.bytes // 1024, str(self.format))
+
+    def get(self, filename):
+        """Returns the converted Sound of the file, loading it if necessary"""
+        sound = self._sounds.get(filename)
+        if sound == None:
+            sound = self.convert(self.decode(filename))
+            self.__store(filename, sound)
+        return sound
+
+    def __store(self, filename, sound):
+        previous = self._sounds.get(filename)
+        if previous != None:
+            self.bytes -= len(previous.data)
+        self._sounds[filename] = sound
+        self.bytes += len(sound.data)
+
+    @staticmethod
+    def decode(filename):
+        """Returns the Sound of a WAV file in its own format"""
+        wav = wave.open(filename, "rb")
+        try:
+            return Sound(wav.getnchannels(), wav.getframerate(), wav.getsampwidth(), wav.readframes(wav.getnframes()))
+        finally:
+            wav.close()
+
+    def convert(self, sound):
+        """Returns the Sound in the format of the bank (the first sound sets it if there is none yet)"""
+        if self.format == None:
+            self.format = sound[:3]
+        (channels, rate, sampleWidth) = self.format
+        if sound[:3] == self.format:
+            return sound
+        if audioop == None:
+            return Sound(channels, rate, sampleWidth, _convertSamples(sound, channels, rate, sampleWidth))
+        data = sound.data
+        if sound.sampleWidth != sampleWidth:
+            if sound.sampleWidth == 1:
+                data = audioop.bias(data, 1, -128)  # 8 bit WAV is unsigned
+            data = audioop.lin2lin(data, sound.sampleWidth, sampleWidth)
+        elif sampleWidth == 1:
+            data = audioop.bias(data, 1, -128)  # audioop works with signed samples
+        if sound.channels != channels:
+            if sound.channels == 2 and channels == 1:
+                data = audioop.tomono(data, sampleWidth, 0.5, 0.5)
+            elif sound.channels == 1 and channels == 2:
+                data = audioop.tostereo(data, sampleWidth, 1, 1)
+            else:
+                raise wave.Error("Cannot convert %d to %d channels" %
+                                 (sound.channels, channels))
+        if sound.rate != rate:
+            (data, _) = audioop.ratecv(data, sampleWidth,
+                                       channels, sound.rate, rate, None)
+        if sampleWidth == 1:
+            data = audioop.bias(data, 1, 128)
+        return Sound(channels, rate, sampleWidth, data)
+
+
+def _samples(data, sampleWidth):
+    """Returns the little endian PCM samples as array of signed 32 bit values"""
+    if sampleWidth == 3:
+        samples = array("i", bytes(byte for i in range(0, len(data) - 2, 3) for byte in (0, data[i], data[i + 1], data[i + 2])))
+    else:
+        samples = array({1: "B", 2: "h", 4: "i"}[sampleWidth], data[:len(data) - len(data) % sampleWidth])
+    if sys.byteorder == "big" and sampleWidth > 1:
+        samples.byteswap()
+    if sampleWidth == 1:
+        return array("i", ((sample - 128) << 24 for sample in samples))  # 8 bit WAV is unsigned
+    if sampleWidth == 2:
+        return array("i", (sample << 16 for sample in samples))
+    return samples if samples.typecode == "i" else array("i", samples)
+
+
+def _data(samples, sampleWidth):
+    """Returns the signed 32 bit samples as little endian PCM data with the sample width"""
+    if sampleWidth == 1:
+        return array("B", ((sample >> 24) + 128 for sample in samples)).tobytes()
+    if sampleWidth == 2:
+        samples = array("h", (sample >> 16 for sample in samples))
+    elif sampleWidth == 3:
+        samples = array("i", (sample & ~0xFF for sample in samples))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    data = samples.tobytes()
+    if sampleWidth == 3:
+        data = bytes(byte for i in range(0, len(data), 4) for byte in data[i + 1:i + 4])
+    return data
+
+
+def _convertSamples(sound, channels, rate, sampleWidth):
+    """Converts the Sound without audioop, the rate by linear interpolation. Returns the PCM data"""
+    samples = _samples(sound.data, sound.sampleWidth)
+    if sound.channels != channels:
+        if sound.channels == 2 and channels == 1:
+            samples = array("i", ((samples[i] >> 1) + (samples[i + 1] >> 1)
+                                  for i in range(0, len(samples) - 1, 2)))
+        elif sound.channels == 1 and channels == 2:
+            samples = array("i", (sample for sample in samples for _ in (0, 1)))
+        else:
+            raise wave.Error("Cannot convert %d to %d channels" %
+                             (sound.channels, channels))
+    if sound.rate != rate:
+        frames = len(samples) // channels
+        count = frames * rate // sound.rate
+        converted = array("i", bytes(4 * count * channels))
+        for frame in range(count):
+            position = frame * sound.rate / rate
+            index = int(position)
+            weight = position - index
+            following = min(index + 1, frames - 1)
+            for channel in range(channels):
+                first = samples[index * channels + channel]
+                converted[frame * channels + channel] = int(
+                    first + (samples[following * channels + channel] - first) * weight)
+        samples = converted
+    return _data(samples, sampleWidth)
@@ -1,38 +1,61 @@
+import heapq
 import logging
 import sys
-from os import WIFEXITED, getpgid, killpg, setsid, system
+from concurrent.futures import CancelledError, TimeoutError
+from io import BytesIO
+from itertools import count
+from os import WIFEXITED, getpgid, killpg, path, setsid, system
 from signal import SIGTERM
-from subprocess import DEVNULL, Popen
-from threading import Lock
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
 
-__version_info__ = (1, 0, 0)
+from SoundBank import SoundBank
+from TextToSpeech import TextToSpeech
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None  # only aplay is available
+
+__version_info__ = (1, 4, 0)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Sebastian Hofmann (Kaemmelot)"
-__all__ = ['AbstractSoundSynthesizer', 'DefaultSoundSynthesizer']
+__all__ = ['AbstractSoundSynthesizer', 'DefaultSoundSynthesizer',
+           'AlsaSoundSynthesizer', 'createSoundSynthesizer',
+           'lowPriority', 'normalPriority', 'highPriority', 'promptPriorities']
 
 
 class AbstractSoundSynthesizer:
     soundLock = Lock()
     soundPopen = None
 
-    def playSound(self, filename, timeOffset=0.5, synchronous=False):
+    def playSound(self, filename, timeOffset=0.5, synchronous=False, priority=None):
         raise NotImplementedError()
 
-    def playTextOnce(self, text, language, timeOffset=0.5, synchronous=False):
+    def playTextOnce(self, text, language, timeOffset=0.5, synchronous=False, priority=None):
         raise NotImplementedError()
 
     def stopPlayback(self):
         raise NotImplementedError()
 
+    def close(self):
+        pass
+
 
 class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
+    _aplayFormats = {1: "U8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE"}
+
+    def __init__(self, tts=None):
+        self._tts = tts if tts != None else TextToSpeech()
+
     def __updateSoundHandle(self):
         if AbstractSoundSynthesizer.soundPopen != None:
             AbstractSoundSynthesizer.soundPopen.poll()
             if AbstractSoundSynthesizer.soundPopen.returncode != None:
                 AbstractSoundSynthesizer.soundPopen = None  # process finished
 
-    def __executeCmdIfPossible(self, cmd, timeOffset, synchronous):
+    def __executeCmdIfPossible(self, cmd, timeOffset, synchronous, stdin=DEVNULL):
         self.__updateSoundHandle()
         if AbstractSoundSynthesizer.soundPopen != None:
             logging.debug("Sound blocked")
@@ -42,14 +65,21 @@ class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
             cmd = "sleep %fs; %s" % (timeOffset, cmd)
 
         AbstractSoundSynthesizer.soundPopen = Popen(cmd,
-                                                    stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                                                    stdin=stdin, stdout=DEVNULL, stderr=DEVNULL,
                                                     close_fds=True, shell=True, preexec_fn=setsid)  # start_new_session=True,
         if synchronous:
             AbstractSoundSynthesizer.soundPopen.wait()
             AbstractSoundSynthesizer.soundPopen = None
         return True
 
-    def playSound(self, filename, timeOffset=0.5, synchronous=False):
+    def playSound(self, filename, timeOffset=0.5, synchronous=False, priority=None):
+        # aplay can only play one sound at a time and doesn't preempt, so the priority is ignored
+        res = self.__playFile(filename, timeOffset, synchronous)
+        if res:
+            logging.debug("Playing sound %s", filename)
+        return res
+
+    def __playFile(self, filename, timeOffset, synchronous):
         lockAvail = False
         try:
             lockAvail = AbstractSoundSynthesizer.soundLock.acquire(False)
@@ -59,11 +89,8 @@ class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
             return False
 
         try:
-            res = self.__executeCmdIfPossible(
+            return self.__executeCmdIfPossible(
                 "aplay %s" % filename, timeOffset, synchronous)
-            if res:
-                logging.debug("Playing sound %s", filename)
-            return res
         except Exception as error:
             logging.error("Could not play file %s\nReason: %s",
                           filename, str(error))
@@ -71,7 +98,7 @@ class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
             AbstractSoundSynthesizer.soundLock.release()
         return False
 
-    def playTextOnce(self, text, language, timeOffset=0.5, synchronous=False):
+    def playTextOnce(self, text, language, timeOffset=0.5, synchronous=False, priority=None):
         lockAvail = False
         try:
             lockAvail = AbstractSoundSynthesizer.soundLock.acquire(False)
@@ -81,11 +108,20 @@ class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
             return False
 
         try:
-            res = self.__executeCmdIfPossible(
-                "pico2wave -l %s -w /tmp/AudiblePlayer-tmp.wav \"%s\"; aplay /tmp/AudiblePlayer-tmp.wav > /dev/null 2> /dev/null; rm /tmp/AudiblePlayer-tmp.wav" %
-                (language, text), timeOffset, synchronous)
+            # one aplay reads the samples of all chunks from a pipe, the next chunks are synthesized while it plays
+            (channels, rate, sampleWidth) = TextToSpeech.format
+            res = self.__executeCmdIfPossible("exec aplay -q -t raw -f %s -r %d -c %d" % (
+                self._aplayFormats[sampleWidth], rate, channels), timeOffset, False, PIPE)
             if res:
                 logging.debug("Reading text: %s", text)
+                feeder = Thread(target=self.__feed, args=(AbstractSoundSynthesizer.soundPopen,
+                                                          self._tts.synthesizeChunks(text, language)),
+                                name="DefaultSoundSynthesizer.feeder", daemon=True)
+                feeder.start()
+                if synchronous:
+                    feeder.join()
+                    AbstractSoundSynthesizer.soundPopen.wait()
+                    AbstractSoundSynthesizer.soundPopen = None
             return res
         except Exception as error:
             logging.error("Could not play text\nReason: %s", str(error))
@@ -94,6 +130,37 @@ class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
             AbstractSoundSynthesizer.soundLock.release()
         return False
 
+    def __feed(self, popen, futures):
+        soundBank = SoundBank(TextToSpeech.format)
+        try:
+            for future in futures:
+                while True:
+                    try:
+                        filename = future.result(0.1)
+                        break
+                    except TimeoutError:
+                        if popen.poll() != None:
+                            return  # stopped
+                if popen.poll() != None:
+                    return
+                popen.stdin.write(soundBank.convert(SoundBank.decode(
+                    BytesIO(self._tts.read(filename)))).data)
+                popen.stdin.flush()
+        except (BrokenPipeError, CancelledError):
+            pass  # stopped
+        except Exception as error:
+            logging.error("Could not read text\nReason: %s", str(error))
+        finally:
+            for future in futures:
+                future.cancel()  # only those that didn't start yet
+            try:
+                popen.stdin.close()  # aplay ends after the last samples
+            except BrokenPipeError:
+                pass
+
+    def close(self):
+        self._tts.close()
+
     def stopPlayback(self):
         locked = AbstractSoundSynthesizer.soundLock.acquire(timeout=0.5)
         try:
@@ -105,3 +172,254 @@ class DefaultSoundSynthesizer(AbstractSoundSynthesizer):
         finally:
             if locked:
                 AbstractSoundSynthesizer.soundLock.release()
+
+
+# priorities of the prompts (by file name without extension), a prompt preempts those with a lower priority
+lowPriority = 0
+normalPriority = 1
+highPriority = 2
+promptPriorities = {
+    "readyRepeat": lowPriority,
+    "error": highPriority,
+    "network": highPriority,
+    "invalidCard": highPriority,
+    "shutdown": highPriority + 1
+}
+
+
+class _SoundRequest(object):
+    __slots__ = ["name", "sound", "text", "language", "priority", "due", "done"]
+
+    def __init__(self, name, sound, text, language, priority, timeOffset):
+        self.name = name
+        self.sound = sound
+        self.text = text
+        self.language = language
+        self.priority = priority
+        self.due = monotonic() + timeOffset
+        self.done = Event()
+
+
+class AlsaSoundSynthesizer(AbstractSoundSynthesizer):
+    """
+    Plays sounds in-process on a PCM device that stays open, so a cue doesn't need to start sh, sleep and aplay.
+    The prompts come from a SoundBank in the format of the device. A single player thread waits for the time offset
+    and writes the samples in periods, so a sound can be stopped after the buffered periods.
+    A sound with a higher priority preempts the current one, others wait in a queue (ordered by priority).
+    If more than maxQueued sounds are waiting, the one with the lowest priority is dropped. Needs pyalsaaudio
+    """
+    periodFrames = 512
+    _formats = {1: "PCM_FORMAT_U8", 2: "PCM_FORMAT_S16_LE",
+                3: "PCM_FORMAT_S24_3LE", 4: "PCM_FORMAT_S32_LE"}
+
+    def __init__(self, device="default", preloadDirs=(), maxQueued=4, tts=None):
+        if alsaaudio == None:
+            raise ImportError("pyalsaaudio is not installed")
+        self._pcm = alsaaudio.PCM(
+            alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL, device=device)
+        self._pcm.setperiodsize(self.periodFrames)
+        self._pcmFormat = None
+        self.soundBank = SoundBank()
+        self._maxQueued = maxQueued
+        self._condition = Condition(Lock())
+        self._queue = []  # heap of (-priority, order, request)
+        self._order = count()
+        self._current = None
+        self._stop = False
+        self._terminated = False
+        self._tts = tts if tts != None else TextToSpeech()
+        # statistics
+        self.played = 0
+        self.preempted = 0
+        self.dropped = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        for directory in preloadDirs:
+            self.soundBank.load(directory)
+        self.__thread = Thread(target=self._run,
+                               name="AlsaSoundSynthesizer.player", daemon=True)
+        self.__thread.start()
+
+    def __start(self, request, synchronous):
+        with self._condition:
+            if self._terminated:
+                return False
+            current = self._current
+            if current != None and not self._stop and request.priority > current.priority:
+                logging.debug("Sound %s preempted by %s",
+                              current.name, request.name)
+                self.__stopCurrent()
+                self.preempted += 1
+            elif len(self._queue) >= self._maxQueued:
+                # drop the sound with the lowest priority (the newest of them)
+                lowest = max(self._queue)
+                if lowest[0] <= -request.priority:
+                    logging.debug("Sound %s dropped", request.name)
+                    self.dropped += 1
+                    return False
+                self._queue.remove(lowest)
+                heapq.heapify(self._queue)
+                lowest[2].done.set()
+                logging.debug("Sound %s dropped for %s",
+                              lowest[2].name, request.name)
+                self.dropped += 1
+            heapq.heappush(self._queue, (-request.priority,
+                                         next(self._order), request))
+            self._condition.notify_all()
+        if synchronous:
+            request.done.wait()
+        return True
+
+    def playSound(self, filename, timeOffset=0.5, synchronous=False, priority=None):
+        try:
+            sound = self.soundBank.get(filename)
+        except Exception as error:
+            logging.error("Could not play file %s\nReason: %s",
+                          filename, str(error))
+            return False
+        if priority == None:
+            priority = promptPriorities.get(path.splitext(
+                path.basename(filename))[0], normalPriority)
+        res = self.__start(_SoundRequest(
+            filename, sound, None, None, priority, timeOffset), synchronous)
+        if res:
+            logging.debug("Playing sound %s", filename)
+        return res
+
+    def playTextOnce(self, text, language, timeOffset=0.5, synchronous=False, priority=None):
+        res = self.__start(_SoundRequest("text", None, text, language,
+                                         priority if priority != None else normalPriority, timeOffset), synchronous)
+        if res:
+            logging.debug("Reading text: %s", text)
+        return res
+
+    def __stopCurrent(self):
+        """Stops the sound that is playing now. Needs the lock"""
+        self._stop = True
+        self._condition.notify_all()
+
+    def stopPlayback(self):
+        with self._condition:
+            for (_, _, request) in self._queue:
+                request.done.set()
+            del self._queue[:]
+            if self._current == None:
+                return
+            self.__stopCurrent()
+            # a new sound can be played right after this
+            if self._condition.wait_for(lambda: self._current == None, 0.5):
+                logging.debug("Terminated current voice")
+
+    def close(self):
+        self.stopPlayback()
+        with self._condition:
+            self._terminated = True
+            self._condition.notify_all()
+        self.__thread.join()
+        self._pcm.close()
+        self._tts.close()
+        for line in self.statisticLines():
+            logging.debug(line)
+
+    def statisticLines(self):
+        """Returns the playback statistics as lines of text"""
+        with self._condition:
+            return ["Sounds: %d played, %d preempted, %d dropped, start latency mean %.1f ms max %.1f ms" % (
+                self.played, self.preempted, self.dropped,
+                self.totalLatency / self.played * 1000 if self.played > 0 else 0, self.maxLatency * 1000)]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._terminated:
+                    self._condition.wait()
+                if self._terminated:
+                    return
+                request = heapq.heappop(self._queue)[2]
+                self._current = request
+                self._stop = False
+                delay = request.due - monotonic()
+                if delay > 0:  # can be cut short by preemption or stopPlayback
+                    self._condition.wait_for(lambda: self._stop, delay)
+            try:
+                if request.text != None:
+                    self.__stream(request)
+                elif not self._stop:
+                    self.__started(request)
+                    self.__write(request.sound)
+            except Exception as error:
+                logging.error("Could not play sound\nReason: %s", str(error))
+            finally:
+                with self._condition:
+                    self._current = None
+                    self._condition.notify_all()
+                request.done.set()
+
+    def __stream(self, request):
+        """Plays the chunks of the text while the next ones are synthesized"""
+        futures = self._tts.synthesizeChunks(request.text, request.language)
+        try:
+            for future in futures:
+                if not future.done():
+                    future.add_done_callback(self.__synthesized)
+                    with self._condition:
+                        # stopping doesn't abort the running synthesis, the chunk is cached for the next time
+                        self._condition.wait_for(
+                            lambda: self._stop or future.done())
+                if self._stop:
+                    return
+                try:
+                    filename = future.result()
+                except Exception:
+                    return  # logged by TextToSpeech
+                sound = self.soundBank.convert(SoundBank.decode(
+                    BytesIO(self._tts.read(filename))))
+                if future is futures[0]:
+                    self.__started(request)
+                self.__write(sound)
+        finally:
+            for future in futures:
+                future.cancel()  # only those that didn't start yet
+
+    def __synthesized(self, future):
+        with self._condition:
+            self._condition.notify_all()
+
+    def __started(self, request):
+        latency = max(0.0, monotonic() - request.due)
+        with self._condition:
+            self.played += 1
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+        logging.debug("Sound %s starts %.1f ms after it was due",
+                      request.name, latency * 1000)
+
+    def __write(self, sound):
+        if sound[:3] != self._pcmFormat:  # only once, all sounds are in the format of the sound bank
+            self._pcm.setchannels(sound.channels)
+            self._pcm.setrate(sound.rate)
+            self._pcm.setformat(
+                getattr(alsaaudio, self._formats[sound.sampleWidth]))
+            self._pcmFormat = sound[:3]
+        periodBytes = self.periodFrames * sound.channels * sound.sampleWidth
+        for start in range(0, len(sound.data), periodBytes):
+            if self._stop:
+                return
+            self._pcm.write(sound.data[start:start + periodBytes])
+
+
+def createSoundSynthesizer(backend="auto", device="default", preloadDirs=(), tts=None):
+    """
+    Returns the AlsaSoundSynthesizer for backend auto or alsa if it is available and the device can be opened,
+    otherwise (or for backend aplay) the DefaultSoundSynthesizer. Both read text with the given TextToSpeech
+    (a temporary cache without)
+    """
+    if backend in ("auto", "alsa"):
+        try:
+            return AlsaSoundSynthesizer(device, preloadDirs, tts=tts)
+        except Exception as error:
+            (logging.error if backend == "alsa" else logging.info)(
+                "In-process sound playback not available, using aplay: %s", str(error))
+    elif backend != "aplay":
+        logging.error("Unknown sound backend %s, using aplay", backend)
+    return DefaultSoundSynthesizer(tts)
@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+from concurrent.futures import Future
+from os import close, listdir, makedirs, path, remove, replace, stat, utime
+from queue import Empty, Queue
+from shutil import rmtree
+from subprocess import DEVNULL, Popen
+from tempfile import mkdtemp, mkstemp
+from threading import Lock, Thread
+from time import monotonic
+
+__version_info__ = (1, 1, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['TextToSpeech', 'splitText']
+
+
+def splitText(text, minLength=40, maxLength=200):
+    """
+    Splits the text into chunks of whole sentences for streaming. Sentences shorter than minLength are joined with the previous one,
+    longer than maxLength are split at spaces
+    """
+    chunks = []
+    for sentence in re.split(r"(?<=[.!?;:])\s+|\n+", text):
+        sentence = sentence.strip()
+        while len(sentence) > maxLength:
+            cut = sentence.rfind(" ", 0, maxLength)
+            if cut <= 0:
+                cut = maxLength
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].strip()
+        if len(sentence) == 0:
+            continue
+        if len(chunks) > 0 and len(chunks[-1]) + len(sentence) < minLength:
+            chunks[-1] += " " + sentence
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+class TextToSpeech(object):
+    """
+    Text to speech with pico2wave and a content addressed cache: a WAV file is named by the hash of engine, language and text.
+    The files on disk and their contents in memory are kept in LRU order, bounded by maxDiskBytes and maxMemoryBytes.
+    Missing texts are synthesized by a single worker thread into their own temp files, equal requests share the result.
+    Requests that were cancelled before the worker got to them are skipped.
+    Without a directory a temporary one is used (removed on close). Other files in the directory are never touched
+    """
+    engine = "pico2wave 1"  # part of the hash, change it if the output changes
+    tempPrefix = ".AudiblePlayer-tts-"  # unfinished synthesis
+    cachePattern = re.compile(r"^[0-9a-f]{40}\.wav$")
+    format = (1, 16000, 2)  # channels, rate and sample width of the engine output
+
+    def __init__(self, directory=None, maxDiskBytes=16 * 1024 * 1024, maxMemoryBytes=2 * 1024 * 1024):
+        self._temporary = directory == None
+        self.directory = mkdtemp(
+            prefix="AudiblePlayer-tts-") if self._temporary else directory
+        makedirs(self.directory, exist_ok=True)
+        self._maxDiskBytes = maxDiskBytes
+        self._maxMemoryBytes = maxMemoryBytes
+        self._lock = Lock()
+        self._disk = OrderedDict()  # filename -> size, least recently used first
+        self._diskBytes = 0
+        self._memory = OrderedDict()  # filename -> WAV data, least recently used first
+        self._memoryBytes = 0
+        self._pending = {}  # filename -> Future
+        self._queue = Queue()
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.memoryReads = 0
+        self.diskReads = 0
+        self.synthesized = 0
+        self.synthesisTime = 0.0
+        self.__loadIndex()
+        self.__thread = Thread(target=self._run,
+                               name="TextToSpeech.worker", daemon=True)
+        self.__thread.start()
+
+    def __loadIndex(self):
+        files = []
+        for name in listdir(self.directory):
+            if self.cachePattern.match(name):
+                info = stat(path.join(self.directory, name))
+                files.append((info.st_mtime, name, info.st_size))
+            elif name.startswith(self.tempPrefix) and name.endswith(".wav"):
+                remove(path.join(self.directory, name))
+        for (_, name, size) in sorted(files):
+            self._disk[path.join(self.directory, name)] = size
+            self._diskBytes += size
+        logging.debug("TTS cache has %d files with %d kB",
+                      len(self._disk), self._diskBytes // 1024)
+
+    def filename(self, text, language):
+        """Returns the cache file of the text"""
+        key = hashlib.sha1(("%s\0%s\0%s" % (self.engine, language, text)).encode("utf-8")).hexdigest()
+        return path.join(self.directory, key + ".wav")
+
+    def synthesize(self, text, language):
+        """Returns a concurrent.futures.Future with the cache file of the text. It is already done if the text is cached"""
+        filename = self.filename(text, language)
+        with self._lock:
+            if filename in self._disk:
+                self._disk.move_to_end(filename)
+                self.hits += 1
+                future = Future()
+                future.set_result(filename)
+                return future
+            future = self._pending.get(filename)
+            if future != None and not future.cancelled():
+                return future  # already requested
+            self.misses += 1
+            future = Future()
+            self._pending[filename] = future
+        self._queue.put((filename, text, language))
+        return future
+
+    def synthesizeChunks(self, text, language):
+        """Requests all chunks of the text (see splitText) at once, so the next ones are synthesized while the first is played. Returns the list of Futures"""
+        return [self.synthesize(chunk, language) for chunk in splitText(text)]
+
+    def read(self, filename):
+        """Returns the contents of a cache file (from memory if possible)"""
+        with self._lock:
+            data = self._memory.get(filename)
+            if data != None:
+                self._memory.move_to_end(filename)
+                self.memoryReads += 1
+                return data
+            self.diskReads += 1
+        with open(filename, "rb") as file:
+            data = file.read()
+        utime(filename)  # keeps the LRU order after a restart
+        with self._lock:
+            if filename not in self._memory and len(data) <= self._maxMemoryBytes:
+                self._memory[filename] = data
+                self._memoryBytes += len(data)
+                while self._memoryBytes > self._maxMemoryBytes:
+                    self._memoryBytes -= len(self._memory.popitem(False)[1])
+        return data
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request == None:
+                return
+            (filename, text, language) = request
+            with self._lock:
+                future = self._pending.get(filename)
+                if future == None:
+                    continue  # requested again after a cancel and already done
+                if not future.set_running_or_notify_cancel():
+                    del self._pending[filename]
+                    continue
+            start = monotonic()
+            try:
+                (handle, tempFile) = mkstemp(
+                    prefix=self.tempPrefix, suffix=".wav", dir=self.directory)
+                close(handle)
+                try:
+                    returncode = Popen(["pico2wave", "-l", language, "-w", tempFile, text],
+                                       stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, close_fds=True).wait()
+                    if returncode != 0:
+                        raise RuntimeError("pico2wave failed with code %d" % returncode)
+                    replace(tempFile, filename)
+                finally:
+                    if path.exists(tempFile):
+                        remove(tempFile)
+                self.__added(filename, stat(filename).st_size, monotonic() - start)
+                error = None
+            except Exception as exception:
+                error = exception
+            with self._lock:
+                self._pending.pop(filename, None)
+            if error == None:
+                future.set_result(filename)
+            else:
+                logging.error("Could not synthesize text: %s", str(error))
+                future.set_exception(error)
+
+    def __added(self, filename, size, duration):
+        with self._lock:
+            self.synthesized += 1
+            self.synthesisTime += duration
+            self._disk[filename] = size
+            self._diskBytes += size
+            while self._diskBytes > self._maxDiskBytes and len(self._disk) > 1:
+                (oldest, oldSize) = self._disk.popitem(False)
+                self._diskBytes -= oldSize
+                data = self._memory.pop(oldest, None)
+                if data != None:
+                    self._memoryBytes -= len(data)
+                try:
+                    remove(oldest)
+                except OSError as error:
+                    logging.warning("Could not remove cached speech %s: %s", oldest, str(error))
+        logging.debug("Synthesized speech in %.0f ms", duration * 1000)
+
+    def statisticLines(self):
+        """Returns the cache statistics as lines of text"""
+        with self._lock:
+            return ["TTS cache: %d hits, %d misses (synthesis mean %.0f ms), %d reads from memory, %d from disk, %d files with %d kB" % (
+                self.hits, self.misses, self.synthesisTime / self.synthesized * 1000 if self.synthesized > 0 else 0,
+                self.memoryReads, self.diskReads, len(self._disk), self._diskBytes // 1024)]
+
+    def close(self):
+        """Stops the worker after the running synthesis, the queued ones are cancelled"""
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except Empty:
+                break
+            with self._lock:
+                future = self._pending.pop(request[0], None)
+            if future != None:
+                future.cancel()
+        self._queue.put(None)
+        self.__thread.join()
+        for line in self.statisticLines():
+            logging.debug(line)
+        if self._temporary:
+            rmtree(self.directory, ignore_errors=True)
@@ -6,26 +6,51 @@ __version_info__ = (1, 0, 0)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Sebastian Hofmann (Kaemmelot)"
 __all__ = ['get_threaded_server', 'run_server',
-           'ThreadingHTTPServer', 'RangeHTTPRequestHandler']
+           'ThreadingHTTPServer', 'AsyncHTTPServer', 'RangeHTTPRequestHandler', 'ReadAhead']
 
+import asyncio
 import datetime
 import email.utils
+import gzip
+import json
 import logging
+import mmap
 import os
 import re
+import stat
 import urllib.parse
+import uuid
 from argparse import ArgumentParser
-from errno import EADDRINUSE
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from errno import EADDRINUSE, EINVAL, EISDIR
+from functools import lru_cache
+from itertools import count
 from html import escape
 from http import HTTPStatus
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from io import BytesIO
+from io import BytesIO, UnsupportedOperation
 from posixpath import normpath
 from signal import SIGINT, signal
-from socket import AF_INET6
+from socket import AF_INET, AF_INET6, SO_REUSEADDR, SOL_SOCKET, socket
 from socketserver import ThreadingMixIn
 from sys import getfilesystemencoding
-from threading import Semaphore, Thread
+from threading import Lock, Semaphore, Thread
+from time import monotonic
+
+try:
+    import brotli
+    _COMPRESSORS = OrderedDict((("br", brotli.compress), ("gzip", gzip.compress)))
+except ImportError:
+    _COMPRESSORS = OrderedDict((("gzip", gzip.compress),))
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    _INOTIFY_ENTRY_CHANGED = inotify_flags.MODIFY | inotify_flags.ATTRIB | inotify_flags.CLOSE_WRITE
+    _INOTIFY_WATCH_FLAGS = _INOTIFY_ENTRY_CHANGED | inotify_flags.CREATE | inotify_flags.DELETE | \
+        inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF
+except ImportError:
+    INotify = None  # listings are only checked by the directory modification time
 
 
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
@@ -33,6 +58,500 @@ class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
 
+class CachedFile:
+    """Read-only file object with its own position on a descriptor shared through a FileCache.
+
+    Reads use pread, so any number of connections can use the same descriptor at once.
+    """
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self._entry = entry
+        self._pos = 0
+        self.closed = False
+
+    @property
+    def stat(self):
+        return self._entry.stat
+
+    def fileno(self):
+        return self._entry.fd
+
+    def read(self, size=-1):
+        if size == None or size < 0:
+            size = max(0, self._entry.stat.st_size - self._pos)
+        data = os.pread(self._entry.fd, size, self._pos)
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._entry.stat.st_size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def view(self, offset, count):
+        """Returns a memoryview of count bytes at offset of the memory map shared by all users of the file.
+        """
+        return self._cache._view(self._entry, offset, count)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._cache._release(self._entry)
+
+
+class _FileCacheEntry:
+    def __init__(self, fd, fs, checked):
+        self.fd = fd
+        self.stat = fs
+        self.checked = checked
+        self.refs = 0
+        self.evicted = False
+        self.mmap = None
+
+    def close(self):
+        if self.mmap != None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # a view is still in use, the map is closed once it is gone
+        os.close(self.fd)
+
+
+class FileCache:
+    """LRU cache of open read-only files and their stat results.
+
+    Entries checked less than ttl seconds ago are used without any syscall, older ones are revalidated
+    with a single stat of their path. Counts hits and misses.
+    """
+
+    def __init__(self, max_entries=8, ttl=2.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, path):
+        """Returns a CachedFile for path if it is cached and unchanged, otherwise None.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry == None:
+                return None
+            now = monotonic()
+            if now - entry.checked > self.ttl:
+                try:
+                    fs = os.stat(path)
+                except OSError:
+                    fs = None
+                if fs == None or (fs.st_ino, fs.st_size, fs.st_mtime_ns) != \
+                        (entry.stat.st_ino, entry.stat.st_size, entry.stat.st_mtime_ns):
+                    self._evict(path)
+                    return None
+                entry.checked = now
+            self._entries.move_to_end(path)
+            self.hits += 1
+            entry.refs += 1
+            return CachedFile(self, entry)
+
+    def open(self, path):
+        """Opens the regular file at path and returns it as CachedFile. Raises OSError if that is not possible.
+        """
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+        try:
+            fs = os.fstat(fd)
+            if not stat.S_ISREG(fs.st_mode):
+                raise OSError(EISDIR if stat.S_ISDIR(fs.st_mode) else EINVAL,
+                              "Not a regular file", path)
+        except:
+            os.close(fd)
+            raise
+        entry = _FileCacheEntry(fd, fs, monotonic())
+        with self._lock:
+            self.misses += 1
+            self._evict(path)
+            self._entries[path] = entry
+            entry.refs += 1
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+        return CachedFile(self, entry)
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._entries):
+                self._evict(path)
+
+    def _evict(self, path):
+        entry = self._entries.pop(path, None)
+        if entry != None:
+            entry.evicted = True
+            if entry.refs == 0:
+                entry.close()
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.evicted and entry.refs == 0:
+                entry.close()
+
+    def _view(self, entry, offset, count):
+        with self._lock:
+            if entry.mmap == None:
+                entry.mmap = mmap.mmap(entry.fd, 0, access=mmap.ACCESS_READ)
+            return memoryview(entry.mmap)[offset:offset + count]
+
+
+class ReadAhead:
+    """Warms the page cache for the file that is about to be played.
+
+    prefetch() starts loading the first window bytes of a file before the browser requests it.
+    Afterwards the window follows the offsets of the requests for that file.
+    Uses posix_fadvise if available, otherwise reads in a background thread.
+    The time to the first byte of the first response for each prefetched file is logged and kept in first_byte_times.
+    """
+
+    def __init__(self, window=8*1024*1024):
+        self.window = window
+        self.first_byte_times = deque(maxlen=20)
+        self._lock = Lock()
+        self._path = None
+        self._fd = None
+        self._warmed = (0, 0)
+        self._awaiting_first_byte = False
+
+    def prefetch(self, path):
+        """Starts warming the beginning of the file at path. A window of 0 only measures the time to the first byte.
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            if path == self._path:
+                return  # already warming
+            self._close()
+            self._path = path
+            self._awaiting_first_byte = True
+            if self.window <= 0:
+                return
+            try:
+                self._fd = os.open(path, os.O_RDONLY |
+                                   getattr(os, "O_CLOEXEC", 0))
+            except OSError as e:
+                logging.debug("Cannot read ahead %s: %s" % (path, str(e)))
+                return
+            self._warm(0)
+        logging.debug("Reading ahead %d bytes of %s" % (self.window, path))
+
+    def follow(self, path, offset):
+        """Moves the window if a request for path at offset gets near its end or starts before it.
+        """
+        with self._lock:
+            if self._fd == None or os.path.normpath(path) != self._path:
+                return
+            start, end = self._warmed
+            if offset < start or offset + self.window // 2 > end:
+                self._warm(offset)
+
+    def first_byte(self, path, seconds):
+        with self._lock:
+            if not self._awaiting_first_byte or os.path.normpath(path) != self._path:
+                return
+            self._awaiting_first_byte = False
+            self.first_byte_times.append(seconds)
+        logging.info("Time to first byte of %s: %.1f ms (read-ahead %s)" %
+                     (path, seconds * 1000, "%d KiB" % (self.window // 1024) if self.window > 0 else "disabled"))
+
+    def stop(self):
+        with self._lock:
+            self._close()
+            self._path = None
+
+    def _warm(self, offset):
+        self._warmed = (offset, offset + self.window)
+        if hasattr(os, "posix_fadvise"):
+            # the kernel reads asynchronously, nothing to wait for here
+            os.posix_fadvise(self._fd, offset, self.window,
+                             os.POSIX_FADV_WILLNEED)
+        else:
+            Thread(target=_read_file_range, name="ReadAhead._warm", daemon=True,
+                   args=(self._path, offset, self.window)).start()
+
+    def _close(self):
+        if self._fd != None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _read_file_range(path, offset, count):
+    """Reads and discards a part of a file, so it ends up in the page cache.
+    """
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            f.seek(offset)
+            while count > 0:
+                read_buf = f.read(min(1024*1024, count))
+                if len(read_buf) == 0:
+                    break
+                count -= len(read_buf)
+    except OSError as e:
+        logging.debug("Reading ahead %s failed: %s" % (path, str(e)))
+
+
+class ValidatorCache:
+    """Small LRU cache of the validators (ETag and Last-Modified) of served files.
+
+    An entry is only used as long as inode, size and modification time of its file are unchanged.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, path, fs):
+        """Returns (etag, last_modified, last_modified_header) of the file at path with the stat result fs.
+        """
+        key = (fs.st_ino, fs.st_size, fs.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry != None and entry[0] == key:
+                self._entries.move_to_end(path)
+                return entry[1]
+        etag = '"%x-%x-%x"' % key
+        # remove microseconds, like in If-Modified-Since
+        last_modif = datetime.datetime.fromtimestamp(
+            fs.st_mtime, datetime.timezone.utc).replace(microsecond=0)
+        validators = (etag, last_modif,
+                      email.utils.formatdate(fs.st_mtime, usegmt=True))
+        with self._lock:
+            self._entries[path] = (key, validators)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return validators
+
+
+class DirectoryListing:
+    """The entries of a directory. HTML and JSON representations are rendered on first use.
+
+    generation is unique for every state of every listing, so it identifies their compressed representations.
+    """
+    _generations = count()
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.wd = None
+        self._entries = {}  # name -> [is_dir, is_link, size, mtime]
+        # scandir knows the entry types without further syscalls
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            self._entries[entry.name] = [
+                is_dir, entry.is_symlink(), None, None]
+        self._names = sorted(self._entries, key=lambda a: a.lower())
+        self._html = None
+        self._json = None
+        self.generation = next(self._generations)
+
+    def update(self, name):
+        """Reloads the metadata of a single entry.
+        """
+        info = self._entries.get(name)
+        if info == None:
+            return
+        self._stat(name, info)
+        self._html = None
+        self._json = None
+        self.generation = next(self._generations)
+
+    def html_items(self):
+        if self._html == None:
+            r = []
+            for name in self._names:
+                is_dir, is_link = self._entries[name][:2]
+                displayname = linkname = name
+                # Append / for directories or @ for symbolic links
+                if is_dir:
+                    displayname = name + "/"
+                    linkname = name + "/"
+                if is_link:
+                    displayname = name + "@"
+                    # Note: a link to a directory displays with @ and links with /
+                r.append('<li><a href="%s">%s</a></li>'
+                         % (urllib.parse.quote(linkname,
+                                               errors='surrogatepass'),
+                            escape(displayname)))
+            self._html = '\n'.join(r)
+        return self._html
+
+    def json(self):
+        if self._json == None:
+            items = []
+            for name in self._names:
+                info = self._entries[name]
+                if info[2] == None:
+                    self._stat(name, info)  # only needed for JSON
+                items.append({"name": name, "type": "dir" if info[0] else "file",
+                              "link": info[1], "size": info[2], "mtime": info[3]})
+            self._json = json.dumps(items).encode("utf-8")
+        return self._json
+
+    def _stat(self, name, info):
+        fullname = os.path.join(self.path, name)
+        try:
+            fs = os.stat(fullname)
+        except OSError:
+            try:
+                fs = os.lstat(fullname)  # e.g. broken link
+            except OSError:
+                info[2] = info[3] = 0  # removed in the meantime
+                return
+        info[0] = stat.S_ISDIR(fs.st_mode)
+        info[2] = fs.st_size
+        info[3] = int(fs.st_mtime)
+
+
+class DirectoryListingCache:
+    """Small LRU cache of directory listings.
+
+    A listing is reused as long as the modification time of its directory is unchanged.
+    If inotify_simple is installed, changed files are updated in the cached listings too,
+    so their sizes and modification times stay current without listing the directory again.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._watches = {}  # watch descriptor -> path
+        self._listing = {}  # watch descriptor -> number of listings in progress that use it
+        self._lock = Lock()
+        self._inotify = None
+        if INotify != None:
+            try:
+                self._inotify = INotify()
+            except OSError as e:
+                logging.warning(
+                    "Could not use inotify for directory listings: %s" % str(e))
+
+    def get(self, path):
+        """Returns the current listing of the directory at path. Raises OSError if it cannot be listed.
+        """
+        dir_mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            self._process_events()
+            listing = self._entries.get(path)
+            if listing != None and listing.mtime == dir_mtime:
+                self._entries.move_to_end(path)
+                return listing
+            self._drop(path)
+            # watch before listing, so no change gets lost
+            wd = self._watch(path)
+            if wd != None:
+                self._listing[wd] = self._listing.get(wd, 0) + 1
+        try:
+            listing = DirectoryListing(path, dir_mtime)
+        except:
+            with self._lock:
+                self._listed(wd)
+                if wd not in self._watches:
+                    self._unwatch(wd)
+            raise
+        listing.wd = wd
+        with self._lock:
+            self._drop(path)  # in case another thread was faster, its watch is the same as ours
+            self._entries[path] = listing
+            if wd != None:
+                self._watches[wd] = path
+            self._listed(wd)
+            while len(self._entries) > self.max_entries:
+                self._unwatch(self._entries.popitem(last=False)[1].wd)
+        return listing
+
+    def _listed(self, wd):
+        if wd != None:
+            self._listing[wd] -= 1
+            if self._listing[wd] == 0:
+                del self._listing[wd]
+
+    def _process_events(self):
+        if self._inotify == None:
+            return
+        for event in self._inotify.read(timeout=0):
+            path = self._watches.get(event.wd)
+            listing = self._entries.get(path) if path != None else None
+            if listing == None:
+                continue
+            if event.mask & _INOTIFY_ENTRY_CHANGED and event.name:
+                listing.update(event.name)
+            else:
+                self._drop(path)  # entries were added or removed
+
+    def _watch(self, path):
+        if self._inotify == None:
+            return None
+        try:
+            return self._inotify.add_watch(path, _INOTIFY_WATCH_FLAGS)
+        except OSError as e:
+            logging.debug("Could not watch %s: %s" % (path, str(e)))
+            return None
+
+    def _unwatch(self, wd):
+        if wd == None:
+            return
+        self._watches.pop(wd, None)
+        if wd in self._listing:
+            return  # inotify returns the same descriptor for the same directory, a listing in progress still needs it
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            pass  # directory is already gone
+
+    def _drop(self, path):
+        listing = self._entries.pop(path, None)
+        if listing != None:
+            self._unwatch(listing.wd)
+
+
+class CompressionCache:
+    """LRU cache of responses compressed on the fly, limited by the size of the compressed data.
+    """
+
+    def __init__(self, max_bytes=4*1024*1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key, encoding, data_func):
+        """Returns the data returned by data_func compressed with encoding.
+
+        data_func is only called if there is no cached result for key and encoding.
+        """
+        key = (key, encoding)
+        with self._lock:
+            data = self._entries.get(key)
+            if data != None:
+                self._entries.move_to_end(key)
+                return data
+        data = _COMPRESSORS[encoding](data_func())
+        with self._lock:
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = data
+                self._size += len(data)
+                while self._size > self.max_bytes:
+                    self._size -= len(self._entries.popitem(last=False)[1])
+        return data
+
+
 class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
     # TODO non static serve_path?
     serve_path = os.getcwd()
@@ -40,13 +559,33 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
     # enable keepalives:
     protocol_version = "HTTP/1.1"
 
-    range_regex = re.compile(r"^bytes=(\d+)\-(\d+)?")
+    # a single byte range spec of a Range header (first-last, first- or -suffix)
+    range_regex = re.compile(r"^(\d*)-(\d*)$")
+    # let the kernel copy file contents directly to the socket if possible
+    use_sendfile = hasattr(os, "sendfile")
+    # write cached files from a shared memory map instead (takes precedence over sendfile)
+    use_mmap = False
+    file_cache = FileCache()
+    # set to a ReadAhead to warm the page cache for the book that is played
+    read_ahead = None
+    validator_cache = ValidatorCache()
+    listing_cache = DirectoryListingCache()
+    compression_cache = CompressionCache()
+
+    # only these are compressed, media files are left alone
+    compressible_types = ("text/", "application/javascript", "application/json",
+                          "application/xml", "image/svg+xml")
+    precompressed_suffixes = (("br", ".br"), ("gzip", ".gz"))
+    # smaller responses do not get smaller, bigger ones should be pre-compressed
+    compress_min_size = 256
+    compress_max_size = 512*1024
+    # sent on its own before the rest of a body, so the time to the first byte is known early
+    first_chunk_length = 64*1024
 
     def do_HEAD(self):
         """ Overridden to handle HTTP Range requests.
         """
-        self.range_from, self.range_to = self._get_range_header()
-        self.response_type = HTTPStatus.OK if self.range_from == None else HTTPStatus.PARTIAL_CONTENT
+        self.ranges = self._get_range_header()
         self.cors_req = self._has_cors_header()
         f = self.send_headers()
         # don't send the file
@@ -56,16 +595,18 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
         """ Overridden to handle HTTP Range requests.
         """
-        self.range_from, self.range_to = self._get_range_header()
-        self.response_type = HTTPStatus.OK if self.range_from == None else HTTPStatus.PARTIAL_CONTENT
+        self.ranges = self._get_range_header()
         self.cors_req = self._has_cors_header()
         f = self.send_headers()
         if f:
             try:
-                if self.range_from == None:
+                if self.ranges == None:
                     self.copyfile(f, self.wfile)  # default
+                elif len(self.ranges) == 1:
+                    self.copy_file_range(
+                        f, self.wfile, *self.ranges[0])  # ranged
                 else:
-                    self.copy_file_range(f, self.wfile)  # ranged
+                    self.copy_file_multipart(f, self.wfile)  # multiple ranges
             finally:
                 f.close()
 
@@ -87,12 +628,26 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
             logging.debug("Connection closed")
             self.close_connection = True
 
-    def copy_file_range(self, in_file, out_file):
-        """ Copy only the range in self.range_from/to.
+    def copyfile(self, source, outputfile):
+        """ Overridden to use sendfile for regular files.
+        """
+        if self._can_mmap(source):
+            self._write_view(source, outputfile, 0, source.stat.st_size)
+        elif self._can_sendfile(source, outputfile):
+            self._sendfile(source, 0, None)
+        else:
+            super().copyfile(source, outputfile)
+
+    def copy_file_range(self, in_file, out_file, range_from, range_to):
+        """ Copy only the inclusive range range_from-range_to.
         """
-        in_file.seek(self.range_from)
         # Add 1 because the range is inclusive
-        bytes_to_copy = 1 + self.range_to - self.range_from
+        bytes_to_copy = 1 + range_to - range_from
+        if self._can_mmap(in_file):
+            return self._write_view(in_file, out_file, range_from, bytes_to_copy)
+        if self._can_sendfile(in_file, out_file):
+            return self._sendfile(in_file, range_from, bytes_to_copy)
+        in_file.seek(range_from)
         buf_length = 64*1024
         bytes_copied = 0
         while bytes_copied < bytes_to_copy:
@@ -101,13 +656,27 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
             if len(read_buf) == 0:
                 break
             out_file.write(read_buf)
+            if bytes_copied == 0:
+                self._first_byte_sent()
             bytes_copied += len(read_buf)
         return bytes_copied
 
+    def copy_file_multipart(self, in_file, out_file):
+        """ Copy all ranges in self.ranges as multipart/byteranges body.
+        """
+        for range_from, range_to, part_header in self.multipart_parts:
+            out_file.write(part_header)
+            self.copy_file_range(in_file, out_file, range_from, range_to)
+        out_file.write(self._multipart_end())
+
     def send_headers(self):
+        self.request_start = monotonic()
+        self.file_path = None
+        self.first_byte_noted = False
         path = self.translate_path(self.path)
-        f = None
-        if os.path.isdir(path):
+        # recently served files are used without touching the file system
+        f = self.file_cache.get(path)
+        if f == None and os.path.isdir(path):
             parts = urllib.parse.urlsplit(self.path)
             if not parts.path.endswith('/'):
                 # redirect browser - doing basically what apache does
@@ -124,55 +693,76 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
                     path = index
                     break
             else:
+                self.ranges = None  # generated content is always sent completely
                 return self.list_directory(path)
 
         ctype = self.guess_type(path)
-        try:
-            f = open(path, 'rb')
-        except OSError:
-            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
-            return None
+        if f == None:
+            try:
+                f = self.file_cache.open(path)
+            except OSError:
+                self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+                return None
 
+        self.file_path = path
         try:
-            fs = os.fstat(f.fileno())
+            fs = f.stat
+            etag, last_modif, last_modif_header = self.validator_cache.get(
+                path, fs)
+            if self.ranges != None and not self._if_range_matches(etag, last_modif):
+                # the file changed since the client got its part, so send everything
+                logging.debug("If-Range does not match, ignoring Range")
+                self.ranges = None
+
+            file_size = fs[6]
+            encoding = None
+            compressible = self._is_compressible(ctype)
+            if compressible and self.ranges == None:  # ranges always refer to the identity
+                f, file_size, encoding = self._select_encoding(
+                    path, f, fs, etag)
+                if encoding != None:
+                    etag = etag[:-1] + "-" + encoding + '"'
+
             # Use browser cache if possible
-            if "If-Modified-Since" in self.headers:
-                # compare If-Modified-Since and time of last file modification
-                try:
-                    ims = email.utils.parsedate_to_datetime(
-                        self.headers["If-Modified-Since"])
-                except (TypeError, IndexError, OverflowError, ValueError):
-                    # ignore ill-formed values
-                    pass
-                else:
-                    if ims.tzinfo is None:
-                        # obsolete format with no timezone, cf.
-                        # https://tools.ietf.org/html/rfc7231#section-7.1.1.1
-                        ims = ims.replace(tzinfo=datetime.timezone.utc)
-                    if ims.tzinfo is datetime.timezone.utc:
-                        # compare to UTC datetime of last modification
-                        last_modif = datetime.datetime.fromtimestamp(
-                            fs.st_mtime, datetime.timezone.utc)
-                        # remove microseconds, like in If-Modified-Since
-                        last_modif = last_modif.replace(microsecond=0)
-
-                        if last_modif <= ims:
-                            self.send_response(HTTPStatus.NOT_MODIFIED)
-                            self.end_headers()
-                            f.close()
-                            return None
+            if self._is_not_modified(etag, last_modif):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                if compressible:
+                    self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                f.close()
+                return None
 
+            if self.ranges != None:
+                self.ranges = self._resolve_ranges(self.ranges, file_size)
+                if len(self.ranges) == 0:
+                    f.close()
+                    self.send_range_not_satisfiable(file_size)
+                    return None
+            if self.read_ahead != None:
+                # keep the read-ahead window in front of the playback position
+                self.read_ahead.follow(
+                    path, 0 if self.ranges == None else self.ranges[0][0])
+            self.response_type = HTTPStatus.OK if self.ranges == None else HTTPStatus.PARTIAL_CONTENT
             self.send_response(self.response_type)
 
             # show that we allow range requests
             self.send_header("Accept-Ranges", "bytes")
 
-            self.send_header("Content-Type", ctype)
+            if self.ranges != None and len(self.ranges) > 1:
+                self.boundary = uuid.uuid4().hex
+                self.send_header("Content-Type",
+                                 "multipart/byteranges; boundary=%s" % self.boundary)
+            else:
+                self.send_header("Content-Type", ctype)
+            if encoding != None:
+                self.send_header("Content-Encoding", encoding)
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
 
-            file_size = fs[6]
-            self.send_length_header(file_size)
-            self.send_header(
-                "Last-Modified", self.date_time_string(fs.st_mtime))
+            self.send_length_header(file_size, ctype)
+            self.send_header("Last-Modified", last_modif_header)
+            self.send_header("ETag", etag)
             # self.send_header("Date", self.date_time_string(fs.st_mtime)) #dafuq?
             self.send_cors_headers()
             self.end_headers()
@@ -187,85 +777,112 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
             self.send_header("Access-Control-Allow-Methods",
                              "OPTIONS, GET, HEAD")
             self.send_header("Access-Control-Allow-Headers",
-                             "If-Modified-Since, Range")
+                             "If-Modified-Since, If-None-Match, If-Range, Range")
             self.send_header("Access-Control-Expose-Headers",
-                             "Content-Length, Content-Range, Accept-Ranges")
+                             "Content-Length, Content-Range, Accept-Ranges, ETag")
             self.send_header("Access-Control-Max-Age", "86400")
 
-    def send_length_header(self, file_size):
-        if self.range_from != None:
-            if self.range_to == None or self.range_to >= file_size:
-                self.range_to = file_size-1
+    def send_length_header(self, file_size, ctype=None):
+        if self.ranges != None and len(self.ranges) > 1:
+            # every part gets its own header, the length includes all of them
+            self.multipart_parts = []
+            content_length = len(self._multipart_end())
+            for range_from, range_to in self.ranges:
+                part_header = ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" %
+                               (self.boundary, ctype, range_from, range_to, file_size)).encode("latin-1")
+                self.multipart_parts.append(
+                    (range_from, range_to, part_header))
+                # Add 1 because ranges are inclusive
+                content_length += len(part_header) + \
+                    1 + range_to - range_from
+            self.send_header("Content-Length", str(content_length))
+            logging.debug("Multi range request, sending bytes %s/%d" % (
+                ",".join("%d-%d" % r for r in self.ranges), file_size))
+        elif self.ranges != None:
+            range_from, range_to = self.ranges[0]
             self.send_header("Content-Range",
-                             "bytes %d-%d/%d" % (self.range_from,
-                                                 self.range_to,
+                             "bytes %d-%d/%d" % (range_from,
+                                                 range_to,
                                                  file_size))
             # Add 1 because ranges are inclusive
             self.send_header("Content-Length",
-                             (1 + self.range_to - self.range_from))
-            logging.debug("Range request, sending bytes %d-%d/%d" % (self.range_from,
-                                                                     self.range_to,
+                             (1 + range_to - range_from))
+            logging.debug("Range request, sending bytes %d-%d/%d" % (range_from,
+                                                                     range_to,
                                                                      file_size))
         else:
             self.send_header("Content-Length", str(file_size))
 
+    def send_range_not_satisfiable(self, file_size):
+        """Answers a request whose ranges are all outside of the file.
+        """
+        self.response_type = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        self.send_response(self.response_type)
+        self.send_header("Content-Range", "bytes */%d" % file_size)
+        self.send_header("Content-Length", "0")
+        self.send_cors_headers()
+        self.end_headers()
+        logging.debug("Range request not satisfiable for %d bytes" % file_size)
+
     def list_directory(self, path):
         """Helper to produce a directory listing (absent index.html).
 
+        The listing is sent as JSON if the client accepts application/json, otherwise as HTML.
         Return value is either a file object, or None (indicating an
         error).  In either case, the headers are sent, making the
         interface the same as for send_headers().
         """
         try:
-            list = os.listdir(path)
+            listing = self.listing_cache.get(path)
         except OSError:
             self.send_error(
                 HTTPStatus.NOT_FOUND,
                 "No permission to list directory")
             return None
-        list.sort(key=lambda a: a.lower())
-        logging.debug("Listing directory %s" % list)
-        r = []
-        try:
-            displaypath = urllib.parse.unquote(self.path,
-                                               errors='surrogatepass')
-        except UnicodeDecodeError:
-            displaypath = urllib.parse.unquote(path)
-        displaypath = escape(displaypath)
-        enc = getfilesystemencoding()
-        title = 'Directory listing for %s' % displaypath
-        r.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" '
-                 '"http://www.w3.org/TR/html4/strict.dtd">')
-        r.append('<html>\n<head>')
-        r.append('<meta http-equiv="Content-Type" '
-                 'content="text/html; charset=%s">' % enc)
-        r.append('<title>%s</title>\n</head>' % title)
-        r.append('<body>\n<h1>%s</h1>' % title)
-        r.append('<hr>\n<ul>')
-        for name in list:
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
-                displayname = name + "/"
-                linkname = name + "/"
-            if os.path.islink(fullname):
-                displayname = name + "@"
-                # Note: a link to a directory displays with @ and links with /
-            r.append('<li><a href="%s">%s</a></li>'
-                     % (urllib.parse.quote(linkname,
-                                           errors='surrogatepass'),
-                        escape(displayname)))
-        r.append('</ul>\n<hr>\n</body>\n</html>\n')
-        encoded = '\n'.join(r).encode(enc, 'surrogateescape')
+        logging.debug("Listing directory %s" % path)
+        request_path = None
+        if "application/json" in self.headers.get("Accept", ""):
+            encoded = listing.json()
+            ctype = "application/json"
+        else:
+            r = []
+            # without query, so the listing is the same for all requests of the directory
+            request_path = self.path.split('?', 1)[0].split('#', 1)[0]
+            try:
+                displaypath = urllib.parse.unquote(request_path,
+                                                   errors='surrogatepass')
+            except UnicodeDecodeError:
+                displaypath = urllib.parse.unquote(path)
+            displaypath = escape(displaypath)
+            enc = getfilesystemencoding()
+            title = 'Directory listing for %s' % displaypath
+            r.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+                     '"http://www.w3.org/TR/html4/strict.dtd">')
+            r.append('<html>\n<head>')
+            r.append('<meta http-equiv="Content-Type" '
+                     'content="text/html; charset=%s">' % enc)
+            r.append('<title>%s</title>\n</head>' % title)
+            r.append('<body>\n<h1>%s</h1>' % title)
+            r.append('<hr>\n<ul>')
+            r.append(listing.html_items())
+            r.append('</ul>\n<hr>\n</body>\n</html>\n')
+            encoded = '\n'.join(r).encode(enc, 'surrogateescape')
+            ctype = "text/html; charset=%s" % enc
+        encoding = self._select_compression(len(encoded))
+        if encoding != None:
+            encoded = self.compression_cache.get(
+                (path, listing.generation, request_path), encoding, lambda: encoded)
         f = BytesIO()
         f.write(encoded)
         f.seek(0)
         self.send_response(HTTPStatus.OK)
         # show that we allow range requests
         self.send_header("Accept-Ranges", "bytes")
-        self.send_header("Content-Type", "text/html; charset=%s" % enc)
+        self.send_header("Content-Type", ctype)
+        if encoding != None:
+            self.send_header("Content-Encoding", encoding)
         self.send_header("Content-Length", str(len(encoded)))
+        self.send_header("Vary", "Accept, Accept-Encoding")
         self.send_cors_headers()
         self.end_headers()
         return f
@@ -308,32 +925,433 @@ class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
         """
         return "Access-Control-Request-Method" in self.headers or "Access-Control-Request-Headers" in self.headers or "Origin" in self.headers
 
+    def _first_byte_sent(self):
+        """Reports the time to the first byte of the body to the read-ahead.
+        """
+        if self.read_ahead != None and not self.first_byte_noted:
+            self.first_byte_noted = True
+            self.read_ahead.first_byte(
+                self.file_path, monotonic() - self.request_start)
+
+    def _can_mmap(self, in_file):
+        # empty files cannot be mapped
+        return self.use_mmap and isinstance(in_file, CachedFile) and in_file.stat.st_size > 0
+
+    def _write_view(self, in_file, out_file, offset, count):
+        """Writes count bytes at offset of in_file from its memory map without copying them.
+
+        Returns the number of bytes written.
+        """
+        with in_file.view(offset, count) as view:
+            with view[:self.first_chunk_length] as first:
+                out_file.write(first)
+            self._first_byte_sent()
+            with view[self.first_chunk_length:] as rest:
+                out_file.write(rest)
+            return len(view)
+
+    def _can_sendfile(self, in_file, out_file):
+        """Returns if in_file can be sent to out_file without copying it through python.
+
+        This is only possible for real files that are written to the socket of this request.
+        """
+        if not self.use_sendfile or out_file is not self.wfile:
+            return False
+        return _has_fileno(in_file)
+
+    def _sendfile(self, in_file, offset, count):
+        """Sends count bytes (or everything if None) of in_file starting at offset via sendfile.
+
+        Returns the number of bytes sent.
+        """
+        # make sure nothing is left in the write buffer before bypassing it
+        self.wfile.flush()
+        if count == None and isinstance(in_file, CachedFile):
+            count = max(0, in_file.stat.st_size - offset)
+        if count == None or self.connection.gettimeout() != None:
+            # the first chunk separately, a blocking sendfile only returns after the whole range
+            bytes_sent = self.connection.sendfile(in_file, offset, self.first_chunk_length if count == None
+                                                  else min(count, self.first_chunk_length))
+            self._first_byte_sent()
+            if bytes_sent > 0 and (count == None or bytes_sent < count):
+                bytes_sent += self.connection.sendfile(in_file, offset + bytes_sent,
+                                                       None if count == None else count - bytes_sent)
+            return bytes_sent
+        # blocking socket with known length: no need for the extra checks of socket.sendfile
+        sock_fd = self.connection.fileno()
+        file_fd = in_file.fileno()
+        bytes_sent = 0
+        while bytes_sent < count:
+            # the first chunk separately, a blocking sendfile only returns after the whole range
+            sent = os.sendfile(sock_fd, file_fd, offset + bytes_sent, count - bytes_sent if bytes_sent > 0
+                               else min(count, self.first_chunk_length))
+            if sent == 0:
+                break  # end of file
+            if bytes_sent == 0:
+                self._first_byte_sent()
+            bytes_sent += sent
+        return bytes_sent
+
+    def _is_compressible(self, ctype):
+        return ctype.startswith(self.compressible_types)
+
+    def _accepted_encodings(self):
+        """Returns the set of content codings accepted by the client.
+        """
+        accepted = set()
+        for item in self.headers.get("Accept-Encoding", "").split(","):
+            coding, _, params = item.partition(";")
+            coding = coding.strip().lower()
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            if coding and q > 0:
+                accepted.add("gzip" if coding == "x-gzip" else coding)
+        return accepted
+
+    def _select_compression(self, size):
+        """Returns the encoding to compress a response of size bytes on the fly or None.
+        """
+        if size < self.compress_min_size or size > self.compress_max_size:
+            return None
+        accepted = self._accepted_encodings()
+        for encoding in _COMPRESSORS:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def _select_encoding(self, path, f, fs, etag):
+        """Returns (file, size, encoding) of the best representation of the opened file f the client accepts.
+
+        Prefers pre-compressed siblings (like app.js.br or app.js.gz) that are not older than the file itself.
+        """
+        accepted = self._accepted_encodings()
+        for encoding, suffix in self.precompressed_suffixes:
+            if encoding not in accepted:
+                continue
+            try:
+                encoded = open(path + suffix, 'rb')
+            except OSError:
+                continue
+            efs = os.fstat(encoded.fileno())
+            if efs.st_mtime >= fs.st_mtime:
+                f.close()
+                return (encoded, efs.st_size, encoding)
+            encoded.close()  # outdated
+        encoding = self._select_compression(fs.st_size)
+        if encoding == None:
+            return (f, fs.st_size, None)
+        data = self.compression_cache.get((path, etag), encoding, f.read)
+        f.close()
+        return (BytesIO(data), len(data), encoding)
+
+    def _is_not_modified(self, etag, last_modif):
+        """Returns if the cached version of the client is still valid.
+        """
+        if "If-None-Match" in self.headers:
+            # If-None-Match takes precedence over If-Modified-Since
+            for tag in self.headers["If-None-Match"].split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]  # weak comparison
+                if tag == "*" or tag == etag:
+                    return True
+            return False
+        if "If-Modified-Since" in self.headers:
+            # compare If-Modified-Since and time of last file modification
+            ims = _parse_http_date(self.headers["If-Modified-Since"])
+            return ims != None and last_modif <= ims
+        return False
+
+    def _if_range_matches(self, etag, last_modif):
+        """Returns if a Range request may be answered partially.
+
+        Without If-Range this is always the case, otherwise the validator has to match the current file.
+        """
+        if_range = self.headers["If-Range"]
+        if if_range == None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == etag  # strong comparison, weak tags never match
+        return _parse_http_date(if_range) == last_modif
+
     def _get_range_header(self):
-        """Returns request Range start and end if specified.
+        """Returns the requested byte ranges as list of (first, last) tuples.
+
+        first is None for suffix ranges (last is the suffix length then) and last is None for open ranges.
+        If Range header is not specified or invalid returns None
+        """
+        range_header = self.headers["Range"]
+        if range_header == None:
+            return None
+        unit, sep, specs = range_header.partition("=")
+        if not sep or unit.strip().lower() != "bytes":
+            return None
+        ranges = []
+        for spec in specs.split(","):
+            spec = spec.strip()
+            if not spec:
+                continue  # empty list elements are allowed
+            match = self.range_regex.match(spec)
+            if match == None or (not match.group(1) and not match.group(2)):
+                return None
+            first = int(match.group(1)) if match.group(1) else None
+            last = int(match.group(2)) if match.group(2) else None
+            if first != None and last != None and last < first:
+                return None  # syntactically invalid, ignore the whole header
+            ranges.append((first, last))
+        return ranges if len(ranges) > 0 else None
+
+    def _resolve_ranges(self, ranges, file_size):
+        """Returns the satisfiable ranges as sorted list of inclusive (from, to) tuples.
+
+        Overlapping and adjacent ranges are merged, so no byte is sent twice.
+        """
+        resolved = []
+        for first, last in ranges:
+            if first == None:  # suffix range
+                if last == 0:
+                    continue
+                first = max(0, file_size - last)
+                last = file_size - 1
+            elif last == None or last >= file_size:
+                last = file_size - 1
+            if first < file_size:
+                resolved.append((first, last))
+        resolved.sort()
+        merged = []
+        for first, last in resolved:
+            if len(merged) > 0 and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def _multipart_end(self):
+        return ("\r\n--%s--\r\n" % self.boundary).encode("latin-1")
 
-        If Range header is not specified returns (None, None)
+
+class AsyncRequestHandlerMixin:
+    """Runs a request handler on an already received request head.
+
+    The response head is collected in wfile and the file to send is kept open in body_file,
+    so the AsyncHTTPServer can stream it without blocking its event loop.
+    """
+
+    def __init__(self, head, client_address, server):
+        self.rfile = BytesIO(head)
+        self.wfile = BytesIO()
+        self.client_address = client_address
+        self.server = server
+        self.body_file = None
+        self.close_connection = True
+        self.handle_one_request()
+
+    def do_GET(self):
+        """ Overridden to keep the file open for streaming.
         """
+        self.ranges = self._get_range_header()
+        self.cors_req = self._has_cors_header()
+        self.body_file = self.send_headers()
+
+
+class AsyncHTTPServer:
+    """HTTP server that handles all connections with asyncio streams in the thread running serve_forever.
+
+    Requests are parsed and their files opened by a small thread pool, the bodies are streamed by the event loop.
+    It needs a few threads instead of one per connection, but every send happens in the loop thread:
+    with many concurrent readers the latency is higher than with the threading engine
+    (see "ServerBenchmark.py load"). The browser of the player only uses a few connections.
+    Offers the parts of the HTTPServer interface that are used with get_threaded_server and run_server.
+    """
+    request_queue_size = 5
+    buf_length = 64*1024
+    # threads that parse requests and open the files, so filesystem access never blocks the event loop
+    handler_threads = 2
+
+    def __init__(self, server_address, RequestHandlerClass, address_family=AF_INET):
+        self.RequestHandlerClass = type(
+            "Async" + RequestHandlerClass.__name__, (AsyncRequestHandlerMixin, RequestHandlerClass), {})
+        # bind right away, so errors like EADDRINUSE are raised here like with HTTPServer
+        self.socket = socket(address_family)
         try:
-            range_header = self.headers["Range"]
-            if range_header == None:
-                return (None, None)
-            match = self.range_regex.match(range_header)
-            if match == None:
-                return (None, None)
+            self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(self.request_queue_size)
         except:
-            return (None, None)
-        from_val = int(match.group(1))
-        if match.group(2) != None:
-            return (from_val, int(match.group(2)))
+            self.socket.close()
+            raise
+        self.server_address = self.socket.getsockname()
+        self._eventLoop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.handler_threads)
+        self._server = None
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self._eventLoop)
+        self._server = self._eventLoop.run_until_complete(
+            asyncio.start_server(self._handle_connection, sock=self.socket))
+        try:
+            self._eventLoop.run_forever()
+        finally:
+            self._server.close()
+            # abort open connections
+            pending = asyncio.Task.all_tasks(self._eventLoop) if hasattr(
+                asyncio.Task, "all_tasks") else asyncio.all_tasks(self._eventLoop)
+            for task in pending:
+                task.cancel()
+            try:
+                self._eventLoop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True))
+            except asyncio.CancelledError:
+                pass
+            self._eventLoop.run_until_complete(self._server.wait_closed())
+            self._eventLoop.close()
+            self._executor.shutdown()
+
+    def shutdown(self):
+        if not self._eventLoop.is_closed():
+            self._eventLoop.call_soon_threadsafe(self._eventLoop.stop)
+
+    def server_close(self):
+        if self._server == None and not self._eventLoop.is_running():
+            # never started
+            self.socket.close()
+            self._eventLoop.close()
+            self._executor.shutdown()
         else:
-            return (from_val, None)
+            self.shutdown()  # serve_forever closes the socket with the server
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break  # closed or garbage
+                # stat, open and listings may block on a slow card, so the loop only streams
+                handler = await self._eventLoop.run_in_executor(
+                    self._executor, self.RequestHandlerClass, head, client_address, self)
+                writer.write(handler.wfile.getvalue())
+                if handler.body_file != None:
+                    try:
+                        await self._send_body(writer, handler)
+                    finally:
+                        handler.body_file.close()
+                await writer.drain()
+                if handler.close_connection:
+                    break
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):  # ignore closed connections
+            logging.debug("Connection closed")
+        except asyncio.CancelledError:
+            logging.debug("Connection aborted by shutdown")
+        finally:
+            writer.close()
 
+    async def _send_body(self, writer, handler):
+        if handler.ranges == None:
+            await self._send_file_range(writer, handler, 0, None)
+        elif len(handler.ranges) == 1:
+            range_from, range_to = handler.ranges[0]
+            await self._send_file_range(writer, handler, range_from,
+                                        1 + range_to - range_from)
+        else:
+            for range_from, range_to, part_header in handler.multipart_parts:
+                writer.write(part_header)
+                await self._send_file_range(writer, handler, range_from,
+                                            1 + range_to - range_from)
+            writer.write(handler._multipart_end())
 
-def get_threaded_server(port=8080, next_attempts=0, serve_path=None, ipv6=False, handler=RangeHTTPRequestHandler):
+    async def _send_file_range(self, writer, handler, offset, count):
+        """Sends count bytes (or everything if None) of the handlers body file starting at offset.
+        """
+        in_file = handler.body_file
+        if handler._can_mmap(in_file):
+            if count == None:
+                count = in_file.stat.st_size - offset
+            # slices of buf_length, so a slow client never makes the transport copy more than one of them
+            view = in_file.view(offset, count)
+            try:
+                for start in range(0, count, self.buf_length):
+                    chunk = view[start:start + self.buf_length]
+                    writer.write(chunk)
+                    handler._first_byte_sent()
+                    await writer.drain()
+                    if writer.transport.get_write_buffer_size() == 0:
+                        chunk.release()  # otherwise the transport still references it, dropping it is enough
+                    del chunk
+            finally:
+                view.release()  # the slices stay valid without it
+            return
+        if handler.use_sendfile and hasattr(self._eventLoop, "sendfile") and _has_fileno(in_file):
+            await writer.drain()
+            # the first chunk separately, sendfile only returns after the whole range
+            sent = await self._eventLoop.sendfile(writer.transport, in_file, offset, handler.first_chunk_length
+                                                  if count == None else min(count, handler.first_chunk_length))
+            handler._first_byte_sent()
+            if sent > 0 and (count == None or sent < count):
+                await self._eventLoop.sendfile(writer.transport, in_file, offset + sent,
+                                               None if count == None else count - sent)
+            return
+        in_file.seek(offset)
+        while count == None or count > 0:
+            read_buf = await self._eventLoop.run_in_executor(self._executor, in_file.read,
+                                                             self.buf_length if count == None else min(self.buf_length, count))
+            if len(read_buf) == 0:
+                break
+            writer.write(read_buf)
+            handler._first_byte_sent()
+            await writer.drain()  # wait while the client is slower than the disk
+            if count != None:
+                count -= len(read_buf)
+
+
+@lru_cache(maxsize=64)
+def _parse_http_date(value):
+    """Returns the UTC datetime of an HTTP date header or None if it is ill-formed.
+    """
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return None
+    if date.tzinfo is None:
+        # obsolete format with no timezone, cf.
+        # https://tools.ietf.org/html/rfc7231#section-7.1.1.1
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    if date.tzinfo is not datetime.timezone.utc:
+        return None
+    return date
+
+
+def _has_fileno(f):
+    try:
+        f.fileno()
+    except (AttributeError, UnsupportedOperation):
+        return False  # e.g. BytesIO of a directory listing
+    return True
+
+
+def get_threaded_server(port=8080, next_attempts=0, serve_path=None, ipv6=False, handler=RangeHTTPRequestHandler,
+                        engine="threading", read_ahead=None):
+    """Returns a server bound to the first free port starting at port.
+
+    engine "threading" uses one thread per connection, "asyncio" serves all connections from the thread running it.
+    """
     if serve_path:
         handler.serve_path = serve_path
+    if read_ahead != None:
+        handler.read_ahead = read_ahead
+    if engine not in ("threading", "asyncio"):
+        raise ValueError("Unknown server engine: %s" % engine)
     while next_attempts >= 0:
         try:
+            if engine == "asyncio":
+                return AsyncHTTPServer(("localhost", port), handler, AF_INET6 if ipv6 else AF_INET)
             httpd = ThreadingHTTPServer(("localhost", port), handler)
             if (ipv6):
                 httpd.address_family = AF_INET6
@@ -374,10 +1392,19 @@ def main():
                         type=str, default=os.getcwd(), required=False)
     parser.add_argument(
         "-6", "--ipv6", help="Use IPv6 instead of IPv4", action='store_true')
+    parser.add_argument("-e", "--engine", help="The server engine: threading or asyncio (Default: threading)",
+                        type=str, choices=["threading", "asyncio"], default="threading", required=False)
+    parser.add_argument("--no-sendfile", help="Copy files through python instead of using sendfile (for comparison)",
+                        action='store_true')
+    parser.add_argument("--mmap", help="Send files from shared memory maps instead of using sendfile",
+                        action='store_true')
     args = parser.parse_args()
+    if args.no_sendfile:
+        RangeHTTPRequestHandler.use_sendfile = False
+    RangeHTTPRequestHandler.use_mmap = args.mmap
 
     httpd = get_threaded_server(
-        port=args.port, serve_path=args.dir, ipv6=args.ipv6)
+        port=args.port, serve_path=args.dir, ipv6=args.ipv6, engine=args.engine)
 
     logging.info("Serving %s at localhost:%d via IPv%d..." %
                  (args.dir, args.port, 6 if args.ipv6 else 4))
@@ -387,6 +1414,8 @@ def main():
         pass
     logging.info("Shutting down")
     httpd.server_close()
+    logging.info("File cache: %d hits, %d misses" % (RangeHTTPRequestHandler.file_cache.hits,
+                                                     RangeHTTPRequestHandler.file_cache.misses))
 
 
 if __name__ == "__main__":
@@ -4,23 +4,28 @@
 import logging
 import re
 import subprocess
-import urllib.parse
 from os import WIFEXITED, _exit, fork, path, popen, setsid, sys, system
-from posixpath import normpath
 from signal import (SIG_IGN, SIGHUP, SIGINT, SIGKILL, SIGSTOP, SIGTERM,
                     Signals, default_int_handler, signal)
 from sys import exit
-from threading import Semaphore, Thread, Timer, enumerate
+from threading import Semaphore, Thread, enumerate
 
-import RPi.GPIO as GPIO
+from CardCache import CardCache
+from CardParser import CardParser
+from CommandChannel import CommandChannel
 from Configuration import *
 from GpioInput import *
 from GpioOutput import *
+from Hardware import GPIO, hardwareBackend
+from PlayerState import PlayerState
 from RepeatCmd import *
 from RfidReader import *
-from SingleClientWebsocket import *
-from SoundSynthesizer import DefaultSoundSynthesizer
-from ThreadingRangeHTTPServer import get_threaded_server, run_server
+from Scheduler import defaultScheduler, stopDefaultScheduler
+from SharedEventLoop import threadStatistics
+from SoundSynthesizer import createSoundSynthesizer
+from TextToSpeech import TextToSpeech
+from ThreadingRangeHTTPServer import ReadAhead, get_threaded_server, run_server
+from VolumeControl import VolumeControl
 
 __version_info__ = (1, 0, 0)
 __version__ = '.'.join(map(str, __version_info__))
@@ -39,6 +44,8 @@ logging.basicConfig(
     format="(%(module)s->%(funcName)s) [%(levelname)s] %(message)s",
     level=logging.DEBUG if config.getboolean("UserControl", "loggingDebug") else logging.INFO)
 logging.debug("Configuration and logging ready")
+if hardwareBackend != "rpi":
+    logging.warning("Using %s hardware", hardwareBackend)
 
 
 def sigHandler(sigNum, stackFrame):
@@ -54,6 +61,8 @@ class UserControl:
     _sysShutdown = False
     pausedStatus = [0.75, 1.5]
     errorStatus = [0.25, 0.5, 0.25, 0.5, 1.5, 0.5]
+    __browserLogLevels = {"debug": logging.DEBUG, "info": logging.INFO,
+                          "warn": logging.WARNING, "error": logging.ERROR}
 
     def __init__(self, config):
         self.config = config
@@ -71,17 +80,35 @@ class UserControl:
         self._reader = None
         self._websocket = None
         self._offlineServer = None
+        self._readAhead = None
         self._sound = None
-        self.__browserTimer = None
-        self.__readyTimer = None
-        self.__recheckStatusTimer = None
+        self._volumeControl = None
+        self._scheduler = defaultScheduler()
         if self._shutdownButton != None and self._shutdownButton.isPressed:
             self._shutdown(1, True)  # shutdown request after start
             return
         self.__paused = True
         self.__networkError = False
         self.__currentUrl = None
-        self._sound = DefaultSoundSynthesizer()
+        self._playerState = PlayerState()
+        # browser messages by type
+        self.__messageHandlers = {
+            "hello": self.__onHello,
+            "state": self.__onState,
+            "log": self.__onLog,
+            "readout": self.__onReadout,
+            "playing": self.__onPlaying,
+            "paused": self.__onPaused,
+            "finished": self.__onFinished,
+            "loaded": self.__onLoaded,
+            "unloaded": self.__onUnloaded,
+            "network": self.__onNetwork
+        }
+        self._sound = createSoundSynthesizer(
+            self.config.get("Extra", "soundBackend"), self.config.get("Extra", "soundDevice"),
+            (self.config.get("UserControl", "language"),),
+            TextToSpeech(self.config.get("Extra", "ttsCache") or None,
+                         int(self.config.getfloat("Extra", "ttsCacheSize") * 1024 * 1024)))
         self._sound.playSound(self.config.get(
             "UserControl", "language") + "/startup.wav", 0)
 
@@ -94,14 +121,19 @@ class UserControl:
             int(self.config.get("UserControl", "key6"), 16)
         ]
         rfidKeyType = self.config.get("UserControl", "selectedKey")
+        self._cardParser = CardParser(
+            self.config.get("UserControl", "offlineDir"))
         self._reader = RfidReader(
             self._readerDetect, self.config.getint(
                 "OutputPins", "rst"), self.config.getint("OutputPins", "ce"),
-            self.config.getint("InputPins", "irq"), GPIO.BOARD, rfidKey, rfidKeyType)
+            self.config.getint("InputPins", "irq"), GPIO.BOARD, rfidKey, rfidKeyType,
+            removalMode=self.config.get("Extra", "rfidRemovalMode"),
+            removalInterval=self.config.getfloat("Extra", "rfidRemovalInterval"),
+            cardCache=CardCache(self.config.get("Extra", "rfidCardCache") or None))
 
         wsHost = self.config.get("Extra", "socketHost")
         wsPort = self.config.getint("Extra", "socketPort")
-        self._websocket = SingleClientWebsocket(
+        self._websocket = CommandChannel(
             wsHost, wsPort, self._websocketMsg, self._websocketConn)
         self._websocket.start()
 
@@ -146,6 +178,10 @@ class UserControl:
         if self.config.getint("InputPins", "volumeClk") > 0 and self.config.getint("InputPins", "volumeDt") > 0:
             logging.debug("Volume control enabled on pins %d and %d" % (self.config.getint(
                 "InputPins", "volumeClk"), self.config.getint("InputPins", "volumeDt")))
+            self._volumeControl = VolumeControl(
+                self.config.get("Extra", "volumeMixer"), self.config.getint("UserControl", "volumePercent"),
+                self.config.get("Extra", "volumeBackend"), self.config.get("Extra", "soundDevice"),
+                self.config.getfloat("Extra", "volumeInterval"), maxAcceleration=self.config.getint("Extra", "volumeAcceleration"))
             self._volRotaryEncoder = GpioInputRotaryEncoder(
                 self.config.getint("InputPins", "volumeClk"), self.config.getint("InputPins", "volumeDt"), self._volume)
         else:
@@ -153,11 +189,17 @@ class UserControl:
             self._volRotaryEncoder = None
 
         self._checkAndStartBrowser()
+        if self.config.getfloat("Chromium", "checktime") > 0:
+            self._scheduler.every(self.config.getfloat(
+                "Chromium", "checktime"), self._checkAndStartBrowser, name="browserCheck")
 
         if self.config.getboolean("UserControl", "useOffline"):
             serverDir = self.config.get("UserControl", "offlineDir")
+            self._readAhead = ReadAhead(
+                int(self.config.getfloat("UserControl", "offlinePrefetchMB") * 1024 * 1024))
             self._offlineServer = get_threaded_server(
-                port=8081, serve_path=serverDir)
+                port=8081, serve_path=serverDir, engine=self.config.get("UserControl", "offlineEngine"),
+                read_ahead=self._readAhead)
             Thread(target=run_server, name="offlineServer.run",
                    kwargs={"server": self._offlineServer}).start()
             logging.debug(
@@ -165,33 +207,61 @@ class UserControl:
         logging.info("User control ready")
 
     def _readyRepeat(self):
-        self.__readyTimer = None
         if self.__running and self._reader.currentCard == None:
             self._sound.playSound(self.config.get(
                 "UserControl", "language") + "/readyRepeat.wav")
-            self.__readyTimer = Timer(self.config.getfloat(
-                "UserControl", "readyRepeat"), self._readyRepeat)
-            self.__readyTimer.start()
+        else:
+            self._scheduler.cancel("readyRepeat")
+
+    def __startReadyRepeat(self, now=False):
+        # repeat the ready sound as long as there is no card
+        if not self._scheduler.isScheduled("readyRepeat"):
+            interval = self.config.getfloat("UserControl", "readyRepeat")
+            self._scheduler.every(interval, self._readyRepeat,
+                                  name="readyRepeat", delay=0 if now else interval)
 
     def __recheckStatus(self):
-        self.__recheckStatusTimer = None
         if self.__running and self.config.getfloat("Chromium", "recheckBrowser") > 0 and self._websocket.connected:
-            if self._websocket.send("status"):
+            if self._websocket.send("status", coalesceKey="status"):
                 logging.info("Rechecking current browser status")
             else:
                 self._internalError("Status check via websocket failed", False)
-            self.__recheckStatusTimer = Timer(
-                self.config.getfloat("Chromium", "recheckBrowser"), self.__recheckStatus)
-            self.__recheckStatusTimer.start()
+        else:
+            self._scheduler.cancel("statusCheck")
+
+    def __stateStreaming(self):
+        """Returns True if the browser can push its state and it should"""
+        return self._websocket.connected and self._websocket.version >= 1 and self.config.getfloat("Chromium", "stateHeartbeat") > 0
+
+    def __checkState(self):
+        heartbeat = self.config.getfloat("Chromium", "stateHeartbeat")
+        if not self.__running or not self.__stateStreaming():
+            self._scheduler.cancel("stateWatchdog")
+            return
+        if self.__currentUrl == None:
+            return  # there is no player without a book
+        if self._playerState.isStale(3 * heartbeat):
+            # fall back to polling and try to restart the stream
+            logging.warning("No player state for %.1f seconds, polling status", self._playerState.age)
+            self._playerState.reset()
+            if not self._websocket.send("status", coalesceKey="status") or not self._websocket.send("subscribe", interval=heartbeat):
+                self._internalError("Status check via websocket failed", False)
+        elif self._playerState.isStalled(3 * heartbeat):
+            logging.warning("Player stalled, it is buffering for more than %.1f seconds", 3 * heartbeat)
 
     def __restartStatusCheck(self):
-        if self.__recheckStatusTimer != None:
-            self.__recheckStatusTimer.cancel()
-            self.__recheckStatusTimer = None
-        if self._websocket.connected and self.config.getfloat("Chromium", "recheckBrowser") > 0:
-            self.__recheckStatusTimer = Timer(
-                self.config.getfloat("Chromium", "recheckBrowser"), self.__recheckStatus)
-            self.__recheckStatusTimer.start()
+        if self.__stateStreaming():
+            # the browser pushes its state, the watchdog only polls if the stream stops
+            self._scheduler.cancel("statusCheck")
+            self._scheduler.every(self.config.getfloat(
+                "Chromium", "stateHeartbeat"), self.__checkState, name="stateWatchdog")
+        elif self._websocket.connected and self.config.getfloat("Chromium", "recheckBrowser") > 0:
+            self._scheduler.cancel("stateWatchdog")
+            self._scheduler.every(self.config.getfloat(
+                "Chromium", "recheckBrowser"), self.__recheckStatus, name="statusCheck")
+        else:
+            self._scheduler.cancel("stateWatchdog")
+            self._scheduler.cancel("statusCheck")
 
     def _internalError(self, error, showUser=True, soundFile="error"):
         logging.error(error)
@@ -208,35 +278,32 @@ class UserControl:
             self._statusLed.off()  # turn off while loading the page
             logging.info("RFID-card detected: %s; Content:\n%s",
                          arrayToHexString(card.uid), card.content)
-            urls = card.content.split(";")
-            offlineUrl = None
-            i = 0
-            while i < len(urls):
-                # TODO compile
-                if re.match("^https?:\/\/(?:[a-z0-9_\-]+)+(?:\.[a-z0-9_\-]+)+(?:\/(?:[a-z0-9_\-\.]|%[\da-f]{2})+)+\/?(?:\?.*|#.*)?$", urls[i], re.IGNORECASE) != None:
-                    i += 1  # url match
-                elif re.match("^offline:\/\/(?:(?:[a-z0-9_\-\.]|%[\da-f]{2})+\/?)+$", urls[i], re.IGNORECASE) != None:
-                    offlineUrl = urls[i]  # offline url match
-                    urls.remove(urls[i])  # remove url
-                    logging.debug("Found offline url")
-                else:
-                    logging.warn("Invalid URL on card: %s" % urls[i])
-                    urls.remove(urls[i])  # remove url
-            if len(urls) == 0 and offlineUrl == None:
+            content = self._cardParser.parse(card)
+            for url in content.invalidUrls:
+                logging.warning("Invalid URL on card: %s" % url)
+            if len(content.onlineUrls) == 0 and content.offlineUrl == None:
                 self._internalError("No valid URL on card",
                                     soundFile="invalidCard")
                 return
             # TODO we could now try every url on this card but for now we check the offline url and use the first online url as fallback
-            load = urls[0]
-            if offlineUrl != None:
-                offFile = normpath(path.join(self.config.get(
-                    "UserControl", "offlineDir"), urllib.parse.unquote(offlineUrl[10:])))
-                if path.exists(offFile):
-                    load = offlineUrl
+            load = content.onlineUrls[0] if len(
+                content.onlineUrls) > 0 else None
+            if content.offlineUrl != None:
+                logging.debug("Found offline url")
+                # checked every time, the offline storage is removable
+                if path.exists(content.offlinePath):
+                    load = content.offlineUrl
+                    if self._readAhead != None:
+                        # warm up before the browser asks
+                        self._readAhead.prefetch(content.offlinePath)
+            if load == None:
+                self._internalError(
+                    "Offline book %s not found and no online URL on card" % content.offlinePath)
+                return
             self.__currentUrl = load
             logging.debug("Selected url '%s'" % self.__currentUrl)
             if self._websocket.connected:
-                if self._websocket.send("load\n" + load):
+                if self._websocket.send("load", url=load):
                     self._sound.playSound(self.config.get(
                         "UserControl", "language") + "/loading.wav")
                     self.__paused = True
@@ -245,6 +312,8 @@ class UserControl:
                     self._internalError("Load via websocket failed")
         else:
             logging.info("RFID-card removed")
+            if self._readAhead != None:
+                self._readAhead.stop()
             if self._websocket.connected:
                 self.__currentUrl = None
                 if self._websocket.send("reset"):
@@ -253,17 +322,15 @@ class UserControl:
                     self.__networkError = False
                 else:
                     self._internalError("Reset via websocket failed")
-            if self.config.getfloat("UserControl", "readyRepeat") > 0 and self.__readyTimer == None:
-                self.__readyTimer = Timer(
-                    self.config.getfloat("UserControl", "readyRepeat"), self._readyRepeat)  # start delayed
-                self.__readyTimer.start()
+            if self.config.getfloat("UserControl", "readyRepeat") > 0:
+                self.__startReadyRepeat()  # start delayed
 
     def _websocketConn(self, connected):
         if not self.__running:
             return
         if connected and self.__currentUrl != None:
             logging.info("Browser connected, loading book")
-            if self._websocket.send("load\n" + self.__currentUrl):
+            if self._websocket.send("load", url=self.__currentUrl):
                 self._sound.stopPlayback() # abort sound
                 self._sound.playSound(self.config.get(
                     "UserControl", "language") + "/loading.wav")
@@ -275,108 +342,141 @@ class UserControl:
         elif connected:  # no card
             logging.info("Browser connected")
             self._statusLed.on()  # on equals ready for input (book/rfid)
-            if self.config.getfloat("UserControl", "readyRepeat") > 0 and self.__readyTimer == None:
-                self._readyRepeat()  # tell the user we are ready to go
+            if self.config.getfloat("UserControl", "readyRepeat") > 0:
+                self.__startReadyRepeat(True)  # tell the user we are ready to go
             elif self.config.getfloat("UserControl", "readyRepeat") <= 0:
                 self._sound.stopPlayback() # abort sound
                 self._sound.playSound(self.config.get(
                     "UserControl", "language") + "/ready.wav")
         elif not connected:
             logging.info("Browser disconnected")
+            self._playerState.reset()
             self._statusLed.setPattern(self.errorStatus)
-            if self.__browserTimer == None:
+            if not self._scheduler.isScheduled("browserCheck"):
                 self._checkAndStartBrowser()
 
         # run status checks while the browser is connected
         self.__restartStatusCheck()
 
-    def _websocketMsg(self, msg, retry=0):
-        lines = msg.split('\n', 3)
-
-        if lines[0] == "log" and len(lines) == 3:
-            if lines[1] == "debug":
-                logging.debug("BROWSER: " + lines[2])
-            elif lines[1] == "info":
-                logging.info("BROWSER: " + lines[2])
-            elif lines[1] == "warn":
-                logging.warning("BROWSER: " + lines[2])
-            elif lines[1] == "error":
-                logging.error("BROWSER: " + lines[2])
-            else:
-                logging.warning(
-                    "Invalid browser log command: %s\n%s" % (lines[1], lines[2]))
-            return
-
-        if not self.__running:
+    def _websocketMsg(self, message):
+        if message["type"] != "log" and not self.__running:
             return  # only log commands are allowed while stopping
+        handler = self.__messageHandlers.get(message["type"])
+        if handler == None:
+            self._internalError("Unknown command received: %s" %
+                                message["type"], False)
+            return
+        try:
+            handler(message)
+        except KeyError as error:
+            self._internalError("Command %s misses field %s" %
+                                (message["type"], str(error)), False)
+
+    def __onHello(self, message):
+        self._playerState.reset()
+        heartbeat = self.config.getfloat("Chromium", "stateHeartbeat")
+        if heartbeat > 0 and not self._websocket.send("subscribe", interval=heartbeat):
+            self._internalError("Subscribe via websocket failed", False)
+        self.__restartStatusCheck()
 
-        if lines[0] == "readout" and len(lines) == 2:
-            # replace all spaces/newlines
-            text = re.sub("\s", " ", lines[1], flags=re.MULTILINE)
-            # make sure only allowed chars will be passed to the shell
-            text = re.sub("[^\w ]", "", text)
-            self._sound.stopPlayback() # abort sound
-            success = self._sound.playTextOnce(
-                text, self.config.get("UserControl", "language"))
-            if not success and retry < self.config.getint("Extras", "readRetries"):
-                Timer(self.config.getfloat("Extras", "readRepeatSecs"), self._websocketMsg, kwargs={
-                      "msg": msg, "retry": retry + 1}).start()  # try again later
-            elif not success:
-                self._internalError(
-                    "Could not read message, because device was still busy", False)
-            else:
-                logging.debug("Read text: %s", text)
-        elif lines[0] == "playing":
-            if self.__paused:
-                self.__paused = False
-                self._statusLed.on()
-                logging.info("Now playing")
+    def __onState(self, message):
+        changes = self._playerState.update(message)
+        if "chapter" in changes and changes["chapter"][1] != None:
+            logging.info("Chapter changed: %s", changes["chapter"][1])
+        if "buffering" in changes:
+            logging.info("Player %s buffering", "started" if changes["buffering"][1] else "stopped")
+        if "error" in changes and changes["error"][1] != None:
+            logging.error("Player error: %s", changes["error"][1])
+        if "playing" in changes and changes["playing"][1] != None:
+            if changes["playing"][1]:
+                self.__onPlaying(message)
             else:
-                logging.debug("Still playing")
-        elif lines[0] == "paused":
-            if not self.__paused:
-                self.__paused = True
-                self._statusLed.setPattern(self.pausedStatus)
-                logging.info("Now paused")
-                self._sound.playSound(self.config.get(
-                    "UserControl", "language") + "/paused.wav")
-            else:
-                logging.debug("Still paused")
-        elif lines[0] == "finished":
+                self.__onPaused(message)
+
+    def __onLog(self, message):
+        level = self.__browserLogLevels.get(message["level"])
+        if level != None:
+            logging.log(level, "BROWSER: " + message["msg"])
+        else:
+            logging.warning(
+                "Invalid browser log command: %s\n%s" % (message["level"], message["msg"]))
+
+    def __onReadout(self, message, retry=0):
+        # replace all spaces/newlines
+        text = re.sub("\s", " ", message["text"], flags=re.MULTILINE)
+        # only allow words and the punctuation that ends sentences (the text is read in chunks of sentences)
+        text = re.sub("[^\w .,!?;:]", "", text)
+        self._sound.stopPlayback() # abort sound
+        success = self._sound.playTextOnce(
+            text, self.config.get("UserControl", "language"))
+        if not success and retry < self.config.getint("Extra", "readRetries"):
+            self._scheduler.callLater(self.config.getfloat("Extra", "readRepeatSecs"), self.__retryReadout, args=(
+                message, retry + 1), name="readoutRetry")  # try again later
+        elif not success:
+            self._internalError(
+                "Could not read message, because device was still busy", False)
+        else:
+            logging.debug("Read text: %s", text)
+
+    def __retryReadout(self, message, retry):
+        if self.__running:
+            self.__onReadout(message, retry)
+
+    def __onPlaying(self, message):
+        if self.__paused:
+            self.__paused = False
+            self._statusLed.on()
+            logging.info("Now playing")
+        else:
+            logging.debug("Still playing")
+
+    def __onPaused(self, message):
+        if not self.__paused:
             self.__paused = True
             self._statusLed.setPattern(self.pausedStatus)
-            logging.info("Book finished")
-        elif lines[0] == "loaded" and len(lines) == 2:
-            self.__paused = True
-            self.__networkError = False
-            if self.__currentUrl == None:
-                self._internalError(
-                    "Browser opened %s but there is no RFID-card" % lines[1])
-            elif not lines[1].startswith(self.__currentUrl):
-                self._internalError(
-                    "Browser opened %s, but %s is to be opened" % (lines[1], self.__currentUrl))
-            else:
-                self._sound.stopPlayback() # abort sound
-                self._sound.playSound(self.config.get(
-                    "UserControl", "language") + "/ready.wav")
-                self._statusLed.setPattern(self.pausedStatus)
-                logging.info("Browser loading finished")
-        elif lines[0] == "unloaded":
-            if self.__networkError:
-                return
-            self.__paused = True
-            if self.__currentUrl != None:
-                self._internalError(
-                    "Browser unloaded page, but %s should be open now" % self.__currentUrl)
-            else:
-                self._statusLed.on()  # on equals ready for input (book/rfid)
-            # else everything is fine
-        elif lines[0] == "network":
-            self.__paused = True
-            self.__networkError = True
-            self._internalError("Network problem", soundFile="network")
+            logging.info("Now paused")
+            self._sound.playSound(self.config.get(
+                "UserControl", "language") + "/paused.wav")
+        else:
+            logging.debug("Still paused")
+
+    def __onFinished(self, message):
+        self.__paused = True
+        self._statusLed.setPattern(self.pausedStatus)
+        logging.info("Book finished")
+
+    def __onLoaded(self, message):
+        self._playerState.reset()  # new page, new player
+        self.__paused = True
+        self.__networkError = False
+        if self.__currentUrl == None:
+            self._internalError(
+                "Browser opened %s but there is no RFID-card" % message["url"])
+        elif not message["url"].startswith(self.__currentUrl):
+            self._internalError(
+                "Browser opened %s, but %s is to be opened" % (message["url"], self.__currentUrl))
         else:
-            self._internalError("Unknown command received: %s" % msg, False)
+            self._sound.stopPlayback() # abort sound
+            self._sound.playSound(self.config.get(
+                "UserControl", "language") + "/ready.wav")
+            self._statusLed.setPattern(self.pausedStatus)
+            logging.info("Browser loading finished")
+
+    def __onUnloaded(self, message):
+        if self.__networkError:
+            return
+        self.__paused = True
+        if self.__currentUrl != None:
+            self._internalError(
+                "Browser unloaded page, but %s should be open now" % self.__currentUrl)
+        else:
+            self._statusLed.on()  # on equals ready for input (book/rfid)
+        # else everything is fine
+
+    def __onNetwork(self, message):
+        self.__paused = True
+        self.__networkError = True
+        self._internalError("Network problem", soundFile="network")
 
     def _playPause(self, pin=0):
         if self.__running and self._websocket.connected:
@@ -399,12 +499,8 @@ class UserControl:
                 self._internalError("Forward via websocket failed", False)
 
     def _volume(self, direction):
-        logging.debug("Volume changing: %s%d%%", "+" if direction >
-                      0 else "", self.config.getint("UserControl", "volumePercent") * direction)
-        # change the volume by percentage up or down
-        subprocess.Popen("amixer set PCM %d%%%s" % (self.config.getint("UserControl", "volumePercent"), "+" if direction > 0 else "-"),
-                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                         close_fds=True, shell=True, start_new_session=True)
+        # change the volume by percentage up or down (collected and applied on the shared event loop)
+        self._volumeControl.step(direction)
 
     def _shutdown(self, pin=0, skipSound=False):
         if self._sysShutdown:
@@ -437,33 +533,32 @@ class UserControl:
         except Exception as error:
             logging.error(
                 "Checking and starting browser gave exception:\n%s", str(error))
-        if self.__running:  # check again since the command above needs time
-            self.__browserTimer = Timer(
-                self.config.getfloat("Chromium", "checktime"), self._checkAndStartBrowser)
-            self.__browserTimer.start()
 
     def stop(self):
         self.__running = False
         if self._statusLed != None:
             self._statusLed.off()
         logging.info("Stopping user control")
-        if self.__browserTimer != None:
-            self.__browserTimer.cancel()
-        if self.__readyTimer != None:
-            self.__readyTimer.cancel()
-        if self.__recheckStatusTimer != None:
-            self.__recheckStatusTimer.cancel()
+        logging.debug("Threads: %d, context switches: %d voluntary, %d involuntary" %
+                      threadStatistics())
+        for job in ("browserCheck", "readyRepeat", "statusCheck", "stateWatchdog", "readoutRetry"):
+            self._scheduler.cancel(job)
         if self._reader != None:  # this would be None on an immediate shutdown
             self._reader.stop(False)
         if self._websocket != None:  # this would be None on an immediate shutdown
-            self._websocket.send("shutdown")
+            self._websocket.send("shutdown", wait=True)
             self._websocket.stop()
         if self._offlineServer != None:
             self._offlineServer.server_close()
+        if self._readAhead != None:
+            self._readAhead.stop()
         gpioInputStop(False)
         gpioOutputStop(False)
+        if self._volumeControl != None:
+            self._volumeControl.close()
         if self._sound != None:  # this would be None on an immediate shutdown
             self._sound.stopPlayback()
+            self._sound.close()
 
 
 control = None
@@ -484,7 +579,7 @@ try:
         if s.endswith("Command") and "command" in config[s] and "interval" in config[s] and "name" in config[s]:
             logging.debug("Found command %s" % config.get(s, "name"))
             repeatCmd(config.get(s, "command").split(' '), config.getint(s, "interval"), config.get(
-                s, "name"), config.getboolean(s, "repeatOnError", fallback=False))
+                s, "name"), config.getboolean(s, "repeatOnError", fallback=False), config.getfloat(s, "timeout", fallback=2000))
     # this will return true once SIGTERM was received
     while not runSema.acquire(True, 0.25):
         pass
@@ -495,6 +590,7 @@ finally:
     if control != None:
         control.stop()
         GPIO.cleanup()
+    stopDefaultScheduler()  # after all users of it are stopped
 
 runningThreads = enumerate()
 if len(runningThreads) > 1:
@@ -0,0 +1,132 @@
+import logging
+from subprocess import DEVNULL, Popen
+from threading import Lock
+from time import monotonic
+
+from SharedEventLoop import acquireEventLoop, releaseEventLoop
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None  # only amixer is available
+
+__version_info__ = (1, 1, 0)
+__version__ = '.'.join(map(str, __version_info__))
+__author__ = "Sebastian Hofmann (Kaemmelot)"
+__all__ = ['VolumeControl']
+
+
+class VolumeControl(object):
+    """
+    Changes the volume for the steps of the rotary encoder. Steps are collected and applied together on the shared event loop,
+    at most once per minInterval seconds, so a fast spin results in a few absolute sets instead of a process per step.
+    The loop only runs short jobs, so unlike the scheduler thread a slow command never delays a set.
+    Every fourth step in a row within accelerationWindow seconds of the previous one (same direction) makes the steps one step size bigger,
+    up to maxAcceleration times the step size.
+    The mixer is kept open with pyalsaaudio, without it (or with backend amixer) amixer is started for each set
+    """
+
+    def __init__(self, control="PCM", stepPercent=5, backend="auto", device="default",
+                 minInterval=0.05, accelerationWindow=0.1, maxAcceleration=4):
+        self._control = control
+        self._stepPercent = stepPercent
+        self._minInterval = minInterval
+        self._accelerationWindow = accelerationWindow
+        self._maxAcceleration = max(1, maxAcceleration)
+        self._lock = Lock()
+        self._mixer = None
+        if backend in ("auto", "alsa"):
+            try:
+                if alsaaudio == None:
+                    raise ImportError("pyalsaaudio is not installed")
+                self._mixer = alsaaudio.Mixer(control=control, device=device)
+            except Exception as error:
+                (logging.error if backend == "alsa" else logging.info)(
+                    "In-process mixer not available, using amixer: %s", str(error))
+        elif backend != "amixer":
+            logging.error("Unknown volume backend %s, using amixer", backend)
+        self._pending = 0  # percent not applied yet
+        self._pendingSince = None
+        self._lastStep = None
+        self._lastDirection = 0
+        self._fastSteps = 0
+        self._lastApply = 0.0
+        self._handle = None
+        self._loop = acquireEventLoop()
+        # statistics
+        self._started = monotonic()
+        self.steps = 0
+        self.sets = 0
+        self.spawns = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def step(self, direction):
+        """Changes the volume by one step up (direction 1) or down (-1), returns immediately"""
+        now = monotonic()
+        with self._lock:
+            if direction == self._lastDirection and self._lastStep != None and now - self._lastStep < self._accelerationWindow:
+                self._fastSteps += 1
+            else:
+                self._fastSteps = 0
+            acceleration = min(self._maxAcceleration, 1 + self._fastSteps // 4)
+            self._lastStep = now
+            self._lastDirection = direction
+            self._pending = min(100, max(-100, self._pending +
+                                         direction * self._stepPercent * acceleration))
+            self.steps += 1
+            if self._pendingSince != None:
+                return  # the scheduled apply takes this step too
+            self._pendingSince = now
+            delay = self._lastApply + self._minInterval - now
+        self._loop.call_soon_threadsafe(self.__schedule, max(0, delay))
+
+    def __schedule(self, delay):
+        self._handle = self._loop.call_later(delay, self._apply)
+
+    def _apply(self):
+        self._handle = None
+        with self._lock:
+            change = self._pending
+            latency = monotonic() - self._pendingSince
+            self._pending = 0
+            self._pendingSince = None
+        try:
+            if change == 0:
+                pass
+            elif self._mixer != None:
+                volume = min(100, max(0, self._mixer.getvolume()[0] + change))
+                self._mixer.setvolume(volume)
+                logging.debug("Volume set to %d%% (%+d%%)", volume, change)
+            else:
+                Popen(["amixer", "-q", "set", self._control, "%d%%%s" % (abs(change), "+" if change > 0 else "-")],
+                      stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, close_fds=True, start_new_session=True)
+                self.spawns += 1
+                logging.debug("Volume changing: %+d%%", change)
+        except Exception as error:
+            logging.error("Could not change volume: %s", str(error))
+        with self._lock:
+            self._lastApply = monotonic()
+            self.sets += 1
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+
+    def statisticLines(self):
+        """Returns the volume statistics as lines of text"""
+        with self._lock:
+            return ["Volume: %d steps in %d sets, latency mean %.1f ms max %.1f ms, %d processes started (%.3f/s)" % (
+                self.steps, self.sets, self.totalLatency / self.sets * 1000 if self.sets > 0 else 0, self.maxLatency * 1000,
+                self.spawns, self.spawns / (monotonic() - self._started))]
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self.__cancel)
+        releaseEventLoop()
+        for line in self.statisticLines():
+            logging.debug(line)
+        if self._mixer != None:
+            self._mixer.close()
+
+    def __cancel(self):
+        if self._handle != None:
+            self._handle.cancel()
+            self._handle = None